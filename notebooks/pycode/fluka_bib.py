@@ -0,0 +1,149 @@
+import numpy as np
+from numpy.lib import recfunctions as rfn
+
+# Record structures of the FLUKA particle lists
+DTYPES = {
+    'old': np.dtype([
+        ('id', np.int32),
+        ('id_mthr', np.int32),
+        ('E', np.float64),
+        ('x', np.float64),
+        ('y', np.float64),
+        ('z', np.float64),
+        ('cx', np.float64),
+        ('cy', np.float64),
+        ('cz', np.float64),
+        ('age_track', np.float64),
+        ('age_samp', np.float64),
+        ('x_samp', np.float64),
+        ('y_samp', np.float64),
+        ('z_samp', np.float64),
+        ('x_mthr', np.float64),
+        ('y_mthr', np.float64),
+        ('z_mthr', np.float64),
+        ('px_mthr', np.float64),
+        ('py_mthr', np.float64),
+        ('pz_mthr', np.float64),
+        ('age_mthr', np.float64)
+    ]),
+    'new': np.dtype([
+        ('pdgId', np.int32),
+        ('x', np.float64),
+        ('y', np.float64),
+        ('z', np.float64),
+        ('px', np.float64),
+        ('py', np.float64),
+        ('pz', np.float64),
+        ('t', np.float64),
+        ('w', np.float64),
+        ('x_o', np.float64),
+        ('y_o', np.float64),
+        ('z_o', np.float64),
+        ('px_o', np.float64),
+        ('py_o', np.float64),
+        ('pz_o', np.float64),
+        ('x_d', np.float64),
+        ('y_d', np.float64),
+        ('z_d', np.float64),
+        ('t_d', np.float64)
+    ]),
+}
+
+# Quantities computed from the record fields for selections
+DERIVED = {
+    'r': lambda d: np.hypot(d['x'], d['y']),
+    'p': lambda d: np.sqrt(d['px']**2 + d['py']**2 + d['pz']**2),
+    'pt': lambda d: np.hypot(d['px'], d['py']),
+}
+
+
+def open_bib(path, fmt='new'):
+    """Memory-maps the particle list without reading it"""
+    dtype = DTYPES[fmt] if isinstance(fmt, str) else np.dtype(fmt)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+def bib_values(data, name):
+    """Values of a record field or a derived quantity"""
+    if name in data.dtype.names:
+        return data[name]
+    return DERIVED[name](data)
+
+def select_bib(data, pdgs=None, ranges=None, abs_pdg=False):
+    """Mask of records with a PDG ID in `pdgs` and values inside `ranges` {name: (min, max)}
+
+    The ID field is `pdgId` for the new format and the FLUKA `id` for the old one.
+    Either limit of a range can be None.
+    """
+    mask = np.ones(len(data), dtype=bool)
+    if pdgs is not None:
+        ids = data['pdgId'] if 'pdgId' in data.dtype.names else data['id']
+        if abs_pdg:
+            ids = np.abs(ids)
+        mask &= np.isin(ids, pdgs)
+    for name, (v_min, v_max) in (ranges or {}).items():
+        values = bib_values(data, name)
+        if v_min is not None:
+            mask &= values >= v_min
+        if v_max is not None:
+            mask &= values < v_max
+    return mask
+
+def iter_bib(path, fmt='new', chunk_size=1000000, pdgs=None, ranges=None, abs_pdg=False, fields=None):
+    """Yields copies of the selected records and their weights chunk by chunk
+
+    Only one chunk of the memory-mapped file is read at a time and only the selected records
+    are copied, optionally keeping only the given `fields`.
+    Weights are taken from the `w` field and are 1 for lists without it.
+    """
+    data = open_bib(path, fmt)
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        sel = chunk[select_bib(chunk, pdgs, ranges, abs_pdg)]
+        weights = np.array(sel['w']) if 'w' in sel.dtype.names else np.ones(len(sel))
+        if fields is not None:
+            sel = rfn.repack_fields(sel[fields])
+        yield np.array(sel), weights
+
+def write_bib(path, chunks):
+    """Writes records from (records, weights) chunks to a binary file with the same packed structure"""
+    nRecords = 0
+    with open(path, 'wb') as f:
+        for records, _ in chunks:
+            np.ascontiguousarray(records).tofile(f)
+            nRecords += len(records)
+    return nRecords
+
+def write_bib_root(path, chunks, tree_name='bib'):
+    """Writes records from (records, weights) chunks to a TTree with one branch per field"""
+    import ROOT as R
+    if not hasattr(R, 'fill_records'):
+        R.gInterpreter.Declare('''
+        #include "TTree.h"
+        #include <cstring>
+        void fill_records(TTree* tree, unsigned char* record, const unsigned char* data, Long64_t n, Long64_t size) {
+            for (Long64_t i = 0; i < n; ++i) {
+                std::memcpy(record, data + i*size, size);
+                tree->Fill();
+            }
+        }
+        ''')
+    leaf_types = {'int32': 'I', 'uint32': 'i', 'int64': 'L', 'uint64': 'l', 'float32': 'F', 'float64': 'D'}
+    out_file = R.TFile(path, 'RECREATE')
+    tree = None
+    nRecords = 0
+    for records, _ in chunks:
+        records = np.ascontiguousarray(records)
+        if tree is None:
+            # Pointing all branches into a single packed record
+            record = np.zeros(1, dtype=records.dtype)
+            tree = R.TTree(tree_name, 'BIB particles')
+            for name in records.dtype.names:
+                leaf = leaf_types[records.dtype.fields[name][0].name]
+                tree.Branch(name, record[name], '{0:s}/{1:s}'.format(name, leaf))
+            record_bytes = record.view(np.uint8)
+        R.fill_records(tree, record_bytes, records.view(np.uint8), len(records), records.dtype.itemsize)
+        nRecords += len(records)
+    if tree is not None:
+        tree.Write()
+    out_file.Close()
+    return nRecords
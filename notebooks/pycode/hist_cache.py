@@ -0,0 +1,163 @@
+import os
+import json
+import glob
+import hashlib
+import ROOT as R
+
+from .multi_draw import multi_draw
+
+CACHE_DIR = os.environ.get('MUC_HISTO_CACHE', os.path.expanduser('~/.cache/muc_histos'))
+
+
+def tree_inputs(tree):
+    """Paths and modification times of the files the tree is read from, or None for in-memory trees"""
+    if tree.InheritsFrom('TChain'):
+        paths = [el.GetTitle() for el in tree.GetListOfFiles()]
+    else:
+        file_in = tree.GetCurrentFile()
+        if not file_in:
+            return None
+        paths = [file_in.GetName()]
+    return [(os.path.abspath(path), os.path.getmtime(path)) for path in paths]
+
+def binning(spec):
+    """Description of the histogram type and binning of a spec"""
+    if not isinstance(spec, R.TH1):
+        return ['TH{0:d}F'.format(1 if len(spec) == 5 else 2)] + list(spec[2:])
+    axes = [spec.GetXaxis(), spec.GetYaxis()][:spec.GetDimension()]
+    return [spec.ClassName()] + [[axis.GetBinLowEdge(iB) for iB in range(1, axis.GetNbins() + 2)] for axis in axes]
+
+
+class HistoCache(object):
+    """Histograms stored in per-entry ROOT files, evicting the least recently used above `max_bytes`
+
+    Each entry has a JSON description of its key, used to invalidate entries of an input file.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=2*1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, tree, expr, sel, spec, first=0, n=-1):
+        """Key of the histogram filled from the tree"""
+        return {
+            'inputs': tree_inputs(tree),
+            'tree': tree.GetName(),
+            'expr': expr,
+            'sel': sel or '',
+            'binning': binning(spec),
+            'range': [first, n],
+        }
+
+    def entry_path(self, key, ext='.root'):
+        return os.path.join(self.path, hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest() + ext)
+
+    def get(self, key):
+        """Returns a copy of the stored histogram or None"""
+        path = self.entry_path(key)
+        if not os.path.isfile(path):
+            return None
+        with R.TDirectory.TContext():
+            file_in = R.TFile(path)
+            histo = file_in.Get('histo')
+            if histo:
+                histo.SetDirectory(R.nullptr)
+            file_in.Close()
+        if not histo:
+            return None
+        # Marking the entry as recently used
+        os.utime(path)
+        return histo
+
+    def put(self, key, histo):
+        """Stores the histogram and evicts old entries above the size limit"""
+        path = self.entry_path(key)
+        with R.TDirectory.TContext():
+            file_out = R.TFile(path + '.tmp', 'RECREATE')
+            histo.Write('histo')
+            file_out.Close()
+        with open(self.entry_path(key, '.json'), 'w') as f:
+            json.dump(key, f)
+        os.replace(path + '.tmp', path)
+        self.evict()
+
+    def remove(self, path):
+        for p in [path, path.replace('.root', '.json')]:
+            if os.path.isfile(p):
+                os.remove(p)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits into `max_bytes`"""
+        entries = [(os.path.getmtime(p), os.path.getsize(p), p) for p in glob.glob(os.path.join(self.path, '*.root'))]
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def invalidate(self, file_path=None):
+        """Removes all entries or only those filled from the given input file"""
+        for path in glob.glob(os.path.join(self.path, '*.root')):
+            if file_path is not None:
+                try:
+                    with open(path.replace('.root', '.json')) as f:
+                        inputs = [p for p, _ in json.load(f)['inputs']]
+                except (IOError, ValueError):
+                    inputs = []
+                if os.path.abspath(file_path) not in inputs:
+                    continue
+            self.remove(path)
+
+
+HISTO_CACHE = HistoCache()
+
+
+def cached_multi_draw(tree, specs, first=0, n=-1, cache=None):
+    """Same as `multi_draw()`, taking histograms from the cache and filling only the missing ones
+
+    Entries become stale when any input file of the tree is modified. Histograms given as specs
+    are reset first, so that they hold the content from the tree also after repeated calls.
+    Trees not read from files are not cached.
+    """
+    cache = cache or HISTO_CACHE
+    for expr, sel, spec in specs:
+        if isinstance(spec, R.TH1):
+            spec.Reset()
+    if tree_inputs(tree) is None:
+        return multi_draw(tree, specs, first, n)
+    histos = [None] * len(specs)
+    missing = []
+    for iS, (expr, sel, spec) in enumerate(specs):
+        key = cache.key(tree, expr, sel, spec, first, n)
+        histo = cache.get(key)
+        if histo is None:
+            missing.append((iS, key))
+            continue
+        if isinstance(spec, R.TH1):
+            spec.Add(histo)
+            histo = spec
+        else:
+            histo.SetName(spec[0])
+        histos[iS] = histo
+    if missing:
+        # Filling fresh histograms to store only the content from the tree
+        specs_fill = []
+        for iS, key in missing:
+            expr, sel, spec = specs[iS]
+            if isinstance(spec, R.TH1):
+                spec_new = spec.Clone(spec.GetName() + '_fill')
+                spec_new.SetDirectory(R.nullptr)
+                spec_new.Reset()
+                spec = spec_new
+            specs_fill.append((expr, sel, spec))
+        for (iS, key), histo in zip(missing, multi_draw(tree, specs_fill, first, n)):
+            cache.put(key, histo)
+            spec = specs[iS][2]
+            if isinstance(spec, R.TH1):
+                spec.Add(histo)
+                histo = spec
+            histos[iS] = histo
+    return histos
@@ -0,0 +1,133 @@
+import re
+import ROOT as R
+
+# Event loop filling many histograms from TTreeFormulas with the same logic as TTree::Draw
+CODE = '''
+#include "TTree.h"
+#include "TH1.h"
+#include "TH2.h"
+#include "TProfile.h"
+#include "TTreeFormula.h"
+#include "TTreeFormulaManager.h"
+#include <vector>
+
+Long64_t multi_draw_loop(TTree* tree, std::vector<TTreeFormulaManager*>& managers,
+                         std::vector<TTreeFormula*>& vars_x, std::vector<TTreeFormula*>& vars_y,
+                         std::vector<TTreeFormula*>& sels, std::vector<TH1*>& hists,
+                         Long64_t first, Long64_t n) {
+    Long64_t nProcessed = 0;
+    Int_t treeNumber = -1;
+    const size_t nSpecs = hists.size();
+    for (Long64_t entry = first; n < 0 || entry < first + n; ++entry) {
+        if (tree->LoadTree(entry) < 0) break;
+        // Updating the formulas when a new tree of a chain is loaded
+        if (tree->GetTreeNumber() != treeNumber) {
+            treeNumber = tree->GetTreeNumber();
+            for (size_t k = 0; k < nSpecs; ++k) {
+                vars_x[k]->UpdateFormulaLeaves();
+                if (vars_y[k]) vars_y[k]->UpdateFormulaLeaves();
+                if (sels[k]) sels[k]->UpdateFormulaLeaves();
+            }
+        }
+        const Double_t weight = tree->GetWeight();
+        for (size_t k = 0; k < nSpecs; ++k) {
+            const Int_t ndata = managers[k]->GetNdata();
+            TH2* h2 = dynamic_cast<TH2*>(hists[k]);
+            TProfile* hp = dynamic_cast<TProfile*>(hists[k]);
+            for (Int_t i = 0; i < ndata; ++i) {
+                // The selection value is used as the weight
+                const Double_t w = sels[k] ? weight * sels[k]->EvalInstance(i) : weight;
+                // Always evaluating the first instance to load the branches
+                if (w == 0 && i > 0) continue;
+                const Double_t x = vars_x[k]->EvalInstance(i);
+                const Double_t y = vars_y[k] ? vars_y[k]->EvalInstance(i) : 0;
+                if (w == 0) continue;
+                if (h2) h2->Fill(x, y, w);
+                else if (hp) hp->Fill(x, y, w);
+                else hists[k]->Fill(x, w);
+            }
+        }
+        ++nProcessed;
+    }
+    return nProcessed;
+}
+'''
+
+if not hasattr(R, 'multi_draw_loop'):
+    R.gInterpreter.Declare(CODE)
+
+
+def split_expr(expr):
+    """Splits a `y:x` expression into the x and y parts like TTree::Draw (ternary `?:` not supported)"""
+    parts = [p.strip() for p in re.split(r'(?<!:):(?!:)', expr)]
+    if len(parts) > 2:
+        raise ValueError('Only 1D and 2D expressions are supported: {0:s}'.format(expr))
+    if len(parts) == 2:
+        return parts[1], parts[0]
+    return parts[0], None
+
+def make_histo(spec):
+    """Returns the histogram itself or creates one from (name, title, nbins, min, max[, nbinsy, ymin, ymax])"""
+    if isinstance(spec, R.TH1):
+        return spec
+    if len(spec) == 5:
+        histo = R.TH1F(*spec)
+    elif len(spec) == 8:
+        histo = R.TH2F(*spec)
+    else:
+        raise ValueError('Unsupported histogram specification: {0!r}'.format(spec))
+    histo.SetDirectory(R.nullptr)
+    return histo
+
+def multi_draw(tree, specs, first=0, n=-1, cache_size=64*1024*1024):
+    """Fills histograms for a list of (expression, selection, histogram spec) in one pass over the tree
+
+    Expressions and selections use the `TTree::Draw` syntax, including array branches,
+    and the selection value is used as the weight. Only branches referenced by the formulas
+    are read, through a TTreeCache of `cache_size` bytes.
+    Returns the list of histograms in the order of `specs`, which can be passed to `draw()`.
+    """
+    managers = R.std.vector('TTreeFormulaManager*')()
+    vars_x = R.std.vector('TTreeFormula*')()
+    vars_y = R.std.vector('TTreeFormula*')()
+    sels = R.std.vector('TTreeFormula*')()
+    hists = R.std.vector('TH1*')()
+    formulas = []
+    histos = []
+    for iS, (expr, sel, spec) in enumerate(specs):
+        expr_x, expr_y = split_expr(expr)
+        manager = R.TTreeFormulaManager()
+        # Deleted by its formulas
+        R.SetOwnership(manager, False)
+        spec_formulas = []
+        for name, text in [('x', expr_x), ('y', expr_y), ('sel', sel)]:
+            if not text:
+                spec_formulas.append(None)
+                continue
+            formula = R.TTreeFormula('f{0:d}_{1:s}'.format(iS, name), text, tree)
+            if formula.GetNdim() == 0:
+                raise ValueError('Invalid formula for {0:s}: {1:s}'.format(tree.GetName(), text))
+            manager.Add(formula)
+            spec_formulas.append(formula)
+        manager.Sync()
+        formulas.append((manager, spec_formulas))
+        histo = make_histo(spec)
+        histos.append(histo)
+        managers.push_back(manager)
+        vars_x.push_back(spec_formulas[0])
+        vars_y.push_back(spec_formulas[1] or R.nullptr)
+        sels.push_back(spec_formulas[2] or R.nullptr)
+        hists.push_back(histo)
+    # Caching only the branches used by the formulas
+    tree.SetCacheSize(cache_size)
+    for manager, spec_formulas in formulas:
+        for formula in spec_formulas:
+            if formula is None:
+                continue
+            for iL in range(formula.GetNcodes()):
+                leaf = formula.GetLeaf(iL)
+                if leaf:
+                    tree.AddBranchToCache(leaf.GetBranch(), True)
+    tree.StopCacheLearningPhase()
+    R.multi_draw_loop(tree, managers, vars_x, vars_y, sels, hists, first, n)
+    return histos
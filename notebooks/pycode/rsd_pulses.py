@@ -0,0 +1,146 @@
+import os
+import warnings
+import numpy as np
+
+# Sampling period of the pulses [ns]
+DT = 0.05
+N_CHANNELS = 4
+N_SAMPLES = 1002
+N_HEADER_WORDS = 11
+
+
+def parse_pulses(path, n_channels=N_CHANNELS):
+    """Parses a pulse text file into event headers (event, words) and pulses (event, channel, sample)
+
+    Each event starts with a header line of 11 words, the first being the event number,
+    followed by one line of 1002 samples per channel. Incomplete events are skipped.
+    The whole file is converted to numbers at once and the words of complete events are
+    reshaped by the fixed record layout, using the number of words on each line to find them.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    # Line of each word from the positions of the word starts in the raw bytes
+    chars = np.frombuffer(raw, dtype=np.uint8)
+    space = chars <= ord(' ')
+    starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    word_line = np.searchsorted(np.flatnonzero(chars == ord('\n')), starts)
+    n_words = np.bincount(word_line)
+    # Events from the header and sample lines, ignoring any other lines
+    lines = np.flatnonzero((n_words == N_HEADER_WORDS) | (n_words == N_SAMPLES))
+    is_header = n_words[lines] == N_HEADER_WORDS
+    event = np.cumsum(is_header) - 1
+    header_pos = np.flatnonzero(is_header)
+    complete = np.append(np.diff(np.append(header_pos, len(lines))) - 1 == n_channels, False)
+    line_ok = np.zeros(len(n_words), dtype=bool)
+    line_ok[lines] = complete[np.where(event >= 0, event, -1)]
+    word_ok = line_ok[word_line]
+    # Converting all words at once, or only the selected ones if some are not numbers
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(raw, dtype=np.float64, sep=' ')
+    except ValueError:
+        values = None
+    if values is not None and len(values) == len(word_ok):
+        values = values[word_ok]
+    else:
+        values = np.array(raw.split())[word_ok].astype(np.float64)
+    record = values.reshape(-1, N_HEADER_WORDS + n_channels * N_SAMPLES)
+    headers = record[:, :N_HEADER_WORDS]
+    pulses = record[:, N_HEADER_WORDS:].astype(np.float32).reshape(-1, n_channels, N_SAMPLES)
+    return headers, pulses
+
+def parse_pulses_lines(path, n_channels=N_CHANNELS):
+    """Reference line-by-line parser used to check `parse_pulses()`"""
+    headers = []
+    pulses = []
+    event_pulses = []
+    header = None
+    with open(path) as f:
+        for line in f:
+            words = line.split()
+            if len(words) == N_HEADER_WORDS:
+                if header is not None and len(event_pulses) == n_channels:
+                    headers.append(header)
+                    pulses.extend(event_pulses)
+                header = np.array(words, dtype=np.float64)
+                event_pulses = []
+            elif len(words) == N_SAMPLES:
+                event_pulses.append(np.array(words, dtype=np.float32))
+    if header is not None and len(event_pulses) == n_channels:
+        headers.append(header)
+        pulses.extend(event_pulses)
+    headers = np.array(headers, dtype=np.float64).reshape(-1, N_HEADER_WORDS)
+    pulses = np.array(pulses, dtype=np.float32).reshape(-1, n_channels, N_SAMPLES)
+    return headers, pulses
+
+def check_parser(path, n_channels=N_CHANNELS):
+    """Raises an AssertionError if the bulk and the line-by-line parsers disagree on the file"""
+    headers, pulses = parse_pulses(path, n_channels)
+    headers_ref, pulses_ref = parse_pulses_lines(path, n_channels)
+    assert np.array_equal(headers, headers_ref), 'Headers differ in {0:s}'.format(path)
+    assert np.array_equal(pulses, pulses_ref), 'Pulses differ in {0:s}'.format(path)
+    return len(headers)
+
+def sidecar_paths(path):
+    """Paths of the binary files caching the parsed headers and pulses"""
+    base = os.path.splitext(path)[0]
+    return base + '.headers.npy', base + '.pulses.npy'
+
+def load_pulses(path, n_channels=N_CHANNELS, mmap=True):
+    """Returns the event numbers, header words and pulses of the text file
+
+    The parsed arrays are stored in .npy files next to the text file and are reused,
+    memory-mapped, as long as they are newer than the text file.
+    """
+    paths = sidecar_paths(path)
+    mtime = os.path.getmtime(path)
+    if all(os.path.isfile(p) and os.path.getmtime(p) >= mtime for p in paths):
+        headers = np.load(paths[0])
+        pulses = np.load(paths[1], mmap_mode='r' if mmap else None)
+    else:
+        headers, pulses = parse_pulses(path, n_channels)
+        for p, values in zip(paths, [headers, pulses]):
+            with open(p + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(p + '.tmp', p)
+    return headers[:, 0].astype(np.int64), headers, pulses
+
+def pulse_features(pulses, threshold=0.5, n_baseline=100, polarity=-1, window=None, dt=DT):
+    """Amplitude, time at threshold and charge of all pulses at once
+
+    The baseline is the mean of the first `n_baseline` samples and the signal is
+    `polarity * (pulse - baseline)`. The threshold is a fraction of the amplitude if < 1 and in mV
+    otherwise, and its crossing time is interpolated linearly between samples (NaN if not crossed).
+    The charge is the signal integral [mV*ns] within the (first, last) sample `window`.
+    Returns a dict of arrays with the shape of `pulses` without the last axis.
+    """
+    pulses = np.asarray(pulses, dtype=np.float32)
+    baseline = pulses[..., :n_baseline].mean(axis=-1)
+    signal = polarity * (pulses - baseline[..., None])
+    amplitude = signal.max(axis=-1)
+    thr = threshold * amplitude if threshold < 1 else np.full(amplitude.shape, threshold, dtype=np.float32)
+    # First sample above the threshold
+    above = signal >= thr[..., None]
+    crossed = above.any(axis=-1) & (amplitude > 0)
+    idx = np.argmax(above, axis=-1)
+    idx_prev = np.maximum(idx - 1, 0)
+    v1 = np.take_along_axis(signal, idx[..., None], axis=-1)[..., 0]
+    v0 = np.take_along_axis(signal, idx_prev[..., None], axis=-1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where((idx > 0) & (v1 > v0), (thr - v0) / (v1 - v0), 0.0)
+    time = np.where(crossed, (idx_prev + frac) * dt, np.nan)
+    first, last = window if window is not None else (0, pulses.shape[-1])
+    charge = signal[..., first:last].sum(axis=-1) * dt
+    return {
+        'baseline': baseline,
+        'amplitude': amplitude,
+        'time': time,
+        'charge': charge,
+    }
+
+
+if __name__ == '__main__':
+    import sys
+    for path in sys.argv[1:]:
+        print('{0:s}: {1:d} events parsed identically'.format(path, check_parser(path)))
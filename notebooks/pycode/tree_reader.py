@@ -0,0 +1,120 @@
+import numpy as np
+import ROOT as R
+
+# Speed of light [mm/ns]
+CONST_C = 299.792458
+
+
+def add_hit_columns(columns, x, y, z, t=None, prefix=''):
+    """Adds radius, theta, phi and time - t0 of the hit positions to the columns"""
+    pos_x, pos_y, pos_z = columns[x], columns[y], columns[z]
+    pos_r = np.hypot(pos_x, pos_y)
+    columns[prefix + 'r'] = pos_r
+    columns[prefix + 'theta'] = np.arctan2(pos_r, pos_z)
+    columns[prefix + 'phi'] = np.arctan2(pos_y, pos_x)
+    if t is not None:
+        columns[prefix + 'tmt0'] = columns[t] - np.hypot(pos_r, pos_z) / CONST_C
+    return columns
+
+def flatten_columns(columns):
+    """Converts per-entry vectors into flat arrays with one row per element
+
+    Scalar columns are repeated for every element of the entry and `entry` holds the entry number.
+    All vector columns must have the same length in each entry.
+    """
+    names_vec = [name for name, values in columns.items() if len(values) and not np.isscalar(values[0])]
+    if not names_vec:
+        return columns
+    lengths = np.array([len(v) for v in columns[names_vec[0]]], dtype=np.int64)
+    flat = {}
+    for name, values in columns.items():
+        if name in names_vec:
+            if len(values) and any(len(v) != l for v, l in zip(values, lengths)):
+                raise ValueError('Column {0:s} has a different length than {1:s}'.format(name, names_vec[0]))
+            flat[name] = np.concatenate([np.asarray(v) for v in values]) if len(values) else np.zeros(0)
+        else:
+            flat[name] = np.repeat(np.asarray(values), lengths)
+    return flat
+
+def tree_source(tree):
+    """Name of the tree within its files and the list of file names, or None for in-memory trees"""
+    if isinstance(tree, R.TChain):
+        return tree.GetName(), [el.GetTitle() for el in tree.GetListOfFiles()]
+    directory = tree.GetDirectory()
+    if not directory or not directory.GetFile():
+        return None
+    path = directory.GetPath().split(':/', 1)[-1]
+    return '/'.join(filter(None, [path, tree.GetName()])), [directory.GetFile().GetName()]
+
+def chunk_frame(tree, begin, end):
+    """New RDataFrame reading only the entries [begin, end) of the tree
+
+    Each chunk gets its own computation graph: newer ROOT versions restrict the dataset to the
+    entry range, also with implicit multithreading, older ones apply `Range()` to the new head node.
+    """
+    source = tree_source(tree)
+    spec_ns = getattr(getattr(R.RDF, 'Experimental', None), 'RDatasetSpec', None)
+    if spec_ns is not None and source is not None:
+        spec = spec_ns()
+        spec.AddSample(R.RDF.Experimental.RSample('chunk', source[0], source[1]))
+        spec.WithGlobalRange(spec_ns.REntryRange(begin, end))
+        return R.RDataFrame(spec)
+    if R.ROOT.IsImplicitMTEnabled():
+        raise RuntimeError('Reading entry ranges requires ROOT.DisableImplicitMT() with this ROOT version')
+    return R.RDataFrame(tree).Range(begin, end)
+
+def iter_tree(tree, branches, defines=None, filter=None, position=None, time=None, prefix='',
+              selection=None, chunk_entries=10000, start=0, stop=None, as_frame=True):
+    """Reads the tree in chunks of entries yielding flat columns of the selected rows
+
+    Only `branches` and the `defines` columns (name: C++ expression) are read.
+    `filter` is a C++ expression selecting whole entries before any column is read, while
+    `selection(columns)` returns a mask of flat rows, applied after adding the hit columns of
+    `position` (x, y, z branches) and `time`, but before creating the DataFrame.
+    Entries are never split between chunks, so per-entry groups are complete within a chunk.
+    """
+    nEntries = tree.GetEntries()
+    stop = nEntries if stop is None else min(stop, nEntries)
+    names = list(branches) + list(defines or {}) + ['entry']
+    for begin in range(start, stop, chunk_entries):
+        df = chunk_frame(tree, begin, min(begin + chunk_entries, stop))
+        for name, expr in (defines or {}).items():
+            df = df.Define(name, expr)
+        df = df.Define('entry', 'rdfentry_')
+        if filter:
+            df = df.Filter(filter)
+        columns = flatten_columns(dict(df.AsNumpy(names)))
+        if position is not None:
+            add_hit_columns(columns, *position, t=time, prefix=prefix)
+        if selection is not None:
+            mask = selection(columns)
+            columns = {name: values[mask] for name, values in columns.items()}
+        if as_frame:
+            import pandas as pd
+            yield pd.DataFrame(columns)
+        else:
+            yield columns
+
+def read_tree(tree, branches, **kwargs):
+    """Reads the selected rows of the whole tree into a single DataFrame"""
+    import pandas as pd
+    return pd.concat(iter_tree(tree, branches, **kwargs), ignore_index=True)
+
+def reduce_tree(tree, branches, func, combine=None, **kwargs):
+    """Applies `func` to every chunk and combines the results
+
+    By default pandas results are added aligned by index, which computes groupby counts or sums
+    of trees larger than the available memory.
+    """
+    result = None
+    for chunk in iter_tree(tree, branches, **kwargs):
+        value = func(chunk)
+        if result is None:
+            result = value
+        elif combine is not None:
+            result = combine(result, value)
+        elif hasattr(result, 'add'):
+            result = result.add(value, fill_value=0)
+        else:
+            result = result + value
+    return result
@@ -1,17 +1,31 @@
 import ROOT as R
+import os
+import re
 import copy
+from collections import OrderedDict
 
-def draw(histos, config, out_file=None):
-    C = R.TCanvas("canvas", "", config['canvas'][0], config['canvas'][1])
+def draw(histos, config, out_file=None, canvas=None):
+    if canvas is None:
+        C = R.TCanvas("canvas", "", config['canvas'][0], config['canvas'][1])
+        R.SetOwnership(C, False)
+    else:
+        # Reusing the canvas, which deletes the objects of the previous plot
+        C = canvas
+        C.Clear()
+        C.SetCanvasSize(config['canvas'][0], config['canvas'][1])
+        C.SetLogy(0)
+        C.SetLogx(0)
+        C.cd()
     C.SetRightMargin(0.05)
     C.SetGridx()
     C.SetGridy()
-    R.SetOwnership(C, False)
     n = len(histos)
     leg = None
     if 'leg' in config:
         leg = R.TLegend(0.75,0.9-n*0.06, 0.95,0.9)
         R.SetOwnership(leg, 0)
+        if canvas is not None:
+            leg.SetBit(R.TObject.kCanDelete)
     h_axis = None
     if 'h_axis' in config:
         h_axis = config['h_axis']
@@ -32,6 +46,8 @@ def draw(histos, config, out_file=None):
         if 'norm' in config:
             h.Scale(config['norm'] / h.GetEntries())
         R.SetOwnership(h, 0)
+        if canvas is not None:
+            h.SetBit(R.TObject.kCanDelete)
         h.SetLineWidth(2)
         if 'style' in config:
             h.SetLineStyle(config['style'][iH])
@@ -57,44 +73,193 @@ def draw(histos, config, out_file=None):
         C.Print(out_file)
 
 
-def read_root_obj(file_path, obj_path, path_delimiter='/', file_delimiter=':'):
-    """Finds an object inside a file supporting ROOT file inputs"""
+# Canvas reused for all plots rendered by a worker process
+WORKER_CANVAS = None
 
-    if isinstance(file_path, str):
-        # Stopping if input file doesn't exist
-        if not os.path.isfile(file_path):
-            return None
-        # Opening the ROOT file
-        file_in = R.TFile(file_path)
-    else:
-        # Using the already opened ROOT file
-        file_in = file_path
-
-    obj = None
-
-    path_sequence = obj_path.split(path_delimiter)
-    # Trying every element of the sequence
-    for i_el, path_el in enumerate(path_sequence):
-        # Getting the object from current directory when it's the last element
-        if i_el == len(path_sequence) - 1:
-            if path_el.startswith('*'):
-                obj = R.gDirectory.FindObjectAny(path_el)
-            else:
-                obj = R.gDirectory.Get(path_el)
-            break
+def init_draw_worker(style=None):
+    """Sets up batch mode, the style and the canvas once per worker process"""
+    global WORKER_CANVAS
+    R.gROOT.SetBatch(True)
+    if style is not None:
+        style()
+    WORKER_CANVAS = R.TCanvas("canvas", "", 800, 600)
+
+def resolve_histos(histos):
+    """Reads histograms given by reference as (file path, object path)"""
+    resolved = []
+    for h in histos:
+        if isinstance(h, tuple):
+            h = read_root_objs(h[0], [h[1]])[0]
+        resolved.append(h)
+    return resolved
+
+def draw_job(job):
+    """Renders one (histograms, config, output path) job on the worker canvas"""
+    histos, config, out_file = job
+    config = dict(config)
+    if isinstance(config.get('h_axis'), tuple):
+        config['h_axis'] = resolve_histos([config['h_axis']])[0]
+    draw(resolve_histos(histos), config, out_file, WORKER_CANVAS)
+    return out_file
+
+def draw_batch(jobs, n_workers=None, style=None, chunksize=4):
+    """Renders many (histograms, config, output path) jobs in parallel batch-mode processes
+
+    Histograms can be ROOT objects, which are pickled to the workers, or references
+    (file path, object path) read by the workers themselves through the file pool.
+    `style` is a picklable function called once in every worker, e.g. to set `gStyle` options.
+    Returns the output paths in the order of the jobs.
+    """
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(n_workers, initializer=init_draw_worker, initargs=(style,)) as pool:
+        return pool.map(draw_job, jobs, chunksize)
+
+
+class RootFilePool(object):
+    """Open ROOT files with an index of their directories, evicting the least recently used"""
+
+    def __init__(self, max_files=16):
+        self.max_files = max_files
+        self.files = OrderedDict()
+
+    def get(self, file_path):
+        """Returns the open file, its modification time and directory index"""
+        file_path = os.path.abspath(file_path)
+        mtime = os.path.getmtime(file_path)
+        entry = self.files.get(file_path)
+        if entry is not None and entry[1] != mtime:
+            # Reopening a file that was modified since it was indexed
+            self.close(file_path)
+            entry = None
+        if entry is None:
+            with R.TDirectory.TContext():
+                file_in = R.TFile(file_path)
+            entry = (file_in, mtime, index_keys(file_in))
+            self.files[file_path] = entry
+            while len(self.files) > self.max_files:
+                self.close(next(iter(self.files)))
+        self.files.move_to_end(file_path)
+        return entry
+
+    def close(self, file_path=None):
+        """Closes one file or all of them"""
+        paths = list(self.files) if file_path is None else [file_path]
+        for path in paths:
+            file_in = self.files.pop(path)[0]
+            file_in.Close()
+
+
+class RootObjCache(object):
+    """Copies of objects read from files, keyed by (path, object path, mtime)"""
+
+    def __init__(self, max_objects=1024):
+        self.max_objects = max_objects
+        self.objects = OrderedDict()
+
+    def get(self, key):
+        obj = self.objects.get(key)
+        if obj is not None:
+            self.objects.move_to_end(key)
+        return obj
+
+    def add(self, key, obj):
+        self.objects[key] = obj
+        while len(self.objects) > self.max_objects:
+            self.objects.popitem(last=False)
+
+    def clear(self):
+        self.objects.clear()
+
+
+FILE_POOL = RootFilePool()
+OBJ_CACHE = RootObjCache()
+
+
+def index_keys(directory, path=''):
+    """Maps the path of every subdirectory to the names of its keys and subdirectories"""
+    index = {path: ([], [])}
+    for key in directory.GetListOfKeys():
+        name = key.GetName()
+        # Trees and canvases are folders too, but have no keys to index
+        if R.TClass.GetClass(key.GetClassName()).InheritsFrom('TDirectory'):
+            index[path][1].append(name)
+            index.update(index_keys(directory.Get(name), path + '/' + name if path else name))
+        else:
+            index[path][0].append(name)
+    return index
+
+def find_root_obj(file_in, index, path_sequence):
+    """Gets the object from the file using the directory index to resolve wildcard names"""
+    dir_path = ''
+    for path_el in path_sequence[:-1]:
         # Entering directly into the directory if full name is provided
         if '*' not in path_el:
-            R.gDirectory.Get(path_el).cd()
+            dir_name = path_el
         else:
-            dir_list = R.gDirectory.GetListOfKeys()
-            for key in dir_list:
-                dir_name = key.GetName()
-                if not re.match(path_el, dir_name):
-                    continue
-                R.gDirectory.Get(dir_name).cd()
+            # Using the last matching directory
+            names = [name for name in index.get(dir_path, ([], []))[1] if re.match(path_el, name)]
+            if not names:
+                return None
+            dir_name = names[-1]
+        dir_path = dir_path + '/' + dir_name if dir_path else dir_name
+    directory = file_in.GetDirectory(dir_path) if dir_path else file_in
+    if not directory:
+        return None
+    path_el = path_sequence[-1]
+    if path_el.startswith('*'):
+        return directory.FindObjectAny(path_el)
+    return directory.Get(path_el)
+
+def copy_root_obj(obj):
+    """Copies the object into memory detaching histograms from their file"""
+    if not obj:
+        return None
+    with R.TDirectory.TContext():
+        obj = copy.deepcopy(obj)
+    if isinstance(obj, R.TH1):
+        obj.SetDirectory(R.nullptr)
+    return obj
+
+def read_root_objs(file_path, obj_paths, path_delimiter='/', use_cache=True):
+    """Reads many objects from one file, returning a list in the order of `obj_paths`
+
+    The file is kept open in a pool and objects are cached in memory until the file changes.
+    """
+
+    # Stopping if input file doesn't exist
+    if not os.path.isfile(file_path):
+        return [None] * len(obj_paths)
+    file_in, mtime, index = FILE_POOL.get(file_path)
+    objs = []
+    for obj_path in obj_paths:
+        key = (os.path.abspath(file_path), obj_path, mtime)
+        obj = OBJ_CACHE.get(key) if use_cache else None
+        if obj is None:
+            obj = copy_root_obj(find_root_obj(file_in, index, obj_path.split(path_delimiter)))
+            if obj is not None and use_cache:
+                OBJ_CACHE.add(key, obj)
+        # Returning a copy so that modifications don't affect the cached object
+        objs.append(copy_root_obj(obj) if use_cache else obj)
+    return objs
+
+def close_root_files():
+    """Closes all pooled files and empties the object cache"""
+    FILE_POOL.close()
+    OBJ_CACHE.clear()
+
+def read_root_obj(file_path, obj_path, path_delimiter='/', file_delimiter=':'):
+    """Finds an object inside a file supporting ROOT file inputs"""
+
+    if isinstance(file_path, str):
+        return read_root_objs(file_path, [obj_path], path_delimiter)[0]
+
+    # Using the already opened ROOT file
+    file_in = file_path
+    obj = find_root_obj(file_in, index_keys(file_in), obj_path.split(path_delimiter))
 
     # Copying the object into memory and closing the file
-    obj = copy.deepcopy(obj)
+    obj = copy_root_obj(obj)
     file_in.Close()
 
     return obj
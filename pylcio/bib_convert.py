@@ -0,0 +1,131 @@
+import os
+import sys
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Reusing the particle-list reader of the notebooks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+from pycode.fluka_bib import iter_bib
+
+parser = argparse.ArgumentParser(description='Convert FLUKA BIB particle lists to LCIO MCParticle events')
+parser.add_argument('input', metavar='summary_DET_IP.dat', type=str, help='List of input particle lists', nargs='+')
+parser.add_argument('-o', dest='output', metavar='OUT.slcio', type=str, help='Output path, numbered as OUT_0000.slcio', required=True)
+parser.add_argument('-n', '--particles_per_event', metavar='N', type=int, help='Number of particles per event', default=10000)
+parser.add_argument('-e', '--events_per_file', metavar='N', type=int, help='Number of events per output file', default=1)
+parser.add_argument('-j', '--jobs', metavar='N', type=int, help='Number of files written in parallel', default=4)
+parser.add_argument('--chunk_size', metavar='N', type=int, help='Number of records read at a time', default=1000000)
+parser.add_argument('--pdgs', metavar='ID', type=int, help='Keep only particles with these |PDG| IDs', nargs='+', default=None)
+parser.add_argument('--p_min', metavar='P', type=float, help='Minimum momentum [GeV]', default=None)
+parser.add_argument('--weight_scale', metavar='F', type=float, help='Factor applied to the particle weights before replication', default=1.0)
+parser.add_argument('--no_weights', action='store_true', help='Write every selected particle once ignoring its weight')
+parser.add_argument('--mirror', choices=['none', 'add', 'flip'], help='Add or use instead the particles mirrored to the other beam', default='none')
+parser.add_argument('--length_unit', metavar='MM', type=float, help='Input length unit in mm', default=10.0)
+parser.add_argument('--time_unit', metavar='NS', type=float, help='Input time unit in ns', default=1.0)
+parser.add_argument('--seed', metavar='N', type=int, help='Seed of the weight-based sampling', default=0)
+
+FIELDS = ['pdgId', 'x', 'y', 'z', 'px', 'py', 'pz', 't']
+# Particles whose charge-conjugate comes from the other beam
+MIRROR_CONJUGATE_PDGS = [11, 13]
+
+
+def replicate(records, weights, rng, scale=1.0):
+    """Repeats each record floor(w) times plus once more with the probability of the remainder"""
+    w = weights * scale
+    counts = np.floor(w).astype(np.int64)
+    counts += rng.random(len(w)) < (w - counts)
+    return np.repeat(records, counts)
+
+def mirror(records):
+    """Mirrors the particles to the opposite beam: x -> -x, z -> -z with charge-conjugated leptons"""
+    mirrored = records.copy()
+    for name in ['x', 'z', 'px', 'pz']:
+        mirrored[name] *= -1
+    conjugate = np.isin(np.abs(mirrored['pdgId']), MIRROR_CONJUGATE_PDGS)
+    mirrored['pdgId'][conjugate] *= -1
+    return mirrored
+
+def write_file(path, particles, n_per_event, run_number, length_unit, time_unit):
+    """Writes the particles into an LCIO file as events of `n_per_event` MCParticles"""
+    import ROOT as R
+    from pyLCIO import EVENT, IMPL, IOIMPL
+    pdg_db = R.TDatabasePDG.Instance()
+    pdg_props = {}
+    writer = IOIMPL.LCFactory.getInstance().createLCWriter()
+    writer.open(path, EVENT.LCIO.WRITE_NEW)
+    run = IMPL.LCRunHeaderImpl()
+    run.setRunNumber(run_number)
+    writer.writeRunHeader(run)
+    for iE, start in enumerate(range(0, len(particles), n_per_event)):
+        evt = IMPL.LCEventImpl()
+        evt.setRunNumber(run_number)
+        evt.setEventNumber(iE)
+        col = IMPL.LCCollectionVec(EVENT.LCIO.MCPARTICLE)
+        for p in particles[start:start + n_per_event]:
+            pdg = int(p['pdgId'])
+            if pdg not in pdg_props:
+                particle = pdg_db.GetParticle(pdg)
+                pdg_props[pdg] = (particle.Mass(), particle.Charge() / 3.0) if particle else (0.0, 0.0)
+            mcp = IMPL.MCParticleImpl()
+            mcp.setPDG(pdg)
+            mcp.setGeneratorStatus(1)
+            mcp.setMass(pdg_props[pdg][0])
+            mcp.setCharge(pdg_props[pdg][1])
+            mcp.setVertex(np.array([p['x'], p['y'], p['z']], dtype=np.float64) * length_unit)
+            mcp.setMomentum(np.array([p['px'], p['py'], p['pz']], dtype=np.float64))
+            mcp.setTime(float(p['t']) * time_unit)
+            col.addElement(mcp)
+        evt.addCollection(col, EVENT.LCIO.MCPARTICLE)
+        writer.writeEvent(evt)
+    writer.close()
+    return path, len(particles)
+
+def convert(opts):
+    """Streams the input lists and submits files with a fixed number of particles to the process pool"""
+    n_per_file = opts.particles_per_event * opts.events_per_file
+    ranges = {'p': (opts.p_min, None)} if opts.p_min is not None else None
+    rng = np.random.default_rng(opts.seed)
+    base, ext = os.path.splitext(opts.output)
+    buffer = []
+    n_buffer = 0
+    iFile = 0
+    pending = []
+    with ProcessPoolExecutor(opts.jobs) as pool:
+        def submit(particles):
+            nonlocal iFile
+            path = '{0:s}_{1:04d}{2:s}'.format(base, iFile, ext or '.slcio')
+            pending.append(pool.submit(write_file, path, particles, opts.particles_per_event, iFile,
+                                       opts.length_unit, opts.time_unit))
+            iFile += 1
+            # Limiting the number of particle sets held in memory
+            while len(pending) > 2 * opts.jobs:
+                print('  written: {0:s} with {1:d} particles'.format(*pending.pop(0).result()))
+        for path_in in opts.input:
+            print('  reading: {0:s}'.format(path_in))
+            for records, weights in iter_bib(path_in, 'new', opts.chunk_size, opts.pdgs, ranges, True, FIELDS):
+                if not opts.no_weights:
+                    records = replicate(records, weights, rng, opts.weight_scale)
+                if opts.mirror == 'flip':
+                    records = mirror(records)
+                elif opts.mirror == 'add':
+                    records = np.concatenate([records, mirror(records)])
+                buffer.append(records)
+                n_buffer += len(records)
+                # Submitting complete files
+                while n_buffer >= n_per_file:
+                    records = np.concatenate(buffer)
+                    submit(records[:n_per_file])
+                    buffer = [records[n_per_file:]]
+                    n_buffer = len(buffer[0])
+        if n_buffer > 0:
+            submit(np.concatenate(buffer))
+        for future in pending:
+            print('  written: {0:s} with {1:d} particles'.format(*future.result()))
+    return iFile
+
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    print('### Converting {0:d} input files'.format(len(opts.input)))
+    nFiles = convert(opts)
+    print('### Finished: {0:d} output files'.format(nFiles))
@@ -0,0 +1,186 @@
+import os
+import json
+import zlib
+import shutil
+import argparse
+import numpy as np
+
+POOL_FILE = 'pool.json'
+# Columns stored for each hit type
+FIELDS = {
+    'sim': ['cellid', 'x', 'y', 'z', 'time', 'edep', 'mcp_pdg', 'px', 'py', 'pz'],
+    'reco': ['cellid', 'x', 'y', 'z', 'time', 'edep'],
+}
+# Time between bunch crossings of the 3 TeV collider with a 4.5 km ring [ns]
+BX_SPACING = 15000.0
+
+
+def build_pool(inputs, path, collections, max_events=None):
+    """Writes the columnar hits of BIB-only events into a pool of raw arrays per collection
+
+    Each collection gets a folder with one `.bin` file per column and the event boundaries
+    in `offsets.npy`, so that the hits of any pool event can be memory-mapped without reading the rest.
+    The pool is written to a temporary folder that replaces `path` only when complete.
+    """
+    from pyLCIO import IOIMPL, EVENT
+    from drivers.utils import read_sim_trk_hits, read_trk_hits
+    readers = {
+        EVENT.LCIO.SIMTRACKERHIT: ('sim', read_sim_trk_hits),
+        EVENT.LCIO.TRACKERHIT: ('reco', read_trk_hits),
+        EVENT.LCIO.TRACKERHITPLANE: ('reco', read_trk_hits),
+    }
+    path_tmp = path + '.tmp'
+    if os.path.isdir(path_tmp):
+        shutil.rmtree(path_tmp)
+    info = {'inputs': [os.path.abspath(p) for p in inputs], 'n_events': 0, 'collections': {}}
+    files = {}
+    offsets = {name: [0] for name in collections}
+    reader = IOIMPL.LCFactory.getInstance().createLCReader()
+    for input_path in inputs:
+        print('  reading: {0:s}'.format(input_path))
+        reader.open(input_path)
+        event = reader.readNextEvent()
+        while event and (max_events is None or info['n_events'] < max_events):
+            names = list(event.getCollectionNames())
+            for name in collections:
+                if name not in names:
+                    # Collections absent in the event count as empty
+                    offsets[name].append(offsets[name][-1])
+                    continue
+                col = event.getCollection(name)
+                if name not in info['collections']:
+                    if col.getTypeName() not in readers:
+                        raise ValueError('Collection {0:s} of type {1:s} cannot be pooled'.format(name, col.getTypeName()))
+                    kind, _ = readers[col.getTypeName()]
+                    info['collections'][name] = {
+                        'type': col.getTypeName(),
+                        'encoding': col.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding),
+                        'fields': {},
+                    }
+                    os.makedirs(os.path.join(path_tmp, name))
+                    files[name] = {field: open(os.path.join(path_tmp, name, field + '.bin'), 'wb') for field in FIELDS[kind]}
+                kind, read = readers[info['collections'][name]['type']]
+                hits = read(col)
+                for field, f in files[name].items():
+                    info['collections'][name]['fields'][field] = hits[field].dtype.str
+                    f.write(hits[field].tobytes())
+                offsets[name].append(offsets[name][-1] + len(hits['cellid']))
+            info['n_events'] += 1
+            event = reader.readNextEvent()
+        reader.close()
+    for name in collections:
+        if name not in info['collections']:
+            raise ValueError('Collection {0:s} not found in the input files'.format(name))
+        for f in files[name].values():
+            f.close()
+        info['collections'][name]['n_hits'] = offsets[name][-1]
+        np.save(os.path.join(path_tmp, name, 'offsets.npy'), np.array(offsets[name], dtype=np.int64))
+    with open(os.path.join(path_tmp, POOL_FILE), 'w') as f:
+        json.dump(info, f, indent=1)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(path_tmp, path)
+    return info
+
+
+class BibPool(object):
+    """Memory-mapped pool of BIB hits overlaid onto signal events
+
+    For each signal event and each bunch crossing in `bunch_crossings`, `ceil(fraction)` pool events
+    are drawn and each of their hits is kept with the probability `fraction / ceil(fraction)`.
+    Times of the hits are shifted by the bunch-crossing index times `bx_spacing`.
+    Random numbers are seeded by the run and event numbers of the signal event, so that the
+    same BIB is overlaid independently of how the input is split between jobs, and the same
+    pool events are used for all collections of one bunch crossing.
+    """
+
+    def __init__(self, path, fraction=1.0, bunch_crossings=(0,), bx_spacing=BX_SPACING, seed=0):
+        """Constructor"""
+        self.path = path
+        self.fraction = fraction
+        self.bunch_crossings = list(bunch_crossings)
+        self.bx_spacing = bx_spacing
+        self.seed = seed
+        with open(os.path.join(path, POOL_FILE)) as f:
+            self.info = json.load(f)
+        self.n_events = self.info['n_events']
+        if self.n_events < 1:
+            raise ValueError('BIB pool in {0:s} has no events'.format(path))
+        self.arrays = {}
+        self.event_key = None
+        self.pool_events = None
+
+    def encoding(self, col_name):
+        """CellID encoding string of the pooled collection"""
+        return self.info['collections'][col_name]['encoding']
+
+    def columns(self, col_name):
+        """Memory-mapped columns and event offsets of the collection, opened on first use"""
+        if col_name not in self.arrays:
+            info = self.info['collections'][col_name]
+            col_path = os.path.join(self.path, col_name)
+            columns = {}
+            for field, dtype in info['fields'].items():
+                if info['n_hits'] > 0:
+                    columns[field] = np.memmap(os.path.join(col_path, field + '.bin'), dtype=np.dtype(dtype), mode='r')
+                else:
+                    columns[field] = np.zeros(0, dtype=np.dtype(dtype))
+            offsets = np.load(os.path.join(col_path, 'offsets.npy'))
+            self.arrays[col_name] = (columns, offsets)
+        return self.arrays[col_name]
+
+    def rng(self, event, *keys):
+        """Random generator specific to the signal event and optional string keys"""
+        seq = [self.seed, event.getRunNumber(), event.getEventNumber()]
+        seq += [zlib.crc32(key.encode()) for key in keys]
+        return np.random.default_rng(seq)
+
+    def set_event(self, event):
+        """Draws the pool events overlaid onto the signal event for each bunch crossing"""
+        key = (event.getRunNumber(), event.getEventNumber())
+        if key == self.event_key:
+            return
+        self.event_key = key
+        n_draw = int(np.ceil(self.fraction))
+        rng = self.rng(event)
+        self.pool_events = []
+        for bx in self.bunch_crossings:
+            replace = n_draw > self.n_events
+            self.pool_events.append((bx, rng.choice(self.n_events, n_draw, replace=replace)))
+
+    def hits(self, event, col_name):
+        """Columnar BIB hits of the collection overlaid onto the event, with a `bx` column"""
+        self.set_event(event)
+        columns, offsets = self.columns(col_name)
+        rng = self.rng(event, col_name)
+        p_keep = self.fraction / max(1, int(np.ceil(self.fraction)))
+        parts = {field: [] for field in columns}
+        parts['bx'] = []
+        for bx, pool_events in self.pool_events:
+            for iE in pool_events:
+                start, end = offsets[iE], offsets[iE+1]
+                # Contiguous slice of the memory-mapped columns
+                keep = np.flatnonzero(rng.random(end - start) < p_keep) + start
+                for field, values in columns.items():
+                    parts[field].append(values[keep])
+                parts['time'][-1] = parts['time'][-1] + np.float32(bx * self.bx_spacing)
+                parts['bx'].append(np.full(len(keep), bx, dtype=np.int32))
+        hits = {}
+        for field, values in parts.items():
+            dtype = columns[field].dtype if field in columns else np.int32
+            hits[field] = np.concatenate(values) if values else np.zeros(0, dtype=dtype)
+        hits['weight'] = np.ones(len(hits['cellid']), dtype=np.float64)
+        return hits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a memory-mapped pool of BIB hits from BIB-only LCIO files')
+    parser.add_argument('input', metavar='bib.slcio', type=str, help='List of input files with BIB-only events', nargs='+')
+    parser.add_argument('-o', dest='output', metavar='POOL', type=str, help='Output folder of the pool', required=True)
+    parser.add_argument('-c', '--collections', metavar='NAME', type=str, help='Tracker hit collections to store', nargs='+', required=True)
+    parser.add_argument('-m', '--max_events', metavar='N', type=int, help='Maximum number of events to store', default=None)
+    opts = parser.parse_args()
+    info = build_pool(opts.input, opts.output, opts.collections, opts.max_events)
+    print('### Finished: {0:d} events in {1:s}'.format(info['n_events'], opts.output))
+    for name, col in info['collections'].items():
+        print('  {0:s}: {1:d} hits'.format(name, col['n_hits']))
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import pickle
+import shutil
+
+import ROOT as R
+from pyLCIO.drivers.Driver import Driver
+
+from drivers.utils import collect_histos
+
+INFO_FILE = 'checkpoint.json'
+# Exit code of a job stopped after a checkpoint to be continued by a new process
+RECYCLE_EXIT_CODE = 75
+
+
+class StopForRecycle(Exception):
+    """Raised after saving the checkpoint to stop the event loop without writing the output"""
+
+
+def checkpoint_dir(output_path):
+    """Directory holding the checkpoints of the job writing to `output_path`"""
+    return output_path + '.ckpt'
+
+def load_checkpoint(path):
+    """Returns the description of the last complete checkpoint or None"""
+    info_path = os.path.join(path, INFO_FILE)
+    if not os.path.isfile(info_path):
+        return None
+    with open(info_path) as f:
+        return json.load(f)
+
+def write_atomic(path, write):
+    """Writes a file through a temporary one that replaces the target only when complete"""
+    path_tmp = path + '.tmp'
+    write(path_tmp)
+    os.replace(path_tmp, path)
+
+
+class CheckpointDriver( Driver ):
+    """Driver saving the state of another driver every N events or T minutes
+
+    Must be added to the event loop after the driver it checkpoints.
+    A checkpoint consists of a snapshot of all histograms, the TTree entries added since
+    the previous checkpoint, the optional `getState()` of the driver and the input position.
+    The checkpoint becomes valid only when its JSON description is replaced at the end.
+    """
+
+    def __init__( self, driver, path, job, every_events=None, every_minutes=None, resume=None, stop_after=None):
+        """Constructor
+
+        With `stop_after` the loop is stopped by `StopForRecycle` after saving a checkpoint
+        once this process has handled that many events or `request_stop()` was called.
+        """
+        Driver.__init__(self)
+        self.driver = driver
+        self.path = path
+        self.job = job
+        self.every_events = every_events
+        self.every_seconds = every_minutes * 60 if every_minutes else None
+        self.resume = resume
+        self.stop_after = stop_after
+        self.stop_requested = False
+        self.nProcessedHere = 0
+        self.nProcessed = 0
+        self.segments = []
+        self.nEntries = 0
+        self.time_last = time.time()
+
+    def startOfData( self ):
+        """Called by the event loop at the beginning of the loop"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if getattr(self.driver, 'out_lcio', None) is not None and not self.stop_after:
+            print('### WARNING: LCIO events written after the last checkpoint are repeated when resuming')
+        if self.resume:
+            self.restore(self.resume)
+
+    def restore( self, info ):
+        """Loads the state of the driver from the checkpoint"""
+        print('### Restoring checkpoint after {0:d} processed events'.format(info['processed']))
+        self.nProcessed = info['processed']
+        self.segments = info['segments']
+        with R.TDirectory.TContext():
+            ckpt_file = R.TFile(os.path.join(self.path, info['histos']))
+            for histo in collect_histos(getattr(self.driver, 'histos', {})):
+                histo_ckpt = ckpt_file.Get(histo.GetName())
+                if histo_ckpt:
+                    histo.Add(histo_ckpt)
+            ckpt_file.Close()
+        # Copying the stored TTree entries into the new TTree
+        tree = getattr(self.driver, 'tree', None)
+        if tree is not None:
+            for segment in self.segments:
+                with R.TDirectory.TContext():
+                    seg_file = R.TFile(os.path.join(self.path, segment))
+                    tree.CopyEntries(seg_file.Get('tree'), -1, '', True)
+                    seg_file.Close()
+            self.nEntries = tree.GetEntries()
+        if info['state'] is not None and hasattr(self.driver, 'setState'):
+            with open(os.path.join(self.path, info['state']), 'rb') as f:
+                self.driver.setState(pickle.load(f))
+
+    def save( self ):
+        """Writes a new checkpoint of the driver"""
+        driver = self.driver
+        tag = '{0:09d}'.format(self.nProcessed)
+        # Waiting for the background writer to fill all pending entries
+        if getattr(driver, 'writer', None) is not None:
+            driver.writer.flush()
+        # Making the LCIO output complete up to the checkpoint, to be appended to after a restart
+        if getattr(driver, 'out_lcio', None) is not None:
+            driver.out_lcio.flush()
+        # Storing histograms
+        name_histos = 'histos_{0:s}.root'.format(tag)
+        def write_histos(path):
+            with R.TDirectory.TContext():
+                out_file = R.TFile(path, 'RECREATE')
+                for histo in collect_histos(getattr(driver, 'histos', {})):
+                    histo.Write(histo.GetName())
+                out_file.Close()
+        write_atomic(os.path.join(self.path, name_histos), write_histos)
+        # Storing the TTree entries added since the previous checkpoint
+        tree = getattr(driver, 'tree', None)
+        if tree is not None and tree.GetEntries() > self.nEntries:
+            name_seg = 'tree_{0:s}.root'.format(tag)
+            def write_segment(path):
+                with R.TDirectory.TContext():
+                    out_file = R.TFile(path, 'RECREATE')
+                    tree_seg = tree.CopyTree('', '', tree.GetEntries() - self.nEntries, self.nEntries)
+                    tree_seg.Write('tree')
+                    out_file.Close()
+            write_atomic(os.path.join(self.path, name_seg), write_segment)
+            self.segments.append(name_seg)
+            self.nEntries = tree.GetEntries()
+        # Storing the custom state of the driver
+        name_state = None
+        if hasattr(driver, 'getState'):
+            name_state = 'state_{0:s}.pkl'.format(tag)
+            def write_state(path):
+                with open(path, 'wb') as f:
+                    pickle.dump(driver.getState(), f, pickle.HIGHEST_PROTOCOL)
+            write_atomic(os.path.join(self.path, name_state), write_state)
+        # Committing the checkpoint by replacing its description
+        info_prev = load_checkpoint(self.path)
+        info = dict(self.job)
+        info.update({
+            'processed': self.nProcessed,
+            'position': self.job['skip_events'] + self.nProcessed,
+            'histos': name_histos,
+            'state': name_state,
+            'segments': self.segments,
+            'time': time.time(),
+        })
+        def write_info(path):
+            with open(path, 'w') as f:
+                json.dump(info, f, indent=1)
+        write_atomic(os.path.join(self.path, INFO_FILE), write_info)
+        # Removing files of the previous checkpoint that are no longer referenced
+        if info_prev:
+            for name in [info_prev['histos'], info_prev['state']]:
+                if name and name not in [name_histos, name_state]:
+                    os.remove(os.path.join(self.path, name))
+        self.time_last = time.time()
+        print('### Checkpoint saved after {0:d} events'.format(self.nProcessed))
+
+    def request_stop( self ):
+        """Stops the loop with a checkpoint after the current event if stopping is enabled"""
+        if self.stop_after:
+            self.stop_requested = True
+
+    def processEvent( self, event ):
+        """Called by the event loop for each event"""
+        self.nProcessed += 1
+        self.nProcessedHere += 1
+        if self.stop_after and (self.stop_requested or self.nProcessedHere >= self.stop_after):
+            self.save()
+            raise StopForRecycle()
+        if self.every_events and self.nProcessed % self.every_events == 0:
+            self.save()
+        elif self.every_seconds and time.time() - self.time_last > self.every_seconds:
+            self.save()
+
+    def endOfData( self ):
+        """Called by the event loop at the end of the loop"""
+        # Removing checkpoints once the final output is written
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
@@ -0,0 +1,148 @@
+import numpy as np
+
+
+def hit_angles(x, y, z):
+    """Polar and azimuthal angles of the hit positions"""
+    return np.arctan2(np.hypot(x, y), z), np.arctan2(y, x)
+
+def wrap_phi(dphi):
+    """Wraps azimuthal differences into the [-pi, pi) range"""
+    return (dphi + np.pi) % (2*np.pi) - np.pi
+
+
+class DoubleLayerIndex(object):
+    """Index of hits in one sublayer sorted in phi within bins of theta
+
+    Bins are as wide as the theta search window, so that every query only needs to look
+    into 3 neighbouring bins with two binary searches each.
+    Hits close to phi = +-pi are duplicated on the other side to handle the wrap-around.
+    """
+
+    def __init__(self, theta, phi, dtheta_max, dphi_max):
+        """Builds the index from arrays of hit angles"""
+        self.dtheta_max = dtheta_max
+        self.dphi_max = dphi_max
+        theta = np.asarray(theta, dtype=np.float64)
+        phi = np.asarray(phi, dtype=np.float64)
+        idx = np.arange(len(phi))
+        # Duplicating hits near the phi boundary
+        low = phi < -np.pi + dphi_max
+        high = phi > np.pi - dphi_max
+        idx = np.concatenate([idx, idx[low], idx[high]])
+        phi = np.concatenate([phi, phi[low] + 2*np.pi, phi[high] - 2*np.pi])
+        theta = theta[idx]
+        # Sorting hits by a combined key of the theta bin and the phi value
+        keys = self.keys(self.theta_bins(theta), phi)
+        order = np.argsort(keys)
+        self.keys_sorted = keys[order]
+        self.theta = theta[order]
+        self.phi = phi[order]
+        self.idx = idx[order]
+
+    def theta_bins(self, theta):
+        """Theta bin of each value"""
+        return np.floor(theta / self.dtheta_max).astype(np.int64)
+
+    def keys(self, bins, phi):
+        """Combined sorting key of the theta bin and phi"""
+        span = 2*np.pi + 2*self.dphi_max + 1.0
+        return bins * span + (phi + np.pi + self.dphi_max)
+
+    def query(self, theta, phi):
+        """Finds all pairs of query hits and indexed hits within the search window
+
+        Returns indices of the query hits, indices of the indexed hits and their dTheta, dPhi
+        """
+        theta = np.asarray(theta, dtype=np.float64)
+        phi = np.asarray(phi, dtype=np.float64)
+        bins = self.theta_bins(theta)
+        idx_q, pos_p = [], []
+        for dbin in (-1, 0, 1):
+            keys = self.keys(bins + dbin, phi)
+            lo = np.searchsorted(self.keys_sorted, keys - self.dphi_max, side='left')
+            hi = np.searchsorted(self.keys_sorted, keys + self.dphi_max, side='right')
+            counts = hi - lo
+            # Expanding each [lo, hi) range into the list of candidate positions
+            n = counts.sum()
+            starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            idx_q.append(np.repeat(np.arange(len(phi)), counts))
+            pos_p.append(starts + np.arange(n))
+        idx_q = np.concatenate(idx_q)
+        pos_p = np.concatenate(pos_p)
+        dtheta = self.theta[pos_p] - theta[idx_q]
+        dphi = self.phi[pos_p] - phi[idx_q]
+        sel = np.abs(dtheta) <= self.dtheta_max
+        return idx_q[sel], self.idx[pos_p[sel]], dtheta[sel], dphi[sel]
+
+
+def closest_partners(n_query, idx_q, idx_p, dtheta, dphi):
+    """Closest partner in dR = sqrt(dTheta^2 + dPhi^2) for each query hit
+
+    Returns the partner index (-1 if none in the window) and the corresponding dTheta, dPhi, dR
+    """
+    dR = np.hypot(dtheta, dphi)
+    order = np.lexsort((dR, idx_q))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = idx_q[order][1:] != idx_q[order][:-1]
+    best = order[first]
+    partner = np.full(n_query, -1, dtype=np.int64)
+    closest = {name: np.full(n_query, np.inf) for name in ['dtheta', 'dphi', 'dR']}
+    partner[idx_q[best]] = idx_p[best]
+    closest['dtheta'][idx_q[best]] = dtheta[best]
+    closest['dphi'][idx_q[best]] = dphi[best]
+    closest['dR'][idx_q[best]] = dR[best]
+    return partner, closest
+
+def pass_flags(n_query, idx_q, dtheta, dphi, dtheta_cut, dphi_cut):
+    """Flags query hits that have at least one partner within the double-layer cuts"""
+    flags = np.zeros(n_query, dtype=bool)
+    sel = (np.abs(dtheta) < dtheta_cut) & (np.abs(dphi) < dphi_cut)
+    flags[idx_q[sel]] = True
+    return flags
+
+def tightest_cuts(n_query, idx_q, dtheta, dphi, dtheta_cuts, dphi_cuts):
+    """Index of the tightest dPhi cut passed by each query hit for each dTheta cut
+
+    A hit passes the cuts (dTheta < dtheta_cuts[i], dPhi < dphi_cuts[j]) if any of its partners
+    does, which is the case for all j >= the returned index [hit, i].
+    Both lists of cuts must be sorted in ascending order; hits without a partner within a
+    dTheta cut get len(dphi_cuts).
+    """
+    n_theta, n_phi = len(dtheta_cuts), len(dphi_cuts)
+    # First cut passed by each pair
+    iTheta = np.searchsorted(dtheta_cuts, np.abs(dtheta), side='right')
+    iPhi = np.searchsorted(dphi_cuts, np.abs(dphi), side='right')
+    sel = iTheta < n_theta
+    tightest = np.full(n_query * n_theta, n_phi, dtype=np.int64)
+    np.minimum.at(tightest, idx_q[sel] * n_theta + iTheta[sel], iPhi[sel])
+    # Pairs passing a dTheta cut pass all the looser ones as well
+    return np.minimum.accumulate(tightest.reshape(n_query, n_theta), axis=1)
+
+def double_layer_tightest(theta, phi, layers, n_pairs, dtheta_cuts, dphi_cuts):
+    """Output of `tightest_cuts()` for all hits matched against the other sublayer of their double layer
+
+    Layers 2*i and 2*i+1 form the double layer i; hits outside the `n_pairs` double layers pass no cut.
+    """
+    tightest = np.full((len(phi), len(dtheta_cuts)), len(dphi_cuts), dtype=np.int64)
+    pairs = layers // 2
+    for pair in range(n_pairs):
+        sublayers = [np.nonzero((pairs == pair) & (layers % 2 == sub))[0] for sub in (0, 1)]
+        for sub in (0, 1):
+            ids_q, ids_p = sublayers[sub], sublayers[1-sub]
+            index = DoubleLayerIndex(theta[ids_p], phi[ids_p], dtheta_cuts[-1], dphi_cuts[-1])
+            idx_q, _, dtheta, dphi = index.query(theta[ids_q], phi[ids_q])
+            tightest[ids_q] = tightest_cuts(len(ids_q), idx_q, dtheta, dphi, dtheta_cuts, dphi_cuts)
+    return tightest
+
+def scan_grid(tightest, n_phi, groups, n_groups, weights):
+    """Number and weight sum of hits passing each (dTheta, dPhi) cut combination for each group
+
+    Returns two arrays of shape (n_groups, n_theta, n_phi) from the output of `tightest_cuts()`
+    """
+    n_hits, n_theta = tightest.shape
+    counts = np.zeros((n_groups, n_theta, n_phi + 1), dtype=np.int64)
+    sums = np.zeros((n_groups, n_theta, n_phi + 1), dtype=np.float64)
+    idx = (np.repeat(groups, n_theta), np.tile(np.arange(n_theta), n_hits), tightest.ravel())
+    np.add.at(counts, idx, 1)
+    np.add.at(sums, idx, np.repeat(weights, n_theta))
+    return np.cumsum(counts, axis=2)[..., :n_phi], np.cumsum(sums, axis=2)[..., :n_phi]
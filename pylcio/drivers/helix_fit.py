@@ -0,0 +1,95 @@
+import numpy as np
+
+
+def group_starts(keys):
+    """Start index of each group of equal consecutive keys"""
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+def group_sums(values, starts):
+    """Sums of the values over each group of consecutive entries starting at `starts`"""
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.float64)
+    return np.add.reduceat(values, starts)
+
+def fit_circles(x, y, starts):
+    """Algebraic (Kasa) circle fits of all groups of points at once
+
+    Solves the linear least-squares problem of the circle equation in coordinates relative to
+    the mean of each group, which is well conditioned also for short arcs.
+    Returns the centre (xc, yc), radius and RMS of the radial residuals of each group,
+    with NaN for groups of less than 3 points or of collinear points.
+    """
+    n = np.diff(np.append(starts, len(x)))
+    idx = np.repeat(np.arange(len(starts)), n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xm = group_sums(x, starts) / n
+        ym = group_sums(y, starts) / n
+        u = x - xm[idx]
+        v = y - ym[idx]
+        uu, vv, uv = group_sums(u*u, starts), group_sums(v*v, starts), group_sums(u*v, starts)
+        r2 = u*u + v*v
+        bu = 0.5 * group_sums(u * r2, starts)
+        bv = 0.5 * group_sums(v * r2, starts)
+        # Solving the 2x2 normal equations of all groups explicitly
+        det = uu * vv - uv * uv
+        a = (bu * vv - bv * uv) / det
+        b = (bv * uu - bu * uv) / det
+        radius = np.sqrt(a*a + b*b + (uu + vv) / n)
+        xc, yc = xm + a, ym + b
+        resid = np.hypot(x - xc[idx], y - yc[idx]) - radius[idx]
+        rms = np.sqrt(group_sums(resid * resid, starts) / n)
+    bad = (n < 3) | ~(np.abs(det) > 0)
+    for values in (xc, yc, radius, rms):
+        values[bad] = np.nan
+    return xc, yc, radius, rms
+
+def unwrap_phases(x, y, xc, yc, starts):
+    """Continuous turning angle of each point around the centre of its group
+
+    Points must be ordered along the trajectory, e.g. by time, and consecutive points of one
+    group must be less than half a turn apart.
+    """
+    n = np.diff(np.append(starts, len(x)))
+    idx = np.repeat(np.arange(len(starts)), n)
+    phi = np.arctan2(y - yc[idx], x - xc[idx])
+    dphi = np.diff(phi, prepend=0.0)
+    dphi = (dphi + np.pi) % (2 * np.pi) - np.pi
+    dphi[starts] = 0.0
+    # Keeping groups without a fitted centre from spoiling the cumulative sum of the others
+    dphi[np.isnan(dphi)] = 0.0
+    cum = np.cumsum(dphi)
+    return phi[starts][idx] + cum - cum[starts][idx]
+
+def fit_helices(x, y, z, starts):
+    """Helix fits of all groups of time-ordered points: circle in XY and linear Z vs turning angle
+
+    Returns a dictionary of per-group arrays: circle centre `xc`, `yc`, `radius`, residual `rms`,
+    number of `turns` between the first and last point and the Z distance per turn `pitch`.
+    """
+    xc, yc, radius, rms = fit_circles(x, y, starts)
+    n = np.diff(np.append(starts, len(x)))
+    with np.errstate(invalid='ignore'):
+        phi = unwrap_phases(x, y, xc, yc, starts)
+    last = starts + n - 1
+    turns = np.abs(phi[last] - phi[starts]) / (2 * np.pi)
+    # Linear regression of Z on the turning angle
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sp, sz = group_sums(phi, starts), group_sums(z, starts)
+        spp, spz = group_sums(phi * phi, starts), group_sums(phi * z, starts)
+        slope = (n * spz - sp * sz) / (n * spp - sp * sp)
+        pitch = 2 * np.pi * np.abs(slope)
+    pitch[~(turns > 0)] = np.nan
+    return {'xc': xc, 'yc': yc, 'radius': radius, 'rms': rms, 'turns': turns, 'pitch': pitch}
+
+def count_recrossings(groups, layer_keys):
+    """Number of hits of each group in a layer that already has a hit of the same group
+
+    `groups` must be sorted; `layer_keys` identify the detector layer of each hit.
+    """
+    starts = group_starts(groups)
+    n = np.diff(np.append(starts, len(groups)))
+    pairs = np.unique(np.stack([groups, layer_keys]), axis=1)
+    n_layers = np.bincount(np.searchsorted(groups[starts], pairs[0]), minlength=len(starts))
+    return n - n_layers
@@ -11,10 +11,11 @@ def get_oldest_mcp_parent(mcp):
     pars = mcp.getParents()
     if (len(pars) < 1):
         return mcp
-    for par in pars:
-        if par is mcp:
+    # Looping by index to avoid memory leak with the standard `for p in pars` iterator
+    for iP in range(len(pars)):
+        if pars[iP] is mcp:
             continue
-        return get_oldest_mcp_parent(par)
+        return get_oldest_mcp_parent(pars[iP])
 
 class HitsMCPDriver( Driver ):
     """Driver creating histograms of detector hits and their corresponding MCParticles"""
@@ -200,7 +201,8 @@ class HitsMCPDriver( Driver ):
                             self.histos['h_hit_cal_time_maxdiff'].Fill(hit_times.max() - hit_times.min())
 
         # Loop over all gen-level MCParticles
-        for mcp in mcParticles:
+        for iMcp in range(mcParticles.getNumberOfElements()):
+            mcp = mcParticles.getElementAt(iMcp)
             if mcp.getGeneratorStatus() != 1:
                 continue
             pdg = mcp.getPDG()
@@ -0,0 +1,205 @@
+import ROOT as R
+import numpy as np
+from pyLCIO.drivers.Driver import Driver
+from pyLCIO import EVENT
+
+from pdb import set_trace as br
+from .utils import read_sim_trk_hits, read_sim_cal_hits, decode_cellids, hit_time0, scan_cuts, group_min_index
+from .dl_pairing import hit_angles, double_layer_tightest, scan_grid
+
+
+class HitsTimingScanDriver( Driver ):
+    """Driver scanning a grid of timing cuts and double-layer cuts in a single pass over the events
+
+    For each collection, layer and cut value it accumulates the surviving number of hits,
+    their energy sum and the number of fired cells, separately for signal and BIB hits.
+    Hits of the double-layered collections are also scanned over a grid of dTheta x dPhi cuts
+    to the closest hits in the other sublayer.
+    """
+
+    HIT_COLLECTION_NAMES = {
+        'SimTrackerHit': ['VertexBarrelCollection', 'VertexEndcapCollection', 'InnerTrackerBarrelCollection', 'InnerTrackerEndcapCollection', 'OuterTrackerBarrelCollection', 'OuterTrackerEndcapCollection'],
+        'SimCalorimeterHit': ['ECalBarrelCollection', 'ECalEndcapCollection', 'HCalBarrelCollection', 'HCalEndcapCollection']
+    }
+    # Upper cuts on the hit time - T0 [ns]
+    TIME_CUTS = [0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 1, 2, 5, 10, 100]
+    # Hits from these MCParticles are counted as signal, everything else as BIB
+    SIGNAL_PDGS = [13, -13]
+    N_LAYERS_MAX = 128
+    # Collections of double layers (2*i, 2*i+1) and their number
+    DL_COLLECTION_NAMES = ['VertexBarrelCollection', 'VertexEndcapCollection']
+    N_DL_PAIRS = 4
+    # Grid of upper cuts on dTheta and dPhi to any hit in the other sublayer [rad]
+    DTHETA_CUTS = [0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.02, 0.05]
+    DPHI_CUTS = [0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.02, 0.05]
+    # Quantities accumulated for each layer and cut value
+    SCAN_NAMES = ['n_sig', 'n_bkg', 'e_sig', 'e_bkg', 'n_cells']
+    # All histograms and scans are filled per hit with the hit weights, allowing hit sampling
+    HIT_SAMPLING = True
+    # Everything per event is done in processArrays() and endOfEventArrays(), allowing shm_pipeline.py
+    PIPELINE_SAFE = True
+
+    def __init__( self, output_path=None, time_cuts=None):
+        """Constructor"""
+        Driver.__init__(self)
+        self.output_path = output_path
+        if time_cuts is not None:
+            self.TIME_CUTS = time_cuts
+        # Last cut accepts everything to provide the totals for efficiencies
+        self.cuts = np.array(sorted(self.TIME_CUTS) + [np.inf], dtype=np.float64)
+        self.dtheta_cuts = np.array(sorted(self.DTHETA_CUTS), dtype=np.float64)
+        self.dphi_cuts = np.array(sorted(self.DPHI_CUTS), dtype=np.float64)
+        self.scan = {}
+        self.dl_scan = {}
+        self.nEvents = 0
+
+    def startOfData( self ):
+        """Called by the event loop at the beginning of the loop"""
+        for col_names in self.HIT_COLLECTION_NAMES.values():
+            for col_name in col_names:
+                self.scan[col_name] = np.zeros((len(self.SCAN_NAMES), self.N_LAYERS_MAX, len(self.cuts)), dtype=np.float64)
+        for col_name in self.DL_COLLECTION_NAMES:
+            self.dl_scan[col_name] = np.zeros((len(self.SCAN_NAMES), 2 * self.N_DL_PAIRS, len(self.dtheta_cuts), len(self.dphi_cuts)), dtype=np.float64)
+
+    def processArrays( self, col_name, hits, layers ):
+        """Accumulates the cut scan for columnar hits of one collection"""
+        scan = self.scan[col_name]
+        time_mt0 = hits['time'] - hit_time0(hits['x'], hits['y'], hits['z'])
+        is_sig = np.isin(hits['mcp_pdg'], self.SIGNAL_PDGS)
+        weights = hits['weight']
+        # Counting hits and energy below each cut
+        for iS, sel in enumerate([is_sig, ~is_sig]):
+            _, counts = scan_cuts(time_mt0[sel], self.cuts, layers[sel], self.N_LAYERS_MAX, weights[sel])
+            _, sums = scan_cuts(time_mt0[sel], self.cuts, layers[sel], self.N_LAYERS_MAX, (hits['edep']*weights)[sel])
+            scan[iS] += counts
+            scan[2+iS] += sums
+        # Counting cells fired by at least one hit below each cut
+        idx = group_min_index(time_mt0, hits['cellid'])
+        _, counts = scan_cuts(time_mt0[idx], self.cuts, layers[idx], self.N_LAYERS_MAX, weights[idx])
+        scan[4] += counts
+        if col_name in self.dl_scan:
+            self.scan_double_layers(self.dl_scan[col_name], hits, layers, is_sig, weights)
+
+    def scan_double_layers( self, scan, hits, layers, is_sig, weights ):
+        """Accumulates the dTheta x dPhi cut grid of the same quantities for each layer"""
+        n_layers, n_phi = 2 * self.N_DL_PAIRS, len(self.dphi_cuts)
+        theta, phi = hit_angles(hits['x'], hits['y'], hits['z'])
+        tightest = double_layer_tightest(theta, phi, layers, self.N_DL_PAIRS, self.dtheta_cuts, self.dphi_cuts)
+        in_dl = layers < n_layers
+        for iS, sel in enumerate([is_sig & in_dl, ~is_sig & in_dl]):
+            _, counts = scan_grid(tightest[sel], n_phi, layers[sel], n_layers, weights[sel])
+            _, sums = scan_grid(tightest[sel], n_phi, layers[sel], n_layers, (hits['edep']*weights)[sel])
+            scan[iS] += counts
+            scan[2+iS] += sums
+        # A cell passes the cuts passed by any of its hits
+        cells, first, inverse = np.unique(hits['cellid'][in_dl], return_index=True, return_inverse=True)
+        tightest_cells = np.full((len(cells), len(self.dtheta_cuts)), n_phi, dtype=np.int64)
+        np.minimum.at(tightest_cells, inverse.ravel(), tightest[in_dl])
+        _, counts = scan_grid(tightest_cells, n_phi, layers[in_dl][first], n_layers, weights[in_dl][first])
+        scan[4] += counts
+
+    def processEvent( self, event ):
+        """Called by the event loop for each event"""
+
+        print('Event: {0:d}'.format(event.getEventNumber()))
+        for col_type, col_names in self.HIT_COLLECTION_NAMES.items():
+            for col_name in col_names:
+                col = event.getCollection(col_name)
+                cellIdEncoding = col.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding)
+                if col_type == 'SimTrackerHit':
+                    hits = read_sim_trk_hits(col)
+                else:
+                    hits = read_sim_cal_hits(col)
+                layers = decode_cellids(hits['cellid'], cellIdEncoding, ['layer'])['layer']
+                self.processArrays(col_name, hits, layers)
+        self.endOfEventArrays()
+
+    def endOfEventArrays( self ):
+        """Called after the arrays of all collections of an event are processed"""
+        self.nEvents += 1
+
+    def getState( self ):
+        """Accumulated scan used for checkpointing"""
+        return {'scan': self.scan, 'dl_scan': self.dl_scan, 'nEvents': self.nEvents}
+
+    def setState( self, state ):
+        """Restores the accumulated scan from a checkpoint"""
+        for col_name, scan in state['scan'].items():
+            self.scan[col_name] += scan
+        for col_name, scan in state.get('dl_scan', {}).items():
+            self.dl_scan[col_name] += scan
+        self.nEvents += state['nEvents']
+
+    def endOfData( self ):
+        """Called by the event loop at the end of the loop"""
+
+        if self.output_path is None:
+            return
+        out_file = R.TFile(self.output_path, 'RECREATE')
+        # Storing the scan as a compact table with one entry per collection, layer and cut
+        data = {}
+        tree = R.TTree('scan', 'Timing-cut scan')
+        for name in ['col_id', 'layer']:
+            data[name] = np.zeros(1, dtype=np.int32)
+            tree.Branch(name, data[name], '{0:s}/I'.format(name))
+        for name in ['cut'] + self.SCAN_NAMES + ['occupancy', 'eff_sig', 'rej_bkg']:
+            data[name] = np.zeros(1, dtype=np.float32)
+            tree.Branch(name, data[name], '{0:s}/F'.format(name))
+        col_names = [name for names in self.HIT_COLLECTION_NAMES.values() for name in names]
+        for iCol, col_name in enumerate(col_names):
+            scan = self.scan[col_name]
+            # Writing the scan as 2D histograms of layer vs cut
+            for iS, name in enumerate(self.SCAN_NAMES):
+                hname = 'h_{0:s}_{1:s}'.format(col_name, name)
+                h = R.TH2F(hname, ';Layer;Cut ID;{0:s}'.format(name), self.N_LAYERS_MAX, 0, self.N_LAYERS_MAX, len(self.cuts), 0, len(self.cuts))
+                for layer in range(self.N_LAYERS_MAX):
+                    for iCut in range(len(self.cuts)):
+                        h.SetBinContent(layer+1, iCut+1, scan[iS, layer, iCut])
+                h.Write()
+            for layer in np.nonzero(scan[:, :, -1].sum(axis=0))[0]:
+                n_sig_tot = scan[0, layer, -1]
+                n_bkg_tot = scan[1, layer, -1]
+                for iCut, cut in enumerate(self.cuts[:-1]):
+                    data['col_id'][0] = iCol
+                    data['layer'][0] = layer
+                    data['cut'][0] = cut
+                    for iS, name in enumerate(self.SCAN_NAMES):
+                        data[name][0] = scan[iS, layer, iCut]
+                    data['occupancy'][0] = scan[4, layer, iCut] / max(self.nEvents, 1)
+                    data['eff_sig'][0] = scan[0, layer, iCut] / n_sig_tot if n_sig_tot > 0 else 0.0
+                    data['rej_bkg'][0] = 1.0 - scan[1, layer, iCut] / n_bkg_tot if n_bkg_tot > 0 else 0.0
+                    tree.Fill()
+        tree.Write()
+
+        # Storing the double-layer scan with one entry per collection, layer and cut combination
+        data = {}
+        tree = R.TTree('dl_scan', 'Double-layer cut scan')
+        for name in ['col_id', 'layer']:
+            data[name] = np.zeros(1, dtype=np.int32)
+            tree.Branch(name, data[name], '{0:s}/I'.format(name))
+        for name in ['dtheta_cut', 'dphi_cut'] + self.SCAN_NAMES + ['occupancy', 'eff_sig', 'rej_bkg']:
+            data[name] = np.zeros(1, dtype=np.float32)
+            tree.Branch(name, data[name], '{0:s}/F'.format(name))
+        for iCol, col_name in enumerate(col_names):
+            if col_name not in self.dl_scan:
+                continue
+            scan = self.dl_scan[col_name]
+            # Totals without any cut from the timing scan
+            totals = self.scan[col_name][:, :, -1]
+            for layer in np.nonzero(totals[:, :2 * self.N_DL_PAIRS].sum(axis=0))[0]:
+                n_sig_tot = totals[0, layer]
+                n_bkg_tot = totals[1, layer]
+                for iTheta, dtheta_cut in enumerate(self.dtheta_cuts):
+                    for iPhi, dphi_cut in enumerate(self.dphi_cuts):
+                        data['col_id'][0] = iCol
+                        data['layer'][0] = layer
+                        data['dtheta_cut'][0] = dtheta_cut
+                        data['dphi_cut'][0] = dphi_cut
+                        for iS, name in enumerate(self.SCAN_NAMES):
+                            data[name][0] = scan[iS, layer, iTheta, iPhi]
+                        data['occupancy'][0] = scan[4, layer, iTheta, iPhi] / max(self.nEvents, 1)
+                        data['eff_sig'][0] = scan[0, layer, iTheta, iPhi] / n_sig_tot if n_sig_tot > 0 else 0.0
+                        data['rej_bkg'][0] = 1.0 - scan[1, layer, iTheta, iPhi] / n_bkg_tot if n_bkg_tot > 0 else 0.0
+                        tree.Fill()
+        tree.Write()
+        out_file.Close()
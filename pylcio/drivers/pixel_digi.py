@@ -0,0 +1,80 @@
+import numpy as np
+
+
+def local_coords(hits, barrel, sensor):
+    """Coordinates (u, v) on the sensor surface and direction components (du, dv, dn) of the hits
+
+    Barrel sensors are approximated by cylinders: u = r*phi, v = z and the normal is radial,
+    with phi measured from the mean phi of the hits of each sensor so that it never wraps at pi.
+    Endcap sensors are discs: u = x, v = y and the normal is along z.
+    """
+    x, y, z = hits['x'], hits['y'], hits['z']
+    px, py, pz = hits['px'].astype(np.float64), hits['py'].astype(np.float64), hits['pz'].astype(np.float64)
+    if barrel:
+        r = np.hypot(x, y)
+        phi = np.arctan2(y, x)
+        phi0 = np.arctan2(np.bincount(sensor, np.sin(phi)), np.bincount(sensor, np.cos(phi)))
+        u = r * ((phi - phi0[sensor] + np.pi) % (2 * np.pi) - np.pi)
+        v = z
+        # Momentum along the azimuthal, z and radial directions
+        dn = (x * px + y * py) / r
+        du = (x * py - y * px) / r
+        dv = pz
+    else:
+        u, v = x, y
+        du, dv, dn = px, py, pz
+    return u, v, du, dv, dn
+
+def track_lengths(du, dv, dn, thickness, max_length):
+    """Projected lengths along u and v of the path of a straight track through the sensor thickness
+
+    Tracks parallel to the sensor are limited to `max_length` along the directions they move in,
+    hits without momentum information get zero length, i.e. a single pixel.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lu = thickness * np.abs(du / dn)
+        lv = thickness * np.abs(dv / dn)
+    parallel = dn == 0
+    lu = np.where(parallel, np.where(du != 0, max_length, 0.0), np.minimum(lu, max_length))
+    lv = np.where(parallel, np.where(dv != 0, max_length, 0.0), np.minimum(lv, max_length))
+    return lu, lv
+
+def fire_pixels(sensor, u, v, lu, lv, pitch):
+    """Pixels crossed by the track segments of all hits on a square grid of the given pitch
+
+    The segment of each hit is centred at (u, v) with projected lengths (lu, lv) and is sampled
+    at steps of half a pitch, which finds every pixel crossed by a straight segment.
+    Returns the unique pixel keys, the hit index of each (hit, pixel) pair and its pixel index.
+    """
+    nSteps = np.ceil(2 * np.maximum(lu, lv) / pitch).astype(np.int64) + 1
+    hit_idx = np.repeat(np.arange(len(u)), nSteps)
+    # Fraction along the segment from -0.5 to 0.5 for each sample
+    start = np.repeat(np.cumsum(nSteps) - nSteps, nSteps)
+    step = np.arange(len(hit_idx)) - start
+    frac = np.where(nSteps[hit_idx] > 1, step / np.maximum(nSteps[hit_idx] - 1, 1) - 0.5, 0.0)
+    iu = np.floor((u[hit_idx] + frac * lu[hit_idx]) / pitch).astype(np.int64)
+    iv = np.floor((v[hit_idx] + frac * lv[hit_idx]) / pitch).astype(np.int64)
+    # Integer key of the pixel unique within the event
+    iu -= iu.min() if len(iu) else 0
+    iv -= iv.min() if len(iv) else 0
+    nu = iu.max() + 1 if len(iu) else 1
+    nv = iv.max() + 1 if len(iv) else 1
+    keys = (sensor[hit_idx] * nu + iu) * nv + iv
+    # Counting each pixel only once per hit
+    pairs = np.unique(np.stack([hit_idx, keys]), axis=1)
+    pixels, pixel_idx = np.unique(pairs[1], return_inverse=True)
+    return pixels, pairs[0], pixel_idx.ravel()
+
+def digitize(hits, barrel, pitch, thickness, max_length):
+    """Cluster size of each hit, number of hits in each fired pixel and a hit of each pixel"""
+    _, sensor = np.unique(hits['cellid'], return_inverse=True)
+    sensor = sensor.ravel()
+    u, v, du, dv, dn = local_coords(hits, barrel, sensor)
+    lu, lv = track_lengths(du, dv, dn, thickness, max_length)
+    pixels, pair_hit, pair_pixel = fire_pixels(sensor, u, v, lu, lv, pitch)
+    cluster_size = np.bincount(pair_hit, minlength=len(u))
+    multiplicity = np.bincount(pair_pixel, minlength=len(pixels))
+    # Any of the hits of each fired pixel, giving its sensor and layer
+    pixel_hit = np.zeros(len(pixels), dtype=np.int64)
+    pixel_hit[pair_pixel] = pair_hit
+    return cluster_size, multiplicity, pixel_hit
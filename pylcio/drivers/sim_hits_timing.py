@@ -11,10 +11,11 @@ def get_oldest_mcp_parent(mcp):
     pars = mcp.getParents()
     if (len(pars) < 1):
         return mcp
-    for par in pars:
-        if par is mcp:
+    # Looping by index to avoid memory leak with the standard `for p in pars` iterator
+    for iP in range(len(pars)):
+        if pars[iP] is mcp:
             continue
-        return get_oldest_mcp_parent(par)
+        return get_oldest_mcp_parent(pars[iP])
 
 class HitsTimingDriver( Driver ):
     """Driver creating histograms of detector hits timing and energy"""
@@ -6,6 +6,8 @@ from pyLCIO.EVENT import TrackState
 from pyLCIO.drivers.Driver import Driver
 
 from pdb import set_trace as br
+from .utils import decode_cellids, count_in_window, fill_hist
+from .truth_matching import truth_match, read_track_params
 
 CONST_C = R.TMath.C()
 
@@ -25,6 +27,17 @@ class TrkEfficiencyDriver( Driver ):
     MCP_PT_MIN = 0.1
     N_HIT_LAYERS_MIN = 4
     N_VTX_LAYERS_MIN = 4
+    # Track-MCParticle matching: 'hits' by the shared hits or 'dR' by the closest direction
+    MATCHING = 'hits'
+    # Minimum fraction of track hits from the matched MCParticle for a non-fake track
+    PURITY_MIN = 0.75
+    # Memory-mapped pool of BIB SimHits overlaid onto each event (see bib_pool.py)
+    BIB_POOL = None
+    BIB_FRACTION = 1.0
+    BIB_BX = [0]
+    BIB_SEED = 0
+    # Time window around the signal hits for counting BIB hits in the same sensor [ns]
+    BIB_DT_MAX = 1.0
 
 
 
@@ -34,6 +47,10 @@ class TrkEfficiencyDriver( Driver ):
         self.histos = {}
         self.output_path = output_path
         self.N_LAYERS_TOTAL = sum(self.N_LAYERS)
+        self.pool = None
+        if self.BIB_POOL:
+            from bib_pool import BibPool
+            self.pool = BibPool(self.BIB_POOL, self.BIB_FRACTION, self.BIB_BX, seed=self.BIB_SEED)
 
     def startOfData( self ):
         """Called by the event loop at the beginning of the loop"""
@@ -61,6 +78,25 @@ class TrkEfficiencyDriver( Driver ):
         self.histos[name] = R.TH1F( name, ';# tracks;Events', 10, 0, 10)
         name = 'h_nhits'
         self.histos[name] = R.TH1F( name, ';# hits;Tracks', 30, 0, 30)
+        # Create histograms for the truth matching of all tracks
+        name = 'h_trk_purity'
+        self.histos[name] = R.TH1F( name, ';Hit purity;Tracks', 110, 0, 1.1)
+        name = 'h_trk_hit_eff'
+        self.histos[name] = R.TH1F( name, ';Fraction of MCParticle hits on track;Tracks', 110, 0, 1.1)
+        name = 'h_ntrk_fake'
+        self.histos[name] = R.TH1F( name, ';# fake tracks;Events', 100, 0, 100)
+        for cat in ['all', 'fake', 'dup']:
+            name = 'h_trk_pt_' + cat
+            self.histos[name] = R.TH1F( name, ';p_{T} [GeV];Tracks', 2200,0,110)
+            name = 'h_trk_abstheta_' + cat
+            self.histos[name] = R.TH1F( name, ';|#Theta| [deg];Tracks', 90,0,90)
+        if self.pool is not None:
+            name = 'h_bib_nhits_layer'
+            self.histos[name] = R.TH1F( name, ';Layer;BIB hits', self.N_LAYERS_TOTAL, 0, self.N_LAYERS_TOTAL)
+            name = 'h_bib_nhits_sensor'
+            self.histos[name] = R.TH1F( name, ';# BIB hits in the sensor of the signal hit;Signal hits', 200, 0, 200)
+            name = 'p_bib_nhits_sensor_layer'
+            self.histos[name] = R.TProfile( name, ';Layer;# BIB hits in the sensor of the signal hit', self.N_LAYERS_TOTAL, 0, self.N_LAYERS_TOTAL)
 
 
     def trk_vec(self, trk):
@@ -75,6 +111,32 @@ class TrkEfficiencyDriver( Driver ):
         v_t.SetPtThetaPhi(trk_pt, trk_theta, trk_phi)
         return v_t
 
+    def read_bib(self, event, simhitcols):
+        """BIB SimHits of each collection sorted by CellID and time, filling their per-layer counts"""
+        bib = []
+        for iCol, simhitcol in enumerate(simhitcols):
+            colName = self.SIMHIT_COLLECTION_NAMES[iCol]
+            hits = self.pool.hits(event, colName)
+            layers = decode_cellids(hits['cellid'], self.pool.encoding(colName))['layer']
+            layer_offset = sum(self.N_LAYERS[:iCol])
+            counts = np.bincount(layers, minlength=self.N_LAYERS[iCol])
+            for layer, count in enumerate(counts[:self.N_LAYERS[iCol]]):
+                self.histos['h_bib_nhits_layer'].Fill(layer_offset + layer, count)
+            order = np.lexsort((hits['time'], hits['cellid']))
+            bib.append((hits['cellid'][order], hits['time'][order]))
+        return bib
+
+    def fill_bib(self, bib, sig_hits):
+        """Fills the number of BIB hits in the sensor of each signal hit within the time window"""
+        for iCol, (cellids, times) in enumerate(bib):
+            sel = sig_hits['col'] == iCol
+            if not np.any(sel):
+                continue
+            counts = count_in_window(cellids, times, sig_hits['cellid'][sel], sig_hits['time'][sel], self.BIB_DT_MAX)
+            for layer, count in zip(sig_hits['layer'][sel], counts):
+                self.histos['h_bib_nhits_sensor'].Fill(count)
+                self.histos['p_bib_nhits_sensor_layer'].Fill(layer, count)
+
     def abstheta(self, theta):
         """Converts theta to the absolute value in degrees"""
         return abs(theta - R.TMath.PiOver2()) * R.TMath.RadToDeg()
@@ -94,10 +156,24 @@ class TrkEfficiencyDriver( Driver ):
         simhitcols = [event.getCollection(col) for col in self.SIMHIT_COLLECTION_NAMES]
         hitcols = [event.getCollection(col) for col in self.HIT_COLLECTION_NAMES]
         hitrels = [event.getCollection(col) for col in self.HIT_RELATION_NAMES]
+        # Truth matching of all tracks through the relations of their hits
+        match = truth_match(trks, hitrels, self.PURITY_MIN)
+        trk_pt, trk_theta, _ = read_track_params(trks, self.MAG_FIELD)
+        trk_abstheta = 90 - np.abs(np.degrees(trk_theta) - 90)
+        fill_hist(H['h_trk_purity'], match.purity)
+        fill_hist(H['h_trk_hit_eff'], match.efficiency[~match.fake])
+        H['h_ntrk_fake'].Fill(np.count_nonzero(match.fake))
+        for cat, sel in [('all', slice(None)), ('fake', match.fake), ('dup', match.duplicate)]:
+            fill_hist(H['h_trk_pt_' + cat], trk_pt[sel])
+            fill_hist(H['h_trk_abstheta_' + cat], trk_abstheta[sel])
+
+        # Overlaying BIB hits from the pool
+        bib = self.read_bib(event, simhitcols) if self.pool is not None else None
 
         # Loop over all gen-level MCParticles
         nmcp = 0
-        for mcp in mcParticles:
+        for iMcp in range(mcParticles.getNumberOfElements()):
+            mcp = mcParticles.getElementAt(iMcp)
             if mcp.getGeneratorStatus() != 1:
                 continue
             pdg = mcp.getPDG()
@@ -117,6 +193,7 @@ class TrkEfficiencyDriver( Driver ):
             # Getting the SimHits belonging to this particle
             simhits = []
             rechits = []
+            sig_hits = {'col': [], 'cellid': [], 'time': [], 'layer': []}
             nhits_sim = np.zeros(self.N_LAYERS_TOTAL, dtype=np.uint8)
             nhits_rec = np.zeros(self.N_LAYERS_TOTAL, dtype=np.uint8)
             for iCol, simhitcol in enumerate(simhitcols):
@@ -135,6 +212,8 @@ class TrkEfficiencyDriver( Driver ):
                     cellIdDecoder.setValue(cellId)
                     layer = int(cellIdDecoder['layer'].value())
                     nhits_sim[layer_offset+layer] += 1
+                    for key, value in zip(['col', 'cellid', 'time', 'layer'], [iCol, cellId, simHit.getTime(), layer_offset+layer]):
+                        sig_hits[key].append(value)
                     # Finding the corresponding RecHit
                     rels = hitrels[iCol]
                     nRels = rels.getNumberOfElements()
@@ -150,6 +229,9 @@ class TrkEfficiencyDriver( Driver ):
             nlayers_vtx = len(nhits_vtx[nhits_vtx>0])
             if nlayers_sim < self.N_HIT_LAYERS_MIN:
                 continue
+            if bib is not None:
+                dtypes = {'col': np.int64, 'cellid': np.uint64, 'time': np.float32, 'layer': np.int64}
+                self.fill_bib(bib, {key: np.array(values, dtype=dtypes[key]) for key, values in sig_hits.items()})
             # print("{4:d} {5:d}: # sim hits (layers): {0:d} ({1:d})\treco hits (layers): {2:d} ({3:d})".format(np.sum(nhits_sim), nlayers_sim,
             #                                                                                                   np.sum(nhits_rec), nlayers_rec,
             #                                                                                                   event.getEventNumber(),
@@ -166,28 +248,32 @@ class TrkEfficiencyDriver( Driver ):
             ntrk = trks.getNumberOfElements()
             H['h_ntrk'].Fill(ntrk)
             # print('  # tracks: {0:d}'.format(ntrk))
-            dR_min = 999
-            trk_id = -1
-            for iTrk in range(ntrk):
-                trk = trks.getElementAt(iTrk)
-                v_t = self.trk_vec(trk)
-                dR = v_t.DeltaR(v_m)
-                if dR < dR_min:
-                    dR_min = dR
-                    trk_id = iTrk
-                # print('trk {0:d}: pt: {1:.2f} dR: {2:.2f}'.format(iTrk, v_t.Pt(), dR))
+            if self.MATCHING == 'hits':
+                trk_id = match.track(mcp)
+                dR_min = self.trk_vec(trks.getElementAt(trk_id)).DeltaR(v_m) if trk_id >= 0 else 999
+            else:
+                dR_min = 999
+                trk_id = -1
+                for iTrk in range(ntrk):
+                    trk = trks.getElementAt(iTrk)
+                    v_t = self.trk_vec(trk)
+                    dR = v_t.DeltaR(v_m)
+                    if dR < dR_min:
+                        dR_min = dR
+                        trk_id = iTrk
+                    # print('trk {0:d}: pt: {1:.2f} dR: {2:.2f}'.format(iTrk, v_t.Pt(), dR))
             if trk_id == -1:
                 # Checking the MCParticle Theta
                 if math.radians(22) < abs(v_m.Theta()) < math.radians(27):
                     print(event.getEventNumber(), event.getRunNumber())
                 continue
             # Filling histograms with track properties
-            trk = trks.getElementAt(iTrk)
+            trk = trks.getElementAt(trk_id)
             v_t = self.trk_vec(trk)
-            nhits = len(trk.getTrackerHits())
-            # print('  trk {0:d}: pt: {1:2f}  theta: {2:.2f}  phi: {3:.2f}  dR: {4:.2f}'.format(iTrk, v_t.Pt(), v_t.Theta(), v_t.Phi(), dR_min))
+            nhits = match.n_hits[trk_id]
+            # print('  trk {0:d}: pt: {1:2f}  theta: {2:.2f}  phi: {3:.2f}  dR: {4:.2f}'.format(trk_id, v_t.Pt(), v_t.Theta(), v_t.Phi(), dR_min))
             H['h_trk_dR'].Fill(dR_min)
-            if dR_min > 0.01:
+            if self.MATCHING == 'dR' and dR_min > 0.01:
                 continue
             dpt = (v_t.Pt() - v_m.Pt()) / v_m.Pt()
             if abs(dpt) > 1.0:
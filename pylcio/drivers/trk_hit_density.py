@@ -5,6 +5,7 @@ from pyLCIO.drivers.Driver import Driver
 from pyLCIO import EVENT, UTIL
 
 from pdb import set_trace as br
+from .utils import read_trk_hits, decode_cellids, overlay_hits
 
 
 class HitDensityDriver( Driver ):
@@ -20,13 +21,24 @@ class HitDensityDriver( Driver ):
     # N_LAYERS = [8, 8, 3, 7, 3, 4]
     N_LAYERS = [8, 8]
     MODULE_MAX = 10000
-
+    # Time window for hits to be considered [ns]
+    T_MIN = None
+    T_MAX = None
+    # Memory-mapped pool of BIB hits overlaid onto each event (see bib_pool.py)
+    BIB_POOL = None
+    BIB_FRACTION = 1.0
+    BIB_BX = [0]
+    BIB_SEED = 0
 
     def __init__( self, output_path=None):
         """Constructor"""
         Driver.__init__(self)
         self.histos = {}
         self.output_path = output_path
+        self.pool = None
+        if self.BIB_POOL:
+            from bib_pool import BibPool
+            self.pool = BibPool(self.BIB_POOL, self.BIB_FRACTION, self.BIB_BX, seed=self.BIB_SEED)
 
     def startOfData( self ):
         """Called by the event loop at the beginning of the loop"""
@@ -45,36 +57,30 @@ class HitDensityDriver( Driver ):
             if iCol > 0:
                 layer_id_offset += self.N_LAYERS[iCol-1]
             hits = event.getCollection(colName)
-            nhits = hits.getNumberOfElements()
-            print('### Processing collection `{0:s}` with {1:d} hits'.format(colName, nhits))
-            H = self.histos
-            # Creating the arrays of sensor hit counts for each layer
-            hit_counts = [{} for i in range(self.N_LAYERS[iCol])]
-            # Creating the CellID decocder
             cellIdEncoding = hits.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding)
-            cellIdDecoder = UTIL.BitField64(cellIdEncoding)
-            # Loop over hits
-            for iH in range(nhits):
-                hit = hits.getElementAt(iH)
-                cellId = int(hit.getCellID0() & 0xffffffff) | (int( hit.getCellID1() ) << 32)
-                cellIdDecoder.setValue(cellId)
-                layer = int(cellIdDecoder['layer'].value())
-                if cellId not in hit_counts[layer]:
-                    hit_counts[layer][cellId] = 1
-                else:
-                    hit_counts[layer][cellId] += 1
-            # Converting dicts to arrays
-            for i in range(len(hit_counts)):
-                hit_counts[i] = np.array(list(hit_counts[i].values()), dtype=np.uint32)
-            # Filling histograms
+            cols = read_trk_hits(hits)
+            # Adding the BIB hits from the pool
+            if self.pool is not None:
+                cols = overlay_hits(cols, self.pool.hits(event, colName))
+            if self.T_MIN is not None or self.T_MAX is not None:
+                t_min = self.T_MIN if self.T_MIN is not None else -np.inf
+                t_max = self.T_MAX if self.T_MAX is not None else np.inf
+                sel = (cols['time'] >= t_min) & (cols['time'] <= t_max)
+                cols = {name: values[sel] for name, values in cols.items()}
+            cellIds = cols['cellid']
+            print('### Processing collection `{0:s}` with {1:d} hits'.format(colName, len(cellIds)))
+            layers = decode_cellids(cellIds, cellIdEncoding)['layer']
+            # Filling histograms with the hit counts of each sensor
             for layer in range(self.N_LAYERS[iCol]):
-                print('  {0:d} sensors hit in layer {1:d}'.format(len(hit_counts[layer]), layer))
-                self.histos['h_nhits_min'].SetBinContent(1+layer_id_offset + layer, np.min(hit_counts[layer]))
-                self.histos['h_nhits_max'].SetBinContent(1+layer_id_offset + layer, np.max(hit_counts[layer]))
-                self.histos['h_nhits_mean'].SetBinContent(1+layer_id_offset + layer, np.mean(hit_counts[layer]))
-                self.histos['h_nhits_median'].SetBinContent(1+layer_id_offset + layer, np.median(hit_counts[layer]))
-                self.histos['h_nhits_sum'].SetBinContent(1+layer_id_offset + layer, np.sum(hit_counts[layer]))
-
+                _, hit_counts = np.unique(cellIds[layers == layer], return_counts=True)
+                print('  {0:d} sensors hit in layer {1:d}'.format(len(hit_counts), layer))
+                if len(hit_counts) == 0:
+                    continue
+                self.histos['h_nhits_min'].SetBinContent(1+layer_id_offset + layer, np.min(hit_counts))
+                self.histos['h_nhits_max'].SetBinContent(1+layer_id_offset + layer, np.max(hit_counts))
+                self.histos['h_nhits_mean'].SetBinContent(1+layer_id_offset + layer, np.mean(hit_counts))
+                self.histos['h_nhits_median'].SetBinContent(1+layer_id_offset + layer, np.median(hit_counts))
+                self.histos['h_nhits_sum'].SetBinContent(1+layer_id_offset + layer, np.sum(hit_counts))
 
 
 
@@ -1,46 +1,47 @@
+import os
 import ROOT as R
 import numpy as np
 import math
-from copy import copy
 
 from pyLCIO.drivers.Driver import Driver
 from pyLCIO import EVENT, UTIL, IMPL, IO, IOIMPL
 
 from pdb import set_trace as br
+from .writer import AsyncWriter, TreeBuffer, copy_mcp, copy_sim_trk_hit
+from .utils import read_sim_trk_hits, decode_cellids, cellid_fields
+from .helix_fit import group_starts, fit_helices, count_recrossings
 
-CONST_C = R.TMath.C()
-# T_MAX = 0.18 # ns
-T_MAX = 10e3 # ns
-T_MIN = -1.0 # ns
-
-def get_oldest_mcp_parent(mcp, nIters=0):
-    """Recursively looks for the oldest parent of the MCParticle"""
-    pars = mcp.getParents()
-    if (len(pars) < 1):
-        return mcp, nIters
-    for par in pars:
-        # Skipping if the particle is its own parent
-        if par is mcp:
-            continue
-        return get_oldest_mcp_parent(par, nIters+1)
 
 class TrkHitLoopersDriver( Driver ):
-    """Driver creating histograms of detector hits associated to looper MCParticles"""
+    """Driver characterising electrons looping in the tracker by helix fits to their hits
+
+    Hits of all electrons are grouped by MCParticle and fitted at once with a circle in XY and
+    a linear dependence of Z on the turning angle, giving the radius, the number of turns and
+    the Z pitch of each helix. Together with the number of layers crossed more than once,
+    these define the `mcp_looper` flag. One tree entry is stored per electron with hits and
+    only the loopers are written with their hits to the LCIO output.
+    """
 
     # HIT_COLLECTION_NAMES = ['VertexBarrelCollection', 'VertexEndcapCollection']
     HIT_COLLECTION_NAMES = ['VertexBarrelCollection', 'VertexEndcapCollection',
                             'InnerTrackerBarrelCollection', 'InnerTrackerEndcapCollection',
                             'OuterTrackerBarrelCollection', 'OuterTrackerEndcapCollection']
-    NHITS_MAX = 300
-    HIT_F = ['hit_t',
-             'hit_pos_z', 'hit_pos_x', 'hit_pos_y', 'hit_pos_r',
-             ]
-    HIT_I = ['hit_det']
+    MAG_FIELD = 4.0  # Tesla
+    # Minimum number of turns or of layer re-crossings of a looper
+    LOOPER_TURNS_MIN = 1.0
+    LOOPER_RECROSS_MIN = 2
+    # Writing the loopers with their hits to the LCIO output
+    WRITE_LCIO = True
+    # Appending to an existing LCIO output, set by run.py when resuming from a checkpoint
+    LCIO_APPEND = False
     MCP_F = ['mcp_vtx_z', 'mcp_vtx_x', 'mcp_vtx_y', 'mcp_vtx_r',
              'mcp_theta', 'mcp_phi', 'mcp_t',
              'mcp_beta', 'mcp_gamma', 'mcp_e', 'mcp_p', 'mcp_pt', 'mcp_pz',
              ]
-    MCP_I = ['mcp_pdg', 'mcp_nhits']
+    MCP_I = ['mcp_pdg', 'mcp_nhits', 'mcp_nlayers', 'mcp_nrecross', 'mcp_looper']
+    FIT_F = ['fit_xc', 'fit_yc', 'fit_r', 'fit_rms', 'fit_pt', 'fit_turns', 'fit_pitch',
+             'hit_t_first', 'hit_t_last', 'hit_r_max', 'hit_z_min', 'hit_z_max',
+             ]
 
 
     def __init__( self, output_path=None):
@@ -49,41 +50,59 @@ class TrkHitLoopersDriver( Driver ):
         self.output_path = output_path
         self.out_root = None
         self.out_lcio = None
+        self.writer = None
         self.event = 0
 
 
-    def clear_data(self):
-        """Resets the data structures used for filling the TTree"""
-        for name in self.MCP_F + self.MCP_I + self.HIT_I + self.HIT_F:
-            self.data[name].fill(0)
-
-
     def startOfData( self ):
         """Called by the event loop at the beginning of the loop"""
 
-        # Creating the TTree with branches
-        self.data = {}
-        self.tree = R.TTree('tree', 'SimTrackerHit properties')
-        for name in self.MCP_F:
-            self.data[name] = np.zeros(1, dtype=np.float32)
-            self.tree.Branch(name, self.data[name], '{0:s}/F'.format(name))
-        for name in self.MCP_I:
-            self.data[name] = np.zeros(1, dtype=np.int32)
-            self.tree.Branch(name, self.data[name], '{0:s}/I'.format(name))
-        for name in self.HIT_I:
-            self.data[name] = np.zeros(self.NHITS_MAX, dtype=np.int32)
-            self.tree.Branch(name, self.data[name], '{0:s}[mcp_nhits]/I'.format(name))
-        for name in self.HIT_F:
-            self.data[name] = np.zeros(self.NHITS_MAX, dtype=np.float32)
-            self.tree.Branch(name, self.data[name], '{0:s}[mcp_nhits]/F'.format(name))
+        # Creating the TTree with branches filled by the background writer
+        self.tree = R.TTree('tree', 'Looper MCParticle properties')
+        fields = [(name, np.float32, '{0:s}/F'.format(name), 1) for name in self.MCP_F + self.FIT_F]
+        fields += [(name, np.int32, '{0:s}/I'.format(name), 1) for name in self.MCP_I]
+        self.buffer = TreeBuffer(self.tree, fields)
 
         # Opening the output ROOT file
         if self.output_path is not None:
             self.out_root = R.TFile(self.output_path, 'RECREATE')
 
         # Opening the output LCIO file
-        self.out_lcio = IOIMPL.LCFactory.getInstance().createLCWriter()
-        self.out_lcio.open(self.output_path.replace('.root', '.slcio'), EVENT.LCIO.WRITE_NEW)
+        if self.output_path is not None and self.WRITE_LCIO:
+            lcio_path = self.output_path.replace('.root', '.slcio')
+            mode = EVENT.LCIO.WRITE_NEW
+            if self.LCIO_APPEND and os.path.isfile(lcio_path):
+                # Continuing the event numbering of the loopers written before the restart
+                reader = IOIMPL.LCFactory.getInstance().createLCReader()
+                reader.open(lcio_path)
+                self.event = reader.getNumberOfEvents()
+                reader.close()
+                mode = EVENT.LCIO.WRITE_APPEND
+            self.out_lcio = IOIMPL.LCFactory.getInstance().createLCWriter()
+            self.out_lcio.open(lcio_path, mode)
+        self.writer = AsyncWriter()
+
+
+    def read_hits( self, event ):
+        """Columnar electron hits of all collections ordered by MCParticle and time"""
+        hits = {}
+        for iCol, col_name in enumerate(self.HIT_COLLECTION_NAMES):
+            col = event.getCollection(col_name)
+            encoding = col.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding)
+            col_hits = read_sim_trk_hits(col)
+            names = ['layer', 'side'] if 'side' in cellid_fields(encoding) else ['layer']
+            ids = decode_cellids(col_hits['cellid'], encoding, names)
+            # Layer unique across the collections and the two endcap sides
+            col_hits['layer_key'] = (iCol * 3 + ids.get('side', 0) + 1) * 1000 + ids['layer']
+            col_hits['col'] = np.full(len(ids['layer']), iCol, dtype=np.int32)
+            col_hits['idx'] = np.arange(len(ids['layer']))
+            for name, values in col_hits.items():
+                hits.setdefault(name, []).append(values)
+        hits = {name: np.concatenate(values) for name, values in hits.items()}
+        sel = (np.abs(hits['mcp_pdg']) == 11) & (hits['mcp_id'] != 0)
+        hits = {name: values[sel] for name, values in hits.items()}
+        order = np.lexsort((hits['time'], hits['mcp_id']))
+        return {name: values[order] for name, values in hits.items()}
 
 
     def processEvent( self, event ):
@@ -91,101 +110,107 @@ class TrkHitLoopersDriver( Driver ):
 
         eventNr = event.getEventNumber()
         print('Event: {0:d}'.format(eventNr))
-        # Get the MCParticle collection from the event
+
+        # Fitting the hits of all electrons at once
+        hits = self.read_hits(event)
+        if len(hits['mcp_id']) == 0:
+            print('Saved  0  particles')
+            return
+        starts = group_starts(hits['mcp_id'])
+        n_hits = np.diff(np.append(starts, len(hits['mcp_id'])))
+        last = starts + n_hits - 1
+        mcp_ids = hits['mcp_id'][starts]
+        fit = fit_helices(hits['x'], hits['y'], hits['z'], starts)
+        n_recross = count_recrossings(hits['mcp_id'], hits['layer_key'])
+        with np.errstate(invalid='ignore'):
+            looper = (fit['turns'] >= self.LOOPER_TURNS_MIN) | (n_recross >= self.LOOPER_RECROSS_MIN)
+        r = np.hypot(hits['x'], hits['y'])
+        columns = {
+            'mcp_nhits': n_hits,
+            'mcp_nlayers': n_hits - n_recross,
+            'mcp_nrecross': n_recross,
+            'mcp_looper': looper,
+            'fit_xc': fit['xc'],
+            'fit_yc': fit['yc'],
+            'fit_r': fit['radius'],
+            'fit_rms': fit['rms'],
+            'fit_pt': 0.0003 * self.MAG_FIELD * fit['radius'],
+            'fit_turns': fit['turns'],
+            'fit_pitch': fit['pitch'],
+            'hit_t_first': hits['time'][starts],
+            'hit_t_last': hits['time'][last],
+            'hit_r_max': np.maximum.reduceat(r, starts),
+            'hit_z_min': np.minimum.reduceat(hits['z'], starts),
+            'hit_z_max': np.maximum.reduceat(hits['z'], starts),
+        }
+
+        # Properties of the fitted MCParticles
+        mcp_values = np.zeros((len(self.MCP_F) + 1, len(mcp_ids)), dtype=np.float64)
+        mcps = {}
         mcParticles = event.getMcParticles()
-        # Loop over MCParticles
-        nParticles = 0
+        for iMcp in range(mcParticles.getNumberOfElements()):
+            mcp = mcParticles.getElementAt(iMcp)
+            iG = np.searchsorted(mcp_ids, mcp.id())
+            if iG == len(mcp_ids) or mcp_ids[iG] != mcp.id():
+                continue
+            mcps[iG] = mcp
+            pos = mcp.getVertex()
+            lv = mcp.getLorentzVec()
+            mcp_values[:, iG] = (pos[2], pos[0], pos[1], math.sqrt(pos[0]*pos[0] + pos[1]*pos[1]),
+                                 lv.Theta(), lv.Phi(), mcp.getTime(),
+                                 lv.Beta(), lv.Gamma(), lv.E(), lv.P(), lv.Pt(), lv.Pz(),
+                                 mcp.getPDG())
+        columns.update(zip(self.MCP_F + ['mcp_pdg'], mcp_values))
+        # Passing the event entries to the background writer
+        self.buffer.extend(columns, len(mcp_ids))
+        self.writer.submit(self.buffer.write, self.buffer.take())
+
+        if self.out_lcio is not None:
+            self.write_loopers(event, eventNr, hits, starts, n_hits, np.flatnonzero(looper), mcps)
+        print('Saved  {0:d}  particles, {1:d} loopers'.format(len(mcp_ids), np.count_nonzero(looper)))
+
+
+    def write_loopers( self, event, eventNr, hits, starts, n_hits, loopers, mcps ):
+        """Writes each looper MCParticle with its hits as a separate LCIO event"""
+
         # Storing even as run in LCIO
         run = IMPL.LCRunHeaderImpl()
         run.setRunNumber(eventNr)
-        self.out_lcio.writeRunHeader(run)
-        for mcp in mcParticles:
-            # Skipping non-electrons
-            if abs(mcp.getPDG()) != 11:
-                continue
-            # Clearing the data structures
-            self.clear_data()
-            nHits_mcp = 0
-            lcio_hits = {i: [] for i, _ in enumerate(self.HIT_COLLECTION_NAMES)}
-            # Looking for matching hits in each collection
-            for iCol, col_name in enumerate(self.HIT_COLLECTION_NAMES):
-                col = event.getCollection(col_name)
-                # Filling the Tracker hit properties
-                data = self.data
-                nHits = col.getNumberOfElements()
-
-                # print('Checking {1:d} hits from: {0:s}'.format(col_name, nHits))
-                for iHit in range(nHits):
-                    # Checking if hit belong to the particle
-                    hit = col.getElementAt(iHit)
-                    mcp_h = hit.getMCParticle()
-                    if mcp_h != mcp:
-                        continue
-                    # Storing hit for writing to LCIO
-                    lcio_hits[iCol].append(hit)
-                    # Storing hit properties
-                    iH = nHits_mcp
-                    pos = hit.getPositionVec()
-                    data['hit_t'][iH] = hit.getTime()
-                    # data['hit_t0'][iH] = pos.Mag() / (CONST_C / 1e6)
-                    data['hit_det'][iH] = iCol
-                    # data['hit_edep'][iH] = hit.getEDep()
-                    data['hit_pos_x'][iH] = pos.X()
-                    data['hit_pos_y'][iH] = pos.Y()
-                    data['hit_pos_z'][iH] = pos.Z()
-                    data['hit_pos_r'][iH] = pos.Perp()
-                    nHits_mcp += 1
-
-            # Storing info about MCParticle if it has 1+ hits
-            if nHits_mcp == 0:
+        self.writer.submit(self.out_lcio.writeRunHeader, run)
+        cols_in = [event.getCollection(col_name) for col_name in self.HIT_COLLECTION_NAMES]
+        for iG in loopers:
+            if iG not in mcps:
                 continue
-
-            pos = mcp.getVertex()
-            lv = mcp.getLorentzVec()
-            data['mcp_nhits'][0] = nHits_mcp
-            data['mcp_vtx_x'][0] = pos[0]
-            data['mcp_vtx_y'][0] = pos[1]
-            data['mcp_vtx_z'][0] = pos[2]
-            data['mcp_vtx_r'][0] = math.sqrt(pos[0]*pos[0] + pos[1]*pos[1])
-            data['mcp_pdg'][0] = mcp.getPDG()
-            data['mcp_t'][0] = mcp.getTime()
-            data['mcp_theta'][0] = lv.Theta()
-            data['mcp_phi'][0] = lv.Phi()
-            data['mcp_p'][0] = lv.P()
-            data['mcp_pt'][0] = lv.Pt()
-            data['mcp_pz'][0] = lv.Pz()
-            data['mcp_beta'][0] = lv.Beta()
-            data['mcp_gamma'][0] = lv.Gamma()
-            nParticles += 1
-
-            self.tree.Fill()
-
-            # Adding MCParticle to the LCIO output
-            print(f'Particle: {nParticles}')
             evt = IMPL.LCEventImpl()
             col = IMPL.LCCollectionVec(EVENT.LCIO.MCPARTICLE)
             evt.setEventNumber(self.event)
             evt.setRunNumber(run.getRunNumber())
             evt.addCollection(col, "MCParticle")
-            col.addElement(copy(mcp))
-            col_hit = [IMPL.LCCollectionVec( EVENT.LCIO.SIMTRACKERHIT ) for col in self.HIT_COLLECTION_NAMES]
+            R.SetOwnership(col, False)
+            # Using independent copies that stay valid after the input event is released
+            mcp_new = copy_mcp(mcps[iG])
+            R.SetOwnership(mcp_new, False)
+            col.addElement(mcp_new)
             # Adding hits to the LCIO output
-            for idx, hits in lcio_hits.items():
+            group = slice(starts[iG], starts[iG] + n_hits[iG])
+            for iCol, col_name in enumerate(self.HIT_COLLECTION_NAMES):
                 col = IMPL.LCCollectionVec(EVENT.LCIO.SIMTRACKERHIT)
-                evt.addCollection(col, self.HIT_COLLECTION_NAMES[idx])
-                for hit in hits:
-                    col.addElement(copy(hit))
-            self.out_lcio.writeEvent(evt)
-
+                evt.addCollection(col, col_name)
+                R.SetOwnership(col, False)
+                for iHit in hits['idx'][group][hits['col'][group] == iCol]:
+                    hit_new = copy_sim_trk_hit(cols_in[iCol].getElementAt(int(iHit)), mcp_new)
+                    R.SetOwnership(hit_new, False)
+                    col.addElement(hit_new)
+            self.writer.submit(self.out_lcio.writeEvent, evt)
             self.event += 1
 
 
-        print(f'Saved  {nParticles}  particles')
-
-
     def endOfData( self ):
         """Called by the event loop at the end of the loop"""
 
+        # Waiting for the pending entries and events to be written
+        if self.writer is not None:
+            self.writer.close()
         # Storing histograms to the output ROOT file
         if self.out_root:
             self.out_root.cd()
@@ -193,4 +218,5 @@ class TrkHitLoopersDriver( Driver ):
             self.out_root.Close()
 
         # Closing the LCIO file
-        self.out_lcio.close()
+        if self.out_lcio is not None:
+            self.out_lcio.close()
@@ -6,6 +6,7 @@ from pyLCIO import EVENT, UTIL
 
 from pdb import set_trace as br
 from .utils import get_oldest_mcp_parent
+from .writer import AsyncWriter, TreeBuffer
 
 # import psutil
 # import os
@@ -31,6 +32,8 @@ class TrkHitsMCPDriver( Driver ):
         Driver.__init__(self)
         self.output_path = output_path
         self.output_file = None
+        self.writer = None
+        self.nHits = 0
 
 
     def startOfData( self ):
@@ -43,7 +46,8 @@ class TrkHitsMCPDriver( Driver ):
                    'mcp_theta', 'mcp_phi', 'mcp_bib_theta', 'mcp_bib_phi',
                    'mcp_time', 'mcp_bib_time',
                    'mcp_beta', 'mcp_gamma', 'mcp_e', 'mcp_p', 'mcp_pt', 'mcp_pz',
-                   'mcp_bib_beta', 'mcp_bib_gamma', 'mcp_bib_e', 'mcp_bib_p', 'mcp_bib_pt', 'mcp_bib_pz'
+                   'mcp_bib_beta', 'mcp_bib_gamma', 'mcp_bib_e', 'mcp_bib_p', 'mcp_bib_pt', 'mcp_bib_pz',
+                   'weight'
                    ]
         names_I = ['layer', 'side', 'col_id',
                    'mcp_pdg', 'mcp_bib_pdg', 'mcp_bib_niters', 'mcp_gen', 'mcp_bib_gen']
@@ -52,15 +56,15 @@ class TrkHitsMCPDriver( Driver ):
         if self.output_path is not None:
             self.output_file = R.TFile(self.output_path, 'RECREATE')
 
-        # Creating the TTree with branches
-        self.data = {}
+        # Creating the TTree with branches filled by the background writer
         self.tree = R.TTree('tree', 'SimTrackerHit properties')
-        for name in names_F:
-            self.data[name] = np.zeros(1, dtype=np.float32)
-            self.tree.Branch(name, self.data[name], '{0:s}/F'.format(name))
-        for name in names_I:
-            self.data[name] = np.zeros(1, dtype=np.int32)
-            self.tree.Branch(name, self.data[name], '{0:s}/I'.format(name))
+        fields = [(name, np.float32, '{0:s}/F'.format(name), 1) for name in names_F]
+        fields += [(name, np.int32, '{0:s}/I'.format(name), 1) for name in names_I]
+        self.buffer = TreeBuffer(self.tree, fields)
+        self.data = self.buffer.data
+        # Entry weight is updated when processing sampled hits
+        self.data['weight'][0] = 1.0
+        self.writer = AsyncWriter()
 
     def processEvent( self, event ):
         """Called by the event loop for each event"""
@@ -130,13 +134,20 @@ class TrkHitsMCPDriver( Driver ):
                     data[prefix+'_pz'][0] = lv.Pz()
                     data[prefix+'_beta'][0] = lv.Beta()
                     data[prefix+'_gamma'][0] = lv.Gamma()
-                self.tree.Fill()
+                self.buffer.fill()
 
-        print('  Tree has {0:d} hits'.format(self.tree.GetEntries()))
+        # Passing the event entries to the background writer
+        rows = self.buffer.take()
+        self.nHits += len(rows)
+        self.writer.submit(self.buffer.write, rows)
+        print('  Tree has {0:d} hits'.format(self.nHits))
 
     def endOfData( self ):
         """Called by the event loop at the end of the loop"""
 
+        # Waiting for the pending entries to be written
+        if self.writer is not None:
+            self.writer.close()
         # Storing histograms to the output ROOT file
         if self.output_file is not None:
             self.output_file.Write()
@@ -3,6 +3,8 @@ import numpy as np
 from pyLCIO.drivers.Driver import Driver
 
 from pdb import set_trace as br
+from .utils import read_tracks, fill_hist
+from .truth_matching import read_track_hits, match_tracks
 
 CONST_C = R.TMath.C()
 
@@ -12,6 +14,9 @@ class TrkPropsDriver( Driver ):
     TRK_COLLECTIONS = ['SiTracks', 'SiTracksCT', 'SiTracks_Refitted']
     HIT_COLLECTIONS = ['VXDTrackerHits', 'VXDEndcapTrackerHits', 'ITrackerHits', 'ITrackerEndcapHits', 'OTrackerHits', 'OTrackerEndcapHits']
     HIT_REL_COLLECTIONS = ['VXDTrackerHitRelations', 'VXDEndcapTrackerHitRelations', 'InnerTrackerBarrelHitsRelationsLCRelation', 'InnerTrackerEndcapHitsRelationsLCRelation', 'OuterTrackerBarrelHitsRelationsLCRelation', 'OuterTrackerEndcapHitsRelationsLCRelation']
+    # Pairs of track collections compared by matching their tracks on shared hits
+    TRK_COMPARISONS = [('SiTracks', 'SiTracksCT'), ('SiTracks', 'SiTracks_Refitted'), ('SiTracksCT', 'SiTracks_Refitted')]
+    MAG_FIELD = 4.0  # Tesla
     
     def __init__( self, output_path=None):
         """Constructor"""
@@ -39,24 +44,69 @@ class TrkPropsDriver( Driver ):
         
             self.histos[trk_type] = histos
     
+        for trk_a, trk_b in self.TRK_COMPARISONS:
+            histos = {}
+            prefix = '{0:s}_vs_{1:s}'.format(trk_a, trk_b)
+            name = 'trk_matched'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';Matched in {0:s};Tracks in {1:s}'.format(trk_b, trk_a), 2, 0, 2)
+            name = 'trk_shared_frac'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';Fraction of shared hits;Tracks', 110, 0, 1.1)
+            name = 'trk_dpt'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';(p_{T}^{B} - p_{T}^{A}) / p_{T}^{A};Tracks', 400, -0.2, 0.2)
+            name = 'trk_dd0'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';D0^{B} - D0^{A} [mm];Tracks', 400, -0.2, 0.2)
+            name = 'trk_dz0'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';Z0^{B} - Z0^{A} [mm];Tracks', 400, -0.2, 0.2)
+            name = 'trk_dtheta'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';#Theta^{B} - #Theta^{A} [mrad];Tracks', 400, -2, 2)
+            name = 'trk_dphi'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';#Phi^{B} - #Phi^{A} [mrad];Tracks', 400, -2, 2)
+            name = 'trk_dchi2_norm'
+            histos[name] = R.TH1I('_'.join([prefix, name]), ';Chi2/Ndf^{B} - Chi2/Ndf^{A};Tracks', 400, -2, 2)
+
+            self.histos[prefix] = histos
+
     def processEvent( self, event ):
         """Called by the event loop for each event"""
 
         # Loop over hits
         print('Event: {0:d}'.format(event.getEventNumber()))
 
+        # Reading all tracks of each collection at once
+        tracks = {}
+        hits = {}
         for trk_type in self.TRK_COLLECTIONS:
             histos = self.histos[trk_type]
             trks = event.getCollection(trk_type)
-            for iTrk in range(trks.getNumberOfElements()):
-                trk = trks.getElementAt(iTrk)
-                histos['trk_d0'].Fill(trk.getD0())
-                histos['trk_z0'].Fill(trk.getZ0())
-                histos['trk_ndf'].Fill(trk.getNdf())
-                histos['trk_chi2'].Fill(trk.getChi2())
-                histos['trk_chi2_norm'].Fill(trk.getChi2()/trk.getNdf())
-                # lv = trk.get
-                # br()
+            trk = tracks[trk_type] = read_tracks(trks, self.MAG_FIELD)
+            fill_hist(histos['trk_pt'], trk['pt'])
+            fill_hist(histos['trk_d0'], trk['d0'])
+            fill_hist(histos['trk_z0'], trk['z0'])
+            fill_hist(histos['trk_ndf'], trk['ndf'])
+            fill_hist(histos['trk_chi2'], trk['chi2'])
+            # Ignoring tracks without degrees of freedom
+            fill_hist(histos['trk_chi2_norm'], trk['chi2_norm'][trk['ndf'] > 0])
+            hits[trk_type] = read_track_hits(trks)
+
+        # Comparing the same tracks in different collections
+        for trk_a, trk_b in self.TRK_COMPARISONS:
+            histos = self.histos['{0:s}_vs_{1:s}'.format(trk_a, trk_b)]
+            trk_idx_a, hit_ids_a, n_hits_a = hits[trk_a]
+            trk_idx_b, hit_ids_b, _ = hits[trk_b]
+            idx_a, idx_b, n_shared = match_tracks(trk_idx_a, hit_ids_a, trk_idx_b, hit_ids_b)
+            matched = np.zeros(len(n_hits_a), dtype=np.float64)
+            matched[idx_a] = 1
+            fill_hist(histos['trk_matched'], matched)
+            fill_hist(histos['trk_shared_frac'], n_shared / n_hits_a[idx_a])
+            a = {name: values[idx_a] for name, values in tracks[trk_a].items()}
+            b = {name: values[idx_b] for name, values in tracks[trk_b].items()}
+            fill_hist(histos['trk_dpt'], (b['pt'] - a['pt']) / a['pt'])
+            fill_hist(histos['trk_dd0'], b['d0'] - a['d0'])
+            fill_hist(histos['trk_dz0'], b['z0'] - a['z0'])
+            fill_hist(histos['trk_dtheta'], 1e3 * (b['theta'] - a['theta']))
+            fill_hist(histos['trk_dphi'], 1e3 * ((b['phi'] - a['phi'] + np.pi) % (2*np.pi) - np.pi))
+            ndf_ok = (a['ndf'] > 0) & (b['ndf'] > 0)
+            fill_hist(histos['trk_dchi2_norm'], b['chi2_norm'][ndf_ok] - a['chi2_norm'][ndf_ok])
 
     def endOfData( self ):
         """Called by the event loop at the end of the loop"""
@@ -64,7 +114,7 @@ class TrkPropsDriver( Driver ):
         # Storing histograms to the output ROOT file
         if self.output_path is not None:
             out_file = R.TFile(self.output_path, 'RECREATE')
-            for trk_type, histos in self.histos.iteritems():
-                for hname, histo in histos.iteritems():
+            for trk_type, histos in self.histos.items():
+                for hname, histo in histos.items():
                     histo.Write()
             out_file.Close()
@@ -0,0 +1,120 @@
+import numpy as np
+
+from .utils import read_tracks
+
+
+def read_track_hits(trks):
+    """Track index and object ID of the hits of all tracks, with the number of hits per track"""
+    nTrks = trks.getNumberOfElements()
+    n_hits = np.zeros(nTrks, dtype=np.int64)
+    hit_ids = []
+    for iTrk in range(nTrks):
+        hits = trks.getElementAt(iTrk).getTrackerHits()
+        n_hits[iTrk] = len(hits)
+        for iH in range(n_hits[iTrk]):
+            hit_ids.append(hits[iH].id())
+    trk_idx = np.repeat(np.arange(nTrks), n_hits)
+    return trk_idx, np.array(hit_ids, dtype=np.int64), n_hits
+
+def read_track_params(trks, mag_field):
+    """Transverse momentum, polar and azimuthal angle of all tracks at the IP"""
+    tracks = read_tracks(trks, mag_field)
+    return tracks['pt'], tracks['theta'], tracks['phi']
+
+def read_hit_mcps(rel_cols):
+    """Unique (reco hit ID, MCParticle ID) pairs from reco -> sim hit relation collections"""
+    pairs = []
+    for rels in rel_cols:
+        for iRel in range(rels.getNumberOfElements()):
+            rel = rels.getElementAt(iRel)
+            mcp = rel.getTo().getMCParticle()
+            if mcp:
+                pairs.append((rel.getFrom().id(), mcp.id()))
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # Several SimHits of the same particle can contribute to one reco hit
+    pairs = np.unique(np.array(pairs, dtype=np.int64), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+def shared_hits(trk_idx, trk_hit_ids, rel_hit_ids, rel_mcp_ids):
+    """Sparse track x MCParticle matrix of shared hit counts as (track, MCParticle ID, count) arrays
+
+    `rel_hit_ids` must be sorted, as returned by `read_hit_mcps()`.
+    Hits without a relation to an MCParticle do not contribute to any entry.
+    """
+    lo = np.searchsorted(rel_hit_ids, trk_hit_ids, side='left')
+    n = np.searchsorted(rel_hit_ids, trk_hit_ids, side='right') - lo
+    # Expanding each track hit to all of its related MCParticles
+    hit_idx = np.repeat(np.arange(len(trk_hit_ids)), n)
+    rel_idx = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+    mcp_ids, mcp_idx = np.unique(rel_mcp_ids[rel_idx], return_inverse=True)
+    n_mcps = max(1, len(mcp_ids))
+    keys, counts = np.unique(trk_idx[hit_idx] * n_mcps + mcp_idx, return_counts=True)
+    return keys // n_mcps, mcp_ids[keys % n_mcps], counts
+
+def first_per_group(groups, *sort_keys):
+    """Indices of the first entry of each group after sorting by the keys in ascending order"""
+    order = np.lexsort(sort_keys[::-1] + (groups,))
+    groups = groups[order]
+    first = np.ones(len(groups), dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+    return order[first]
+
+def match_tracks(trk_idx_a, hit_ids_a, trk_idx_b, hit_ids_b):
+    """Track of collection B sharing most hits with each track of collection A, joined on hit IDs
+
+    Returns the matched track indices in A and B with the number of shared hits.
+    """
+    order = np.argsort(hit_ids_b, kind='stable')
+    trk_a, trk_b, counts = shared_hits(trk_idx_a, hit_ids_a, hit_ids_b[order], trk_idx_b[order])
+    best = first_per_group(trk_a, -counts)
+    return trk_a[best], trk_b[best], counts[best]
+
+
+class TruthMatch(object):
+    """Hit-based truth matching of all tracks of an event
+
+    Each track is matched to the MCParticle contributing most of its hits.
+    It is a fake if the fraction of its hits from that particle (purity) is below `purity_min`,
+    and a duplicate if another track matched to the same particle has more shared hits
+    or the same number of shared hits with a higher purity.
+    The efficiency of a match is the fraction of the particle's reco hits found on the track.
+    """
+
+    def __init__(self, trk_idx, trk_hit_ids, n_trk_hits, rel_hit_ids, rel_mcp_ids, purity_min=0.75):
+        """Builds the shared-hit matrix and classifies the tracks"""
+        nTrks = len(n_trk_hits)
+        trk, mcp, counts = shared_hits(trk_idx, trk_hit_ids, rel_hit_ids, rel_mcp_ids)
+        # Best matching MCParticle of each track
+        best = first_per_group(trk, -counts)
+        self.mcp_id = np.zeros(nTrks, dtype=np.int64)
+        self.n_shared = np.zeros(nTrks, dtype=np.int64)
+        self.mcp_id[trk[best]] = mcp[best]
+        self.n_shared[trk[best]] = counts[best]
+        self.n_hits = n_trk_hits
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.purity = np.where(n_trk_hits > 0, self.n_shared / n_trk_hits, 0.0)
+        # Number of reco hits of each MCParticle
+        mcp_ids, mcp_n_hits = np.unique(rel_mcp_ids, return_counts=True)
+        pos = np.searchsorted(mcp_ids, self.mcp_id).clip(0, max(0, len(mcp_ids) - 1))
+        n_mcp_hits = np.where(self.n_shared > 0, mcp_n_hits[pos] if len(mcp_ids) else 0, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.efficiency = np.where(n_mcp_hits > 0, self.n_shared / n_mcp_hits, 0.0)
+        self.fake = (self.purity < purity_min) | (self.n_shared == 0)
+        # The best of the good tracks of each MCParticle is the primary one
+        good = np.flatnonzero(~self.fake)
+        primary = good[first_per_group(self.mcp_id[good], -self.n_shared[good], -self.purity[good])]
+        self.duplicate = ~self.fake
+        self.duplicate[primary] = False
+        self.mcp_track = dict(zip(self.mcp_id[primary].tolist(), primary.tolist()))
+
+    def track(self, mcp):
+        """Index of the primary track matched to the MCParticle or -1"""
+        return self.mcp_track.get(mcp.id(), -1)
+
+
+def truth_match(trks, rel_cols, purity_min=0.75):
+    """Reads the tracks and hit relations of the event and returns their TruthMatch"""
+    trk_idx, trk_hit_ids, n_trk_hits = read_track_hits(trks)
+    rel_hit_ids, rel_mcp_ids = read_hit_mcps(rel_cols)
+    return TruthMatch(trk_idx, trk_hit_ids, n_trk_hits, rel_hit_ids, rel_mcp_ids, purity_min)
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def get_oldest_mcp_parent(mcp, nIters=0):
     """Recursively looks for the oldest parent of the MCParticle"""
     pars = mcp.getParents()
@@ -96,3 +99,237 @@ def pdg_to_type(pdgId):
     if pdgId == -5332:
         return 40
     return 0
+
+
+def cellid_fields(encoding):
+    """Parses a CellID encoding string into {name: (offset, width, signed)}"""
+    fields = {}
+    offset = 0
+    for field in encoding.split(','):
+        words = field.strip().split(':')
+        if len(words) == 3:
+            offset = int(words[1])
+        width = int(words[-1])
+        fields[words[0]] = (offset, abs(width), width < 0)
+        offset += abs(width)
+    return fields
+
+def decode_cellids(cellids, encoding, names=('layer',)):
+    """Decodes an array of 64-bit CellIDs into arrays of the requested fields"""
+    fields = cellid_fields(encoding)
+    cellids = np.asarray(cellids, dtype=np.uint64)
+    values = {}
+    for name in names:
+        offset, width, signed = fields[name]
+        value = ((cellids >> np.uint64(offset)) & np.uint64((1 << width) - 1)).astype(np.int64)
+        # Restoring the sign of negative values stored in two's complement
+        if signed:
+            value[value >= (1 << (width - 1))] -= (1 << width)
+        values[name] = value
+    return values
+
+def collection_weights(col):
+    """Weights of the collection elements: set for sampled collections and 1 otherwise"""
+    weights = getattr(col, 'weights', None)
+    if weights is None:
+        return np.ones(col.getNumberOfElements(), dtype=np.float64)
+    return np.asarray(weights, dtype=np.float64)
+
+def read_sim_trk_hits(col):
+    """Reads a SimTrackerHit collection into a dictionary of columnar arrays"""
+    nHits = col.getNumberOfElements()
+    hits = {
+        'cellid': np.zeros(nHits, dtype=np.uint64),
+        'x': np.zeros(nHits, dtype=np.float64),
+        'y': np.zeros(nHits, dtype=np.float64),
+        'z': np.zeros(nHits, dtype=np.float64),
+        'time': np.zeros(nHits, dtype=np.float32),
+        'edep': np.zeros(nHits, dtype=np.float32),
+        'mcp_id': np.zeros(nHits, dtype=np.int64),
+        'mcp_pdg': np.zeros(nHits, dtype=np.int32),
+        'px': np.zeros(nHits, dtype=np.float32),
+        'py': np.zeros(nHits, dtype=np.float32),
+        'pz': np.zeros(nHits, dtype=np.float32),
+    }
+    for iHit in range(nHits):
+        hit = col.getElementAt(iHit)
+        hits['cellid'][iHit] = int(hit.getCellID0() & 0xffffffff) | (int( hit.getCellID1() ) << 32)
+        pos = hit.getPosition()
+        hits['x'][iHit] = pos[0]
+        hits['y'][iHit] = pos[1]
+        hits['z'][iHit] = pos[2]
+        hits['time'][iHit] = hit.getTime()
+        hits['edep'][iHit] = hit.getEDep()
+        mom = hit.getMomentum()
+        hits['px'][iHit] = mom[0]
+        hits['py'][iHit] = mom[1]
+        hits['pz'][iHit] = mom[2]
+        mcp = hit.getMCParticle()
+        if mcp:
+            hits['mcp_id'][iHit] = mcp.id()
+            hits['mcp_pdg'][iHit] = mcp.getPDG()
+    hits['weight'] = collection_weights(col)
+    return hits
+
+def read_trk_hits(col):
+    """Reads a digitised TrackerHit collection into a dictionary of columnar arrays"""
+    nHits = col.getNumberOfElements()
+    hits = {
+        'cellid': np.zeros(nHits, dtype=np.uint64),
+        'x': np.zeros(nHits, dtype=np.float64),
+        'y': np.zeros(nHits, dtype=np.float64),
+        'z': np.zeros(nHits, dtype=np.float64),
+        'time': np.zeros(nHits, dtype=np.float32),
+        'edep': np.zeros(nHits, dtype=np.float32),
+    }
+    for iHit in range(nHits):
+        hit = col.getElementAt(iHit)
+        hits['cellid'][iHit] = int(hit.getCellID0() & 0xffffffff) | (int( hit.getCellID1() ) << 32)
+        pos = hit.getPosition()
+        hits['x'][iHit] = pos[0]
+        hits['y'][iHit] = pos[1]
+        hits['z'][iHit] = pos[2]
+        hits['time'][iHit] = hit.getTime()
+        hits['edep'][iHit] = hit.getEDep()
+    hits['weight'] = collection_weights(col)
+    return hits
+
+def read_tracks(trks, mag_field):
+    """Reads the fit quality and the parameters at the IP of all tracks into columnar arrays
+
+    Tracks without a TrackState at the IP use their own parameters, as Track.getD0() etc.
+    """
+    from pyLCIO.EVENT import TrackState
+    nTrks = trks.getNumberOfElements()
+    names = ['d0', 'z0', 'phi', 'omega', 'tan_lambda', 'chi2', 'ndf']
+    values = np.zeros((len(names), nTrks), dtype=np.float64)
+    for iTrk in range(nTrks):
+        trk = trks.getElementAt(iTrk)
+        ts = trk.getTrackState(TrackState.AtIP) or trk
+        values[:, iTrk] = (ts.getD0(), ts.getZ0(), ts.getPhi(), ts.getOmega(), ts.getTanLambda(),
+                           trk.getChi2(), trk.getNdf())
+    tracks = dict(zip(names, values))
+    tracks['ndf'] = tracks['ndf'].astype(np.int32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tracks['pt'] = 0.0003 * mag_field / np.abs(tracks['omega'])
+        tracks['chi2_norm'] = np.where(tracks['ndf'] > 0, tracks['chi2'] / tracks['ndf'], np.nan)
+    tracks['theta'] = np.pi / 2 - np.arctan(tracks['tan_lambda'])
+    return tracks
+
+def read_sim_cal_hits(col):
+    """Reads a SimCalorimeterHit collection into columnar arrays of MC contributions"""
+    nHits = col.getNumberOfElements()
+    nConts = np.zeros(nHits, dtype=np.int64)
+    conts = {'time': [], 'edep': [], 'mcp_id': [], 'mcp_pdg': []}
+    hits = {
+        'cellid': np.zeros(nHits, dtype=np.uint64),
+        'x': np.zeros(nHits, dtype=np.float64),
+        'y': np.zeros(nHits, dtype=np.float64),
+        'z': np.zeros(nHits, dtype=np.float64),
+    }
+    for iHit in range(nHits):
+        hit = col.getElementAt(iHit)
+        hits['cellid'][iHit] = int(hit.getCellID0() & 0xffffffff) | (int( hit.getCellID1() ) << 32)
+        pos = hit.getPosition()
+        hits['x'][iHit] = pos[0]
+        hits['y'][iHit] = pos[1]
+        hits['z'][iHit] = pos[2]
+        nConts[iHit] = hit.getNMCContributions()
+        for iC in range(nConts[iHit]):
+            conts['time'].append(hit.getTimeCont(iC))
+            conts['edep'].append(hit.getEnergyCont(iC))
+            mcp = hit.getParticleCont(iC)
+            conts['mcp_id'].append(mcp.id() if mcp else 0)
+            conts['mcp_pdg'].append(mcp.getPDG() if mcp else 0)
+    # Expanding the hit properties to each of its contributions
+    hit_idx = np.repeat(np.arange(nHits), nConts)
+    out = {name: values[hit_idx] for name, values in hits.items()}
+    out['hit_idx'] = hit_idx
+    out['time'] = np.array(conts['time'], dtype=np.float32)
+    out['edep'] = np.array(conts['edep'], dtype=np.float32)
+    out['mcp_id'] = np.array(conts['mcp_id'], dtype=np.int64)
+    out['mcp_pdg'] = np.array(conts['mcp_pdg'], dtype=np.int32)
+    out['weight'] = collection_weights(col)[hit_idx]
+    return out
+
+def overlay_hits(hits, bib_hits):
+    """Concatenates signal and BIB hit columns present in both, with a `bib` flag column"""
+    names = [name for name in hits if name in bib_hits]
+    merged = {name: np.concatenate([hits[name], np.asarray(bib_hits[name]).astype(hits[name].dtype)]) for name in names}
+    merged['bib'] = np.concatenate([np.zeros(len(hits['cellid']), dtype=bool), np.ones(len(bib_hits['cellid']), dtype=bool)])
+    return merged
+
+def hit_time0(x, y, z):
+    """Time of flight from the IP to the hit positions in ns"""
+    return np.sqrt(x*x + y*y + z*z) / 299.792458
+
+def scan_cuts(values, cuts, groups=None, n_groups=1, weights=None):
+    """Cumulative number and weight sum of entries with `value <= cut` for each group
+
+    Returns two arrays of shape (n_groups, len(cuts)); `cuts` must be sorted in ascending order
+    """
+    values = np.asarray(values)
+    cuts = np.asarray(cuts)
+    if groups is None:
+        groups = np.zeros(len(values), dtype=np.int64)
+    if weights is None:
+        weights = np.ones(len(values), dtype=np.float64)
+    # Sorting entries by group and then by value
+    order = np.lexsort((values, groups))
+    values = values[order]
+    groups = groups[order]
+    weights_cum = np.concatenate(([0.0], np.cumsum(weights[order], dtype=np.float64)))
+    bounds = np.searchsorted(groups, np.arange(n_groups + 1))
+    counts = np.zeros((n_groups, len(cuts)), dtype=np.int64)
+    sums = np.zeros((n_groups, len(cuts)), dtype=np.float64)
+    for iG in range(n_groups):
+        start, end = bounds[iG], bounds[iG+1]
+        idx = start + np.searchsorted(values[start:end], cuts, side='right')
+        counts[iG] = idx - start
+        sums[iG] = weights_cum[idx] - weights_cum[start]
+    return counts, sums
+
+def count_in_window(keys, times, query_keys, query_times, dt_max):
+    """Number of entries with the same key as each query and a time within `dt_max` of it
+
+    `keys` and `times` must be sorted by key and then by time, e.g. with `np.lexsort((times, keys))`.
+    """
+    counts = np.zeros(len(query_keys), dtype=np.int64)
+    lo = np.searchsorted(keys, query_keys, side='left')
+    hi = np.searchsorted(keys, query_keys, side='right')
+    for iQ in np.flatnonzero(hi > lo):
+        t = times[lo[iQ]:hi[iQ]]
+        counts[iQ] = np.searchsorted(t, query_times[iQ] + dt_max, side='right') - np.searchsorted(t, query_times[iQ] - dt_max, side='left')
+    return counts
+
+def group_min_index(values, keys):
+    """Indices of the entries with the minimum value for each unique key"""
+    order = np.lexsort((values, keys))
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return order[first]
+
+def fill_hist(histo, x, y=None, w=None):
+    """Fills a 1D or 2D histogram with arrays of values in a single call"""
+    n = len(x)
+    if n == 0:
+        return
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    if w is None:
+        w = np.ones(n, dtype=np.float64)
+    w = np.ascontiguousarray(w, dtype=np.float64)
+    if y is None:
+        histo.FillN(n, x, w)
+    else:
+        histo.FillN(n, x, np.ascontiguousarray(y, dtype=np.float64), w)
+
+def collect_histos(histos):
+    """Flat list of histograms stored in a driver's (nested) dictionary of histograms"""
+    if isinstance(histos, dict):
+        histos = list(histos.values())
+    if isinstance(histos, (list, tuple)):
+        return [h for obj in histos for h in collect_histos(obj)]
+    if hasattr(histos, 'Fill') and hasattr(histos, 'GetName'):
+        return [histos]
+    return []
@@ -0,0 +1,221 @@
+import ROOT as R
+import numpy as np
+from pyLCIO.drivers.Driver import Driver
+from pyLCIO import EVENT
+
+from pdb import set_trace as br
+from .utils import read_sim_trk_hits, decode_cellids, hit_time0, scan_cuts, fill_hist
+from .dl_pairing import hit_angles, DoubleLayerIndex, closest_partners, pass_flags, tightest_cuts, scan_grid
+
+
+class VtxDoubleLayerDriver( Driver ):
+    """Driver pairing hits between the sublayers of Vertex double layers
+
+    Fills the dR_min and closest dPhi/dTheta/dZ/dR distributions, the number of hits passing
+    the double-layer cuts, a scan of the dR_min cut and a scan of the grid of dTheta x dPhi cuts,
+    separately for signal and BIB hits.
+    """
+
+    HIT_COLLECTION_NAMES = ['VertexBarrelCollection', 'VertexEndcapCollection']
+    N_LAYER_PAIRS = 4
+    # Search window for the closest hit in the other sublayer [rad]
+    DTHETA_WINDOW = 0.05
+    DPHI_WINDOW = 0.05
+    # Double-layer cuts [rad]
+    DTHETA_MAX = 0.005
+    DPHI_MAX = 0.005
+    # Upper cuts on the dR to the closest hit used for the scan [rad]
+    DR_CUTS = [0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.02, 0.05]
+    # Grid of upper cuts on dTheta and dPhi to any hit in the other sublayer, within the search window [rad]
+    DTHETA_CUTS = [0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.02, 0.05]
+    DPHI_CUTS = [0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.02, 0.05]
+    # Hits from these MCParticles are counted as signal, everything else as BIB
+    SIGNAL_PDGS = [13, -13]
+    # Time window for hits to be considered [ns]
+    T_MIN = None
+    T_MAX = None
+    ORIGINS = ['sig', 'bib']
+    # All histograms and scans are filled per hit with the hit weights, allowing hit sampling
+    HIT_SAMPLING = True
+    # Everything per event is done in processArrays() and endOfEventArrays(), allowing shm_pipeline.py
+    PIPELINE_SAFE = True
+
+    def __init__( self, output_path=None, dtheta_max=None, dphi_max=None):
+        """Constructor"""
+        Driver.__init__(self)
+        self.histos = {}
+        self.output_path = output_path
+        if dtheta_max is not None:
+            self.DTHETA_MAX = dtheta_max
+        if dphi_max is not None:
+            self.DPHI_MAX = dphi_max
+        self.cuts = np.array(sorted(self.DR_CUTS) + [np.inf], dtype=np.float64)
+        self.dtheta_cuts = np.array(sorted(self.DTHETA_CUTS), dtype=np.float64)
+        self.dphi_cuts = np.array(sorted(self.DPHI_CUTS), dtype=np.float64)
+        self.scan = {}
+        self.grid = {}
+
+    def startOfData( self ):
+        """Called by the event loop at the beginning of the loop"""
+
+        for col in self.HIT_COLLECTION_NAMES:
+            for origin in self.ORIGINS:
+                histos = {}
+                suffix = '{0:s}_{1:s}'.format(col, origin)
+                name = 'nhits'
+                histos[name] = R.TH1F('_'.join([name, suffix]), ';Layer pair;Hits', self.N_LAYER_PAIRS, 0, self.N_LAYER_PAIRS)
+                name = 'nhits_pass'
+                histos[name] = R.TH1F('_'.join([name, suffix]), ';Layer pair;Hits passing the cuts', self.N_LAYER_PAIRS, 0, self.N_LAYER_PAIRS)
+                for pair in range(self.N_LAYER_PAIRS):
+                    suffix_pair = '{0:s}_{1:d}'.format(suffix, pair)
+                    name = 'sublayerDRmin'
+                    histos[(name, pair)] = R.TH1F('_'.join([name, suffix_pair]), ';#DeltaR_{min} [rad];Hits', 500,0,0.05)
+                    name = 'sublayerDPhi_closest'
+                    histos[(name, pair)] = R.TH1F('_'.join([name, suffix_pair]), ';#Delta#phi_{closest} [rad];Hits', 500,0,0.05)
+                    name = 'sublayerDTheta_closest'
+                    histos[(name, pair)] = R.TH1F('_'.join([name, suffix_pair]), ';#Delta#theta_{closest} [rad];Hits', 1000,0,0.01)
+                    name = 'sublayerDZ_closest'
+                    histos[(name, pair)] = R.TH1F('_'.join([name, suffix_pair]), ';#DeltaZ_{closest} [mm];Hits', 5000,0,5.0)
+                    name = 'sublayerDR_closest'
+                    histos[(name, pair)] = R.TH1F('_'.join([name, suffix_pair]), ';#DeltaR_{closest} [mm];Hits', 3000,0,3.0)
+                self.histos[(col, origin)] = histos
+                self.scan[(col, origin)] = np.zeros((self.N_LAYER_PAIRS, len(self.cuts)), dtype=np.float64)
+                self.grid[(col, origin)] = np.zeros((self.N_LAYER_PAIRS, len(self.dtheta_cuts), len(self.dphi_cuts)), dtype=np.float64)
+
+    def processArrays( self, col_name, hits, layers ):
+        """Pairs the hits of each double layer for columnar hits of one collection"""
+
+        # Selecting hits in the time window
+        if self.T_MIN is not None or self.T_MAX is not None:
+            time_mt0 = hits['time'] - hit_time0(hits['x'], hits['y'], hits['z'])
+            sel = np.ones(len(time_mt0), dtype=bool)
+            if self.T_MIN is not None:
+                sel &= time_mt0 >= self.T_MIN
+            if self.T_MAX is not None:
+                sel &= time_mt0 <= self.T_MAX
+            hits = {name: values[sel] for name, values in hits.items()}
+            layers = layers[sel]
+        theta, phi = hit_angles(hits['x'], hits['y'], hits['z'])
+        radius = np.hypot(hits['x'], hits['y'])
+        is_sig = np.isin(hits['mcp_pdg'], self.SIGNAL_PDGS)
+        weights = hits['weight']
+        pairs = layers // 2
+        dR_min = np.full(len(phi), np.inf)
+        tightest = np.full((len(phi), len(self.dtheta_cuts)), len(self.dphi_cuts), dtype=np.int64)
+        for pair in range(self.N_LAYER_PAIRS):
+            sublayers = [np.nonzero((pairs == pair) & (layers % 2 == sub))[0] for sub in (0, 1)]
+            # Matching each sublayer against the other one
+            for sub in (0, 1):
+                ids_q, ids_p = sublayers[sub], sublayers[1-sub]
+                index = DoubleLayerIndex(theta[ids_p], phi[ids_p], self.DTHETA_WINDOW, self.DPHI_WINDOW)
+                idx_q, idx_p, dtheta, dphi = index.query(theta[ids_q], phi[ids_q])
+                partner, closest = closest_partners(len(ids_q), idx_q, idx_p, dtheta, dphi)
+                flags = pass_flags(len(ids_q), idx_q, dtheta, dphi, self.DTHETA_MAX, self.DPHI_MAX)
+                dR_min[ids_q] = closest['dR']
+                tightest[ids_q] = tightest_cuts(len(ids_q), idx_q, dtheta, dphi, self.dtheta_cuts, self.dphi_cuts)
+                found = partner >= 0
+                ids_c = ids_p[partner[found]]
+                for iO, origin in enumerate(self.ORIGINS):
+                    histos = self.histos[(col_name, origin)]
+                    sel_o = is_sig[ids_q] if iO == 0 else ~is_sig[ids_q]
+                    sel_f = sel_o[found]
+                    w_o = weights[ids_q][sel_o]
+                    w_f = weights[ids_q][found][sel_f]
+                    fill_hist(histos['nhits'], np.full(sel_o.sum(), pair), w=w_o)
+                    fill_hist(histos['nhits_pass'], np.full((sel_o & flags).sum(), pair), w=weights[ids_q][sel_o & flags])
+                    fill_hist(histos[('sublayerDRmin', pair)], closest['dR'][found][sel_f], w=w_f)
+                    fill_hist(histos[('sublayerDPhi_closest', pair)], np.abs(closest['dphi'][found][sel_f]), w=w_f)
+                    fill_hist(histos[('sublayerDTheta_closest', pair)], np.abs(closest['dtheta'][found][sel_f]), w=w_f)
+                    fill_hist(histos[('sublayerDZ_closest', pair)], np.abs(hits['z'][ids_q][found][sel_f] - hits['z'][ids_c][sel_f]), w=w_f)
+                    fill_hist(histos[('sublayerDR_closest', pair)], np.abs(radius[ids_q][found][sel_f] - radius[ids_c][sel_f]), w=w_f)
+        # Scanning the dR_min cut and the dTheta x dPhi cut grid for each layer pair
+        for iO, origin in enumerate(self.ORIGINS):
+            sel = (is_sig if iO == 0 else ~is_sig) & (pairs < self.N_LAYER_PAIRS)
+            _, counts = scan_cuts(dR_min[sel], self.cuts, pairs[sel], self.N_LAYER_PAIRS, weights[sel])
+            self.scan[(col_name, origin)] += counts
+            _, counts = scan_grid(tightest[sel], len(self.dphi_cuts), pairs[sel], self.N_LAYER_PAIRS, weights[sel])
+            self.grid[(col_name, origin)] += counts
+
+    def processEvent( self, event ):
+        """Called by the event loop for each event"""
+
+        print('Event: {0:d}'.format(event.getEventNumber()))
+        for col_name in self.HIT_COLLECTION_NAMES:
+            col = event.getCollection(col_name)
+            cellIdEncoding = col.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding)
+            hits = read_sim_trk_hits(col)
+            layers = decode_cellids(hits['cellid'], cellIdEncoding, ['layer'])['layer']
+            self.processArrays(col_name, hits, layers)
+
+    def getState( self ):
+        """Accumulated scans used for checkpointing"""
+        return {'scan': self.scan, 'grid': self.grid}
+
+    def setState( self, state ):
+        """Restores the accumulated scans from a checkpoint"""
+        for key, scan in state['scan'].items():
+            self.scan[key] += scan
+        for key, grid in state.get('grid', {}).items():
+            self.grid[key] += grid
+
+    def endOfData( self ):
+        """Called by the event loop at the end of the loop"""
+
+        if self.output_path is None:
+            return
+        out_file = R.TFile(self.output_path, 'RECREATE')
+        for histos in self.histos.values():
+            for histo in histos.values():
+                histo.Write()
+        # Storing the dR_min scan as a compact table with one entry per collection, layer pair and cut
+        data = {}
+        tree = R.TTree('scan', 'Double-layer dR_min cut scan')
+        for name in ['col_id', 'layer']:
+            data[name] = np.zeros(1, dtype=np.int32)
+            tree.Branch(name, data[name], '{0:s}/I'.format(name))
+        for name in ['cut', 'n_sig', 'n_bkg', 'eff_sig', 'rej_bkg']:
+            data[name] = np.zeros(1, dtype=np.float32)
+            tree.Branch(name, data[name], '{0:s}/F'.format(name))
+        for iCol, col_name in enumerate(self.HIT_COLLECTION_NAMES):
+            scan_sig = self.scan[(col_name, 'sig')]
+            scan_bkg = self.scan[(col_name, 'bib')]
+            for pair in range(self.N_LAYER_PAIRS):
+                for iCut, cut in enumerate(self.cuts[:-1]):
+                    data['col_id'][0] = iCol
+                    data['layer'][0] = pair
+                    data['cut'][0] = cut
+                    data['n_sig'][0] = scan_sig[pair, iCut]
+                    data['n_bkg'][0] = scan_bkg[pair, iCut]
+                    data['eff_sig'][0] = float(scan_sig[pair, iCut]) / scan_sig[pair, -1] if scan_sig[pair, -1] > 0 else 0.0
+                    data['rej_bkg'][0] = 1.0 - float(scan_bkg[pair, iCut]) / scan_bkg[pair, -1] if scan_bkg[pair, -1] > 0 else 0.0
+                    tree.Fill()
+        tree.Write()
+        # Storing the dTheta x dPhi cut grid with one entry per collection, layer pair and cut combination
+        data = {}
+        tree = R.TTree('grid', 'Double-layer dTheta x dPhi cut grid')
+        for name in ['col_id', 'layer']:
+            data[name] = np.zeros(1, dtype=np.int32)
+            tree.Branch(name, data[name], '{0:s}/I'.format(name))
+        for name in ['dtheta_cut', 'dphi_cut', 'n_sig', 'n_bkg', 'eff_sig', 'rej_bkg']:
+            data[name] = np.zeros(1, dtype=np.float32)
+            tree.Branch(name, data[name], '{0:s}/F'.format(name))
+        for iCol, col_name in enumerate(self.HIT_COLLECTION_NAMES):
+            grid_sig = self.grid[(col_name, 'sig')]
+            grid_bkg = self.grid[(col_name, 'bib')]
+            # Totals from the last cut of the dR_min scan, which accepts every hit
+            total_sig = self.scan[(col_name, 'sig')][:, -1]
+            total_bkg = self.scan[(col_name, 'bib')][:, -1]
+            for pair in range(self.N_LAYER_PAIRS):
+                for iTheta, dtheta_cut in enumerate(self.dtheta_cuts):
+                    for iPhi, dphi_cut in enumerate(self.dphi_cuts):
+                        data['col_id'][0] = iCol
+                        data['layer'][0] = pair
+                        data['dtheta_cut'][0] = dtheta_cut
+                        data['dphi_cut'][0] = dphi_cut
+                        data['n_sig'][0] = grid_sig[pair, iTheta, iPhi]
+                        data['n_bkg'][0] = grid_bkg[pair, iTheta, iPhi]
+                        data['eff_sig'][0] = float(grid_sig[pair, iTheta, iPhi]) / total_sig[pair] if total_sig[pair] > 0 else 0.0
+                        data['rej_bkg'][0] = 1.0 - float(grid_bkg[pair, iTheta, iPhi]) / total_bkg[pair] if total_bkg[pair] > 0 else 0.0
+                        tree.Fill()
+        tree.Write()
+        out_file.Close()
@@ -0,0 +1,114 @@
+import ROOT as R
+import numpy as np
+from pyLCIO.drivers.Driver import Driver
+from pyLCIO import EVENT
+
+from pdb import set_trace as br
+from .utils import read_sim_trk_hits, decode_cellids, hit_time0, fill_hist
+from .pixel_digi import digitize
+
+
+class VtxPixelDriver( Driver ):
+    """Driver emulating the pixel response of the Vertex sensors to estimate their occupancy
+
+    The SimHits of each event are projected onto the sensor surface and the straight path of the
+    particle through the sensor thickness is binned onto square pixel grids of several pitches,
+    giving the cluster size of each hit, the number of hits in each fired pixel and the number
+    of fired pixels per sensor and layer.
+    """
+
+    HIT_COLLECTION_NAMES = ['VertexBarrelCollection', 'VertexEndcapCollection']
+    N_LAYERS = 8
+    # Pixel pitches [mm]
+    PITCHES = [0.025, 0.05, 0.1, 0.2]
+    # Thickness of the sensitive layer [mm]
+    SENSOR_THICKNESS = 0.05
+    # Upper limit on the path length of tracks nearly parallel to the sensor [mm]
+    MAX_CLUSTER_LENGTH = 2.0
+    # Time window for hits to be considered [ns]
+    T_MIN = None
+    T_MAX = None
+    # Everything per event is done in processArrays() and endOfEventArrays(), allowing shm_pipeline.py
+    PIPELINE_SAFE = True
+
+    def __init__( self, output_path=None):
+        """Constructor"""
+        Driver.__init__(self)
+        self.histos = {}
+        self.output_path = output_path
+
+    def startOfData( self ):
+        """Called by the event loop at the beginning of the loop"""
+
+        self.histos['nevents'] = R.TH1F('nevents', ';;Events', 1, 0, 1)
+        for col in self.HIT_COLLECTION_NAMES:
+            histos = {}
+            name = 'nhits'
+            histos[name] = R.TH1F('_'.join([name, col]), ';Layer;Hits', self.N_LAYERS, 0, self.N_LAYERS)
+            for pitch in self.PITCHES:
+                suffix = '{0:s}_{1:.0f}um'.format(col, pitch * 1000)
+                name = 'npixels'
+                histos[(name, pitch)] = R.TH1F('_'.join([name, suffix]), ';Layer;Fired pixels', self.N_LAYERS, 0, self.N_LAYERS)
+                name = 'cluster_size'
+                histos[(name, pitch)] = R.TH2F('_'.join([name, suffix]), ';Layer;Pixels per hit', self.N_LAYERS, 0, self.N_LAYERS, 50, 0, 50)
+                name = 'pixel_mult'
+                histos[(name, pitch)] = R.TH2F('_'.join([name, suffix]), ';Layer;Hits per fired pixel', self.N_LAYERS, 0, self.N_LAYERS, 20, 0, 20)
+                name = 'sensor_pixels'
+                histos[(name, pitch)] = R.TH2F('_'.join([name, suffix]), ';Layer;Fired pixels per sensor', self.N_LAYERS, 0, self.N_LAYERS, 500, 0, 5000)
+            self.histos[col] = histos
+
+    def processArrays( self, col_name, hits, layers ):
+        """Digitizes the columnar hits of one collection at each pixel pitch"""
+
+        # Selecting hits in the time window
+        if self.T_MIN is not None or self.T_MAX is not None:
+            time_mt0 = hits['time'] - hit_time0(hits['x'], hits['y'], hits['z'])
+            sel = np.ones(len(time_mt0), dtype=bool)
+            if self.T_MIN is not None:
+                sel &= time_mt0 >= self.T_MIN
+            if self.T_MAX is not None:
+                sel &= time_mt0 <= self.T_MAX
+            hits = {name: values[sel] for name, values in hits.items()}
+            layers = layers[sel]
+        histos = self.histos[col_name]
+        # Event sampling weights are applied to all the fills by the histograms themselves
+        fill_hist(histos['nhits'], layers)
+        if len(layers) == 0:
+            return
+        barrel = 'Barrel' in col_name
+        for pitch in self.PITCHES:
+            cluster_size, multiplicity, pixel_hit = digitize(hits, barrel, pitch, self.SENSOR_THICKNESS, self.MAX_CLUSTER_LENGTH)
+            pixel_layers = layers[pixel_hit]
+            fill_hist(histos[('npixels', pitch)], pixel_layers)
+            fill_hist(histos[('cluster_size', pitch)], layers, cluster_size)
+            fill_hist(histos[('pixel_mult', pitch)], pixel_layers, multiplicity)
+            # Number of fired pixels in each sensor
+            sensors, sensor_idx, sensor_pixels = np.unique(hits['cellid'][pixel_hit], return_index=True, return_counts=True)
+            fill_hist(histos[('sensor_pixels', pitch)], pixel_layers[sensor_idx], sensor_pixels)
+
+    def processEvent( self, event ):
+        """Called by the event loop for each event"""
+
+        for col_name in self.HIT_COLLECTION_NAMES:
+            col = event.getCollection(col_name)
+            cellIdEncoding = col.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding)
+            hits = read_sim_trk_hits(col)
+            layers = decode_cellids(hits['cellid'], cellIdEncoding, ['layer'])['layer']
+            self.processArrays(col_name, hits, layers)
+        self.endOfEventArrays()
+
+    def endOfEventArrays( self ):
+        """Called after the arrays of all collections of an event are processed"""
+        self.histos['nevents'].Fill(0.5)
+
+    def endOfData( self ):
+        """Called by the event loop at the end of the loop"""
+
+        if self.output_path is None:
+            return
+        out_file = R.TFile(self.output_path, 'RECREATE')
+        self.histos['nevents'].Write()
+        for col in self.HIT_COLLECTION_NAMES:
+            for histo in self.histos[col].values():
+                histo.Write()
+        out_file.Close()
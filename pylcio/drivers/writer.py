@@ -0,0 +1,179 @@
+import threading
+import queue
+import numpy as np
+import ROOT as R
+from pyLCIO import IMPL
+
+FILL_ROWS_CODE = """
+#include "TTree.h"
+#include <cstring>
+namespace muc_writer {
+// Copies each row into the branch buffers of the tree and fills it
+Long64_t fill_rows(TTree* tree, ULong64_t record, ULong64_t rows, Long64_t n, Long64_t size) {
+    Long64_t nBytes = 0;
+    for (Long64_t i = 0; i < n; ++i) {
+        std::memcpy(reinterpret_cast<char*>(record), reinterpret_cast<const char*>(rows) + i * size, size);
+        nBytes += tree->Fill();
+    }
+    return nBytes;
+}
+}
+"""
+_fill_rows = None
+
+
+def fill_rows():
+    """C++ function filling a tree with rows of a buffer without holding the GIL
+
+    Only this function releases the GIL, leaving `TTree.Fill()` of other trees unchanged.
+    """
+    global _fill_rows
+    if _fill_rows is None:
+        R.gInterpreter.Declare(FILL_ROWS_CODE)
+        _fill_rows = R.muc_writer.fill_rows
+        _fill_rows.__release_gil__ = True
+    return _fill_rows
+
+
+class AsyncWriter(object):
+    """Background thread executing output tasks in the order of submission
+
+    Tasks are passed through a bounded queue, so that the event loop blocks instead of
+    accumulating unlimited amounts of pending output.
+    The first exception raised by a task is re-raised in the main thread at the next call.
+    Objects used by the queued tasks, e.g. the tree of a TreeBuffer or an LCWriter, must not be
+    accessed from the main thread until `flush()` or `close()` returns.
+    """
+
+    def __init__(self, max_tasks=8):
+        """Constructor"""
+        # Making ROOT internals safe for writing baskets from the background thread
+        R.ROOT.EnableThreadSafety()
+        self.queue = queue.Queue(max_tasks)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='AsyncWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Executes the queued tasks until the closing marker is received"""
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                # Skipping further output after a failure
+                if self.error is None:
+                    func, args = task
+                    func(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        """Re-raises the error of a failed task in the calling thread"""
+        if self.error is not None:
+            raise RuntimeError('Output writer failed: {0!r}'.format(self.error)) from self.error
+
+    def submit(self, func, *args):
+        """Queues a call of `func(*args)`, blocking while the queue is full"""
+        self.check()
+        self.queue.put((func, args))
+
+    def flush(self):
+        """Waits until all the queued tasks are finished"""
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """Finishes the queued tasks and stops the thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+
+class TreeBuffer(object):
+    """Buffer of TTree entries filled in the event loop and written by another thread
+
+    The driver sets values through `data` exactly like single-entry branch buffers and calls
+    `fill()` instead of `TTree.Fill()`. Entries are stored as rows of a structured array,
+    which are copied into the actual branch buffers by `write()`.
+    Once `write()` is submitted to an AsyncWriter, the tree belongs to the writer thread until
+    its `flush()`, so the driver must not fill, read or write the tree meanwhile.
+    """
+
+    def __init__(self, tree, fields, size=1024):
+        """Creates branches from a list of (name, dtype, leaflist, length) tuples"""
+        self.tree = tree
+        self.dtype = np.dtype([(name, dtype, (length,)) for name, dtype, leaflist, length in fields], align=True)
+        self.record = np.zeros(1, dtype=self.dtype)
+        self.record_out = np.zeros(1, dtype=self.dtype)
+        self.data = {}
+        for name, dtype, leaflist, length in fields:
+            self.data[name] = self.record[name][0]
+            self.tree.Branch(name, self.record_out[name][0], leaflist)
+        self.rows = np.zeros(size, dtype=self.dtype)
+        self.n = 0
+        # Declaring the C++ helper in the main thread before any background write
+        self.fill_rows = fill_rows()
+
+    def fill(self):
+        """Stores the current values as a new entry"""
+        if self.n == len(self.rows):
+            self.rows = np.concatenate([self.rows, np.zeros_like(self.rows)])
+        self.rows[self.n] = self.record[0]
+        self.n += 1
+
+    def extend(self, columns, n):
+        """Stores `n` new entries at once from arrays of values of single-value branches"""
+        if self.n + n > len(self.rows):
+            size = max(2 * len(self.rows), self.n + n)
+            self.rows = np.concatenate([self.rows, np.zeros(size - len(self.rows), dtype=self.dtype)])
+        rows = self.rows[self.n:self.n + n]
+        for name, values in columns.items():
+            rows[name][:, 0] = values
+        self.n += n
+
+    def take(self):
+        """Returns the stored entries and starts a new set"""
+        rows = self.rows[:self.n]
+        self.rows = np.zeros(len(self.rows), dtype=self.dtype)
+        self.n = 0
+        return rows
+
+    def write(self, rows):
+        """Fills the TTree with the stored entries"""
+        rows = np.ascontiguousarray(rows)
+        self.fill_rows(self.tree, self.record_out.ctypes.data, rows.ctypes.data, len(rows), self.dtype.itemsize)
+
+
+def copy_mcp(mcp):
+    """Creates an independent copy of the MCParticle without relations"""
+    mcp_new = IMPL.MCParticleImpl()
+    mcp_new.setPDG(mcp.getPDG())
+    mcp_new.setGeneratorStatus(mcp.getGeneratorStatus())
+    mcp_new.setSimulatorStatus(mcp.getSimulatorStatus())
+    mcp_new.setVertex(mcp.getVertex())
+    mcp_new.setEndpoint(mcp.getEndpoint())
+    mcp_new.setMomentum(mcp.getMomentum())
+    mcp_new.setMass(mcp.getMass())
+    mcp_new.setCharge(mcp.getCharge())
+    mcp_new.setTime(mcp.getTime())
+    return mcp_new
+
+def copy_sim_trk_hit(hit, mcp=None):
+    """Creates an independent copy of the SimTrackerHit pointing to the given MCParticle"""
+    hit_new = IMPL.SimTrackerHitImpl()
+    hit_new.setCellID0(hit.getCellID0())
+    hit_new.setCellID1(hit.getCellID1())
+    hit_new.setPosition(hit.getPosition())
+    hit_new.setMomentum(hit.getMomentum())
+    hit_new.setEDep(hit.getEDep())
+    hit_new.setTime(hit.getTime())
+    hit_new.setPathLength(hit.getPathLength())
+    hit_new.setQuality(hit.getQuality())
+    if mcp is not None:
+        hit_new.setMCParticle(mcp)
+    return hit_new
@@ -0,0 +1,212 @@
+import os
+import sys
+import glob
+import json
+import pickle
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import ROOT as R
+
+from checkpoint import write_atomic
+from merge import merge_files
+from drivers.utils import collect_histos
+
+MANIFEST_FILE = 'manifest.json'
+DRIVERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'drivers')
+
+
+def parts_dir(output_path):
+    """Directory holding the per-file partial outputs of the job writing to `output_path`"""
+    return output_path + '.parts'
+
+def file_hash(path, block_size=1 << 24):
+    """SHA-256 of the file content"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def code_version():
+    """Hash of the source code of all drivers and their helpers"""
+    sha = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(DRIVERS_DIR, '*.py'))):
+        with open(path, 'rb') as f:
+            sha.update(os.path.basename(path).encode())
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def driver_config(driver_class, options=None):
+    """Class name and configuration constants of the driver with extra job options"""
+    params = {}
+    for name in dir(driver_class):
+        if name.isupper():
+            params[name] = repr(getattr(driver_class, name))
+    if options:
+        params.update({key: repr(value) for key, value in options.items()})
+    return {
+        'driver': '{0:s}.{1:s}'.format(driver_class.__module__, driver_class.__name__),
+        'params': params,
+        'version': code_version(),
+    }
+
+
+class Manifest(object):
+    """Record of the per-file partial outputs and of the inputs they were produced from
+
+    An entry is valid only if the content hash of the input file and the driver configuration
+    are the same as those of the current job.
+    Content hashes are recomputed only for files with a changed size or modification time.
+    """
+
+    def __init__(self, path, config):
+        """Loads the manifest from the parts directory"""
+        self.path = path
+        self.config = config
+        self.entries = {}
+        info_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.isfile(info_path):
+            with open(info_path) as f:
+                self.entries = json.load(f)['entries']
+
+    def input_hash(self, input_path):
+        """Content hash of the input file, reusing the stored one for unmodified files"""
+        stat = os.stat(input_path)
+        entry = self.entries.get(os.path.abspath(input_path))
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['hash']
+        return file_hash(input_path)
+
+    def part_name(self, input_hash):
+        """Name of the partial output for the input file content and current configuration"""
+        key = json.dumps([input_hash, self.config], sort_keys=True)
+        return 'part_{0:s}.root'.format(hashlib.sha256(key.encode()).hexdigest()[:20])
+
+    def is_valid(self, input_path, input_hash):
+        """Whether an up-to-date partial output exists for the input file"""
+        entry = self.entries.get(os.path.abspath(input_path))
+        if not entry or entry['hash'] != input_hash or entry['config'] != self.config:
+            return False
+        return os.path.isfile(os.path.join(self.path, entry['output']))
+
+    def update(self, input_path, input_hash, output, state):
+        """Records the partial output of the input file"""
+        stat = os.stat(input_path)
+        self.entries[os.path.abspath(input_path)] = {
+            'hash': input_hash,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'config': self.config,
+            'output': output,
+            'state': state,
+        }
+
+    def save(self):
+        """Writes the manifest replacing the previous one only when complete"""
+        def write_info(path):
+            with open(path, 'w') as f:
+                json.dump({'entries': self.entries}, f, indent=1)
+        write_atomic(os.path.join(self.path, MANIFEST_FILE), write_info)
+
+    def remove_unused(self):
+        """Deletes partial outputs that are not referenced by any entry"""
+        used = set()
+        for entry in self.entries.values():
+            used.update([entry['output'], entry['state']])
+        for path in glob.glob(os.path.join(self.path, 'part_*')):
+            if os.path.basename(path) not in used:
+                os.remove(path)
+
+
+def process_file(input_path, output_path, state_path, args):
+    """Runs the driver over a single input file in a separate process"""
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py'),
+           input_path, '-o', output_path, '--save_state', state_path] + args
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode != 0:
+        print(result.stdout)
+        raise RuntimeError('Processing of {0:s} failed with code {1:d}'.format(input_path, result.returncode))
+
+def merge_partials(driver, parts):
+    """Fills the driver with the partial outputs and writes its final output
+
+    Histograms are added, TTree entries are copied in the order of the parts and the
+    accumulated state is restored through `setState()`, so that the driver's own `endOfData()`
+    produces the same output as a single pass over all the inputs.
+    Histograms stored as doubles by sampled runs are merged into double-precision copies.
+    """
+    driver.startOfData()
+    histos = getattr(driver, 'histos', {})
+    if parts:
+        # Partial outputs of sampled runs store integer histograms as doubles
+        with R.TDirectory.TContext():
+            part_file = R.TFile(parts[0][0])
+            doubled = set()
+            for histo in collect_histos(histos):
+                histo_part = part_file.Get(histo.GetName())
+                if histo_part and histo_part.ClassName() != histo.ClassName() and histo_part.ClassName()[-1] == 'D':
+                    doubled.add(histo.GetName())
+            part_file.Close()
+        if doubled:
+            from sampling import double_histo, replace_histos
+            replace_histos(histos, lambda histo: double_histo(histo) if histo.GetName() in doubled else histo)
+    tree = getattr(driver, 'tree', None)
+    for output_path, state_path in parts:
+        with R.TDirectory.TContext():
+            part_file = R.TFile(output_path)
+            for histo in collect_histos(histos):
+                histo_part = part_file.Get(histo.GetName())
+                if histo_part:
+                    histo.Add(histo_part)
+            if tree is not None:
+                tree_part = part_file.Get(tree.GetName())
+                if tree_part:
+                    tree.CopyEntries(tree_part, -1, '', True)
+            part_file.Close()
+        if state_path and hasattr(driver, 'setState') and os.path.isfile(state_path):
+            with open(state_path, 'rb') as f:
+                driver.setState(pickle.load(f))
+    driver.endOfData()
+
+def run_incremental(driver_class, inputs, output_path, args=None, options=None, force=False, n_jobs=1, driver_kwargs=None):
+    """Processes only new or changed input files and merges all partial outputs
+
+    `args` are passed to the per-file jobs and `options` are included in the configuration key.
+    `driver_kwargs` are the constructor arguments of the driver merging the accumulated states.
+    """
+    path = parts_dir(output_path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    manifest = Manifest(path, driver_config(driver_class, options))
+    # Finding the inputs without a valid partial output
+    hashes = {}
+    stale = []
+    for input_path in inputs:
+        hashes[input_path] = manifest.input_hash(input_path)
+        if force or not manifest.is_valid(input_path, hashes[input_path]):
+            stale.append(input_path)
+    print('### {0:d} of {1:d} input files need processing'.format(len(stale), len(inputs)))
+    def process(input_path):
+        output = manifest.part_name(hashes[input_path])
+        state = output.replace('.root', '.pkl')
+        process_file(input_path, os.path.join(path, output), os.path.join(path, state), args or [])
+        return output, state
+    with ThreadPoolExecutor(max(1, n_jobs)) as pool:
+        for input_path, (output, state) in zip(stale, pool.map(process, stale)):
+            print('  processed: {0:s}'.format(input_path))
+            manifest.update(input_path, hashes[input_path], output, state)
+            manifest.save()
+    manifest.remove_unused()
+    # Merging the partial outputs in the order of the inputs
+    parts = []
+    for input_path in inputs:
+        entry = manifest.entries[os.path.abspath(input_path)]
+        parts.append((os.path.join(path, entry['output']), os.path.join(path, entry['state'])))
+    print('### Merging {0:d} partial outputs into: {1:s}'.format(len(parts), output_path))
+    if hasattr(driver_class, 'setState'):
+        # Letting the driver compute its output from the accumulated state
+        merge_partials(driver_class(output_path, **(driver_kwargs or {})), parts)
+    else:
+        merge_files([output for output, _ in parts], output_path, max(1, n_jobs))
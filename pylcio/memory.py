@@ -0,0 +1,119 @@
+import os
+import gc
+import json
+import time
+from collections import Counter
+
+import numpy as np
+from pyLCIO.drivers.Driver import Driver
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_mb():
+    """Resident memory of the current process [MB]"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 1024.0**2
+
+def type_counts():
+    """Number of live Python objects of each type, including PyROOT proxies"""
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+def attribute_sizes(driver):
+    """Sizes of the container and array attributes of the driver"""
+    sizes = {}
+    for name, value in vars(driver).items():
+        if isinstance(value, np.ndarray):
+            sizes[name] = value.nbytes
+        elif isinstance(value, (list, dict, set, tuple)):
+            sizes[name] = len(value)
+    return sizes
+
+def growth(current, reference, n_max=20):
+    """Largest positive differences between two {name: size} dictionaries"""
+    diff = [(name, current[name] - reference.get(name, 0)) for name in current]
+    diff = sorted([d for d in diff if d[1] > 0], key=lambda d: -d[1])
+    return diff[:n_max]
+
+
+class MemoryGuardDriver( Driver ):
+    """Driver releasing per-event objects and watching the resident memory of the job
+
+    At the end of each event it runs the garbage collector, so that PyROOT proxies of the
+    event are freed deterministically.
+    When the memory exceeds `max_rss_mb` or grows by more than `max_growth_mb` after the first
+    `n_warmup` events, a report of the object types and driver attributes that grew since the
+    warm-up is written to `report_path` and the optional `on_exceed()` callback is called.
+    """
+
+    def __init__( self, drivers, max_rss_mb=None, max_growth_mb=None, report_path=None,
+                  n_warmup=10, gc_every=1, on_exceed=None ):
+        """Constructor"""
+        Driver.__init__(self)
+        self.drivers = drivers
+        self.max_rss_mb = max_rss_mb
+        self.max_growth_mb = max_growth_mb
+        self.report_path = report_path
+        self.n_warmup = n_warmup
+        self.gc_every = gc_every
+        self.on_exceed = on_exceed
+        self.nEvents = 0
+        self.rss_ref = None
+        self.rss_reported = None
+        self.types_ref = None
+        self.attrs_ref = None
+        self.history = []
+
+    def release( self ):
+        """Releases the objects of the current event"""
+        if self.gc_every and self.nEvents % self.gc_every == 0:
+            gc.collect()
+
+    def exceeded( self, rss ):
+        """Whether the memory is above the budget or has grown too much since the warm-up"""
+        if self.max_rss_mb and rss > self.max_rss_mb:
+            return True
+        if self.max_growth_mb and rss - self.rss_ref > self.max_growth_mb:
+            return True
+        return False
+
+    def report( self, rss ):
+        """Writes the objects and driver attributes accumulated since the warm-up"""
+        types = type_counts()
+        report = {
+            'time': time.time(),
+            'events': self.nEvents,
+            'rss_mb': rss,
+            'rss_warmup_mb': self.rss_ref,
+            'history': self.history[-100:],
+            'types': growth(types, self.types_ref),
+            'drivers': {},
+        }
+        for driver, attrs_ref in zip(self.drivers, self.attrs_ref):
+            report['drivers'][type(driver).__name__] = growth(attribute_sizes(driver), attrs_ref)
+        print('### WARNING: memory at {0:.0f} MB after {1:d} events, growing types: {2:s}'.format(
+            rss, self.nEvents, ', '.join('{0:s} +{1:d}'.format(*t) for t in report['types'][:5])))
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump(report, f, indent=1)
+
+    def processEvent( self, event ):
+        """Called by the event loop for each event"""
+        self.nEvents += 1
+        self.release()
+        rss = rss_mb()
+        if self.nEvents == self.n_warmup:
+            # Reference state after caches and buffers were filled by the first events
+            self.rss_ref = rss
+            self.types_ref = type_counts()
+            self.attrs_ref = [attribute_sizes(driver) for driver in self.drivers]
+        if self.nEvents % 100 == 0:
+            self.history.append((self.nEvents, rss))
+        if self.rss_ref is None or not self.exceeded(rss):
+            return
+        # Reporting again only after 10% of additional growth
+        if self.rss_reported is None or rss > 1.1 * self.rss_reported:
+            self.rss_reported = rss
+            self.report(rss)
+            if self.on_exceed is not None:
+                self.on_exceed()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import ROOT as R
+
+
+def object_schema(obj):
+    """Description of an object that must be identical for merging: binning or TTree branches"""
+    if obj.InheritsFrom('TH1'):
+        axes = [obj.GetXaxis(), obj.GetYaxis(), obj.GetZaxis()][:obj.GetDimension()]
+        binning = []
+        for axis in axes:
+            if axis.IsVariableBinSize():
+                binning.append([axis.GetBinLowEdge(iB) for iB in range(1, axis.GetNbins() + 2)])
+            else:
+                binning.append([axis.GetNbins(), axis.GetXmin(), axis.GetXmax()])
+        return [obj.ClassName(), binning]
+    if obj.InheritsFrom('TTree'):
+        return [obj.ClassName(), [(br.GetName(), br.GetTitle()) for br in obj.GetListOfBranches()]]
+    return [obj.ClassName()]
+
+def file_schema(path):
+    """Schemas of all objects in the file keyed by their path"""
+    schema = {}
+    in_file = R.TFile.Open(path)
+    if not in_file or in_file.IsZombie():
+        raise IOError('Cannot open {0:s}'.format(path))
+    def walk(directory, prefix):
+        for key in directory.GetListOfKeys():
+            name = prefix + key.GetName()
+            # Using only the highest cycle of each key
+            if name in schema:
+                continue
+            if R.TClass.GetClass(key.GetClassName()).InheritsFrom('TDirectory'):
+                schema[name] = ['TDirectory']
+                walk(key.ReadObj(), name + '/')
+            else:
+                # Objects are owned by the file and deleted when it is closed
+                schema[name] = object_schema(key.ReadObj())
+    walk(in_file, '')
+    in_file.Close()
+    return schema
+
+def check_schemas(paths, pool):
+    """Raises a ValueError if any file has different objects, binning or branches than the first one"""
+    schemas = pool.map(file_schema, paths, chunksize=16)
+    ref = None
+    for path, schema in zip(paths, schemas):
+        if ref is None:
+            ref = schema
+            continue
+        if schema == ref:
+            continue
+        names = sorted(set(ref) ^ set(schema)) or sorted(name for name in ref if ref[name] != schema[name])
+        raise ValueError('{0:s} differs from {1:s} in: {2:s}'.format(path, paths[0], ', '.join(names[:10])))
+
+def merge_group(paths, output, fast=True, max_open=64):
+    """Merges the files with TFileMerger: histograms are added and trees are fast-cloned"""
+    merger = R.TFileMerger(False, False)
+    merger.SetPrintLevel(0)
+    merger.SetFastMethod(fast)
+    merger.SetMaxOpenedFiles(max_open)
+    if not merger.OutputFile(output, 'RECREATE'):
+        raise IOError('Cannot create {0:s}'.format(output))
+    for path in paths:
+        if not merger.AddFile(path, False):
+            raise IOError('Cannot open {0:s}'.format(path))
+    if not merger.Merge():
+        raise RuntimeError('Merging into {0:s} failed'.format(output))
+    return output
+
+def merge_files(paths, output, n_jobs=4, group_size=32, check=True, fast=True):
+    """Merges the files by a parallel tree-reduction in groups of `group_size` files
+
+    Groups are contiguous, so the order of TTree entries follows the order of the inputs.
+    At most `n_jobs` groups are merged at a time, which bounds the memory and open files.
+    """
+    if not paths:
+        raise ValueError('No input files to merge into {0:s}'.format(output))
+    if group_size < 2:
+        raise ValueError('Groups must have at least 2 files, got {0:d}'.format(group_size))
+    tmp_dir = output + '.merge_tmp'
+    with ProcessPoolExecutor(n_jobs) as pool:
+        if check:
+            check_schemas(paths, pool)
+        level = 0
+        inputs = list(paths)
+        while True:
+            groups = [inputs[i:i + group_size] for i in range(0, len(inputs), group_size)]
+            if len(groups) == 1:
+                outputs = [output]
+            else:
+                if not os.path.isdir(tmp_dir):
+                    os.makedirs(tmp_dir)
+                outputs = [os.path.join(tmp_dir, 'l{0:d}_{1:05d}.root'.format(level, iG)) for iG in range(len(groups))]
+            print('### Merging {0:d} files into {1:d}'.format(len(inputs), len(outputs)))
+            list(pool.map(merge_group, groups, outputs, [fast] * len(groups)))
+            # Removing intermediate files of the previous level
+            if level > 0:
+                for path in inputs:
+                    os.remove(path)
+            if len(outputs) == 1:
+                break
+            inputs = outputs
+            level += 1
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge driver outputs of many jobs')
+    parser.add_argument('input', metavar='input.root', type=str, help='List of input files', nargs='+')
+    parser.add_argument('-o', dest='output', metavar='OUT.root', type=str, help='Path to the merged ROOT file', required=True)
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, help='Number of parallel merging processes', default=4)
+    parser.add_argument('-g', '--group_size', metavar='N', type=int, help='Number of files merged by one process', default=32)
+    parser.add_argument('--no_check', action='store_true', help='Skip the check of objects, binning and branches')
+    parser.add_argument('--slow', action='store_true', help='Re-compress the TTree baskets instead of fast cloning')
+    opts = parser.parse_args()
+    try:
+        merge_files(opts.input, opts.output, opts.jobs, opts.group_size, not opts.no_check, not opts.slow)
+    except ValueError as e:
+        parser.error(str(e))
+    print('### Finished: {0:s}'.format(opts.output))
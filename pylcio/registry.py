@@ -0,0 +1,145 @@
+import os
+import ast
+import importlib
+
+DRIVERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'drivers')
+DEFAULT_DRIVER = 'TrkHitsMCPDriver'
+
+
+class DriverInfo(object):
+    """Description of a driver class found in the source code without importing it"""
+
+    def __init__(self, module, name, doc, args, constants):
+        self.module = module
+        self.name = name
+        self.doc = doc
+        self.args = args
+        self.constants = constants
+
+    def aliases(self):
+        """Lower-case names under which the driver can be selected"""
+        names = [self.name.lower(), self.module.lower()]
+        if self.name.endswith('Driver'):
+            names.append(self.name[:-len('Driver')].lower())
+        return names
+
+
+def class_info(module, node):
+    """Constructor arguments and configuration constants of a class definition"""
+    args = []
+    constants = []
+    for item in node.body:
+        if isinstance(item, ast.FunctionDef) and item.name == '__init__':
+            # Skipping `self` and the output path
+            args = [arg.arg for arg in item.args.args[2:]]
+        elif isinstance(item, ast.Assign):
+            constants += [t.id for t in item.targets if isinstance(t, ast.Name) and t.id.isupper()]
+    doc = (ast.get_docstring(node) or '').split('\n')[0]
+    return DriverInfo(module, node.name, doc, args, constants)
+
+def find_drivers(path=DRIVERS_DIR):
+    """Driver classes defined in the modules of the folder, parsed without executing them"""
+    drivers = []
+    for file_name in sorted(os.listdir(path)):
+        if not file_name.endswith('.py') or file_name.startswith('_'):
+            continue
+        with open(os.path.join(path, file_name)) as f:
+            tree = ast.parse(f.read(), file_name)
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                continue
+            bases = [b.id if isinstance(b, ast.Name) else getattr(b, 'attr', None) for b in node.bases]
+            if 'Driver' in bases:
+                drivers.append(class_info(file_name[:-3], node))
+    return drivers
+
+def split_params(text):
+    """Splits `key=value,...` at commas outside of brackets and quotes"""
+    parts = ['']
+    depth = 0
+    quote = None
+    for char in text:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in '\'"':
+            quote = char
+        elif char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append('')
+            continue
+        parts[-1] += char
+    return [p for p in parts if p.strip()]
+
+def parse_value(text):
+    """Python literal of the value or the plain string if it is not a literal"""
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+def parse_driver_spec(spec):
+    """Splits `name[:key=value,...]` into the driver name and a dictionary of parameters"""
+    name, _, text = spec.partition(':')
+    params = {}
+    for part in split_params(text):
+        key, sep, value = part.partition('=')
+        if not sep:
+            raise ValueError('Driver parameter `{0:s}` is not in the form key=value'.format(part))
+        params[key.strip()] = parse_value(value.strip())
+    return name.strip(), params
+
+def find_driver(name, drivers=None):
+    """Driver matching the class name, the class name without `Driver` or the module name"""
+    if drivers is None:
+        drivers = find_drivers()
+    matches = [d for d in drivers if name.lower() in d.aliases()]
+    if len(matches) != 1:
+        names = ', '.join(d.name for d in drivers)
+        reason = 'Unknown' if not matches else 'Ambiguous'
+        raise ValueError('{0:s} driver `{1:s}`, available: {2:s}'.format(reason, name, names))
+    return matches[0]
+
+def resolve(spec, drivers=None):
+    """Driver description, constructor arguments and class constants of the `-d` option
+
+    Lower-case keys are passed as constructor arguments and upper-case keys override the
+    configuration constants of the class, e.g. `vtx_dl_pairs:dtheta_max=0.01,T_MAX=0.5`.
+    """
+    name, params = parse_driver_spec(spec)
+    info = find_driver(name, drivers)
+    kwargs = {}
+    constants = {}
+    for key, value in params.items():
+        if key in info.args:
+            kwargs[key] = value
+        elif key in info.constants:
+            constants[key] = value
+        else:
+            raise ValueError('{0:s} has no parameter `{1:s}`, available: {2:s}'.format(
+                info.name, key, ', '.join(info.args + info.constants)))
+    return info, kwargs, constants
+
+def load_driver(info, constants=None):
+    """Imports the driver class, subclassing it with the overridden class constants"""
+    module = importlib.import_module('drivers.' + info.module)
+    driver_class = getattr(module, info.name)
+    if constants:
+        attrs = dict(constants, __module__=driver_class.__module__, __doc__=driver_class.__doc__)
+        driver_class = type(info.name, (driver_class,), attrs)
+    return driver_class
+
+def list_drivers(drivers=None):
+    """Human-readable table of the available drivers"""
+    if drivers is None:
+        drivers = find_drivers()
+    lines = []
+    for d in drivers:
+        lines.append('{0:<24s} {1:<20s} {2:s}'.format(d.name, d.module, d.doc))
+        if d.args:
+            lines.append('{0:<45s} arguments: {1:s}'.format('', ', '.join(d.args)))
+        if d.constants:
+            lines.append('{0:<45s} constants: {1:s}'.format('', ', '.join(d.constants)))
+    return '\n'.join(lines)
@@ -1,34 +1,124 @@
+import os
 import argparse
 
+import registry
+
 parser = argparse.ArgumentParser(description='Process hits from a file')
-parser.add_argument('input', metavar='input.root', type=str, help='List of input files', nargs="+")
+parser.add_argument('input', metavar='input.root', type=str, help='List of input files', nargs="*")
+parser.add_argument('-d', '--driver', metavar='NAME[:KEY=VALUE,...]', type=str, help='Driver to run with its constructor arguments or class constants (default: {0:s})'.format(registry.DEFAULT_DRIVER), default=registry.DEFAULT_DRIVER)
+parser.add_argument('--list-drivers', dest='list_drivers', action='store_true', help='List the available drivers and their parameters')
 parser.add_argument('-m', '--max_events', metavar='N', type=int, help='Maximum number of events to process', default=-1)
 parser.add_argument('-o', dest='output', metavar='OUT.root', type=str, help='Path to the output ROOT file')
 parser.add_argument('-s', '--skip_events', metavar='N', type=int, help='Number of events to skip', default=0)
+parser.add_argument('--checkpoint_events', metavar='N', type=int, help='Save a checkpoint every N events', default=None)
+parser.add_argument('--checkpoint_minutes', metavar='T', type=float, help='Save a checkpoint every T minutes', default=None)
+parser.add_argument('--resume', action='store_true', help='Continue from the last checkpoint of the same output file')
+parser.add_argument('--sample_events', metavar='F', type=float, help='Fraction of randomly selected events to process', default=1.0)
+parser.add_argument('--sample_hits', metavar='F', type=float, help='Fraction of randomly selected hits to process in each collection', default=1.0)
+parser.add_argument('--sample_strata', metavar='COL[:LAYER]=F,...', type=str, help='Hit fractions for individual collections or layers', default=None)
+parser.add_argument('--sample_seed', metavar='N', type=int, help='Seed of the random sampling', default=0)
+parser.add_argument('--catalog', metavar='CATALOG.npz', type=str, help='Event summary catalog written by skim.py', default=None)
+parser.add_argument('--select', metavar='EXPR', type=str, help='Process only the catalog events passing the expression, e.g. "nmcp == 1"', default=None)
+parser.add_argument('--incremental', action='store_true', help='Process only new or changed input files and merge with the stored per-file outputs')
+parser.add_argument('--force', action='store_true', help='Reprocess all input files in the incremental mode')
+parser.add_argument('-j', '--jobs', metavar='N', type=int, help='Number of input files processed in parallel in the incremental mode', default=1)
+parser.add_argument('--max_rss_mb', metavar='MB', type=float, help='Memory budget: report accumulating objects when exceeded', default=None)
+parser.add_argument('--max_growth_mb', metavar='MB', type=float, help='Report accumulating objects when memory grows by this much after the first events', default=None)
+parser.add_argument('--recycle_events', metavar='N', type=int, help='Restart the processing in a new process every N events using checkpoints', default=None)
+parser.add_argument('--save_state', metavar='STATE.pkl', type=str, help=argparse.SUPPRESS, default=None)
+parser.add_argument('--stop_after', metavar='N', type=int, help=argparse.SUPPRESS, default=None)
 
 opts = parser.parse_args()
 
+if opts.list_drivers:
+	print(registry.list_drivers())
+	exit()
+
+# Validating the arguments before the slow imports of ROOT and pyLCIO
+if not opts.input and not opts.catalog:
+	parser.error('at least one input file is required')
+if bool(opts.select) != bool(opts.catalog):
+	parser.error('--select and --catalog must be used together')
+if opts.select and opts.incremental:
+	parser.error('--incremental cannot be combined with an event selection')
+if not opts.output:
+	parser.error('the output path is required: -o OUT.root')
+missing = [path for path in opts.input if not os.path.isfile(path)]
+if missing:
+	parser.error('input files not found: {0:s}'.format(', '.join(missing)))
+try:
+	driver_info, driver_kwargs, driver_constants = registry.resolve(opts.driver)
+except ValueError as e:
+	parser.error(str(e))
+
+# Reading only the events selected from the catalog
+events = None
+if opts.select:
+	from skim import selected_events
+	if not os.path.isfile(opts.catalog):
+		parser.error('catalog not found: {0:s}'.format(opts.catalog))
+	try:
+		events = selected_events(opts.catalog, opts.select)
+	except (SyntaxError, NameError, TypeError, ValueError) as e:
+		parser.error('invalid selection `{0:s}`: {1:s}'.format(opts.select, str(e)))
+	if opts.input:
+		inputs = set(os.path.abspath(path) for path in opts.input)
+		events = [e for e in events if e[0] in inputs]
+	else:
+		opts.input = list(dict.fromkeys(e[0] for e in events))
+
 from pyLCIO.io.EventLoop import EventLoop
-# from drivers.hits_timing import HitsTimingDriver as TheDriver
-# from drivers.trk_props import TrkPropsDriver as TheDriver
-# from drivers.trk_hit_props import TrkHitPropsDriver as TheDriver
-# from drivers.hit_props import HitPropsDriver as TheDriver
-# from drivers.pfo_props import PfoPropsDriver as TheDriver
-# from drivers.vtx_hit_props import VtxHitPropsDriver as TheDriver
-# from drivers.trk_efficiency import TrkEfficiencyDriver as TheDriver
-# from drivers.trk_hit_density import HitDensityDriver as TheDriver
-from drivers.trk_hits_mcp import TrkHitsMCPDriver as TheDriver
-# from drivers.trk_hit_loopers import TrkHitLoopersDriver as TheDriver
-# from drivers.cal_hits_mcp import CalHitsMCPDriver as TheDriver
-
-
-
-print('### Starting analysis with {0:d} input files:'.format(len(opts.input)))
-
-evLoop = EventLoop()
-for infile in opts.input:
-    print('  {0:s}'.format(infile))
-    evLoop.addFile(infile)
+TheDriver = registry.load_driver(driver_info, driver_constants)
+
+# Reusing per-file outputs of previous runs with the same driver configuration
+if opts.incremental:
+	if opts.skip_events or opts.max_events > 0 or opts.checkpoint_events or opts.checkpoint_minutes or opts.resume:
+		parser.error('--incremental processes whole files and cannot be combined with event ranges or checkpoints')
+	from manifest import run_incremental
+	sampling = {'sample_events': opts.sample_events, 'sample_hits': opts.sample_hits,
+	            'sample_strata': opts.sample_strata, 'sample_seed': opts.sample_seed}
+	args = ['-d', opts.driver]
+	for key, value in sampling.items():
+		if value is not None:
+			args += ['--' + key, str(value)]
+	options = dict(sampling, driver_args=driver_kwargs)
+	run_incremental(TheDriver, opts.input, opts.output, args, options, opts.force, opts.jobs, driver_kwargs)
+	print('### Finished')
+	exit()
+
+# Running the job in a sequence of processes continuing from each other's checkpoints
+if opts.recycle_events:
+	import sys, subprocess
+	from checkpoint import RECYCLE_EXIT_CODE
+	args = []
+	argv = iter(sys.argv[1:])
+	for arg in argv:
+		if arg == '--recycle_events':
+			next(argv)
+		elif not arg.startswith('--recycle_events='):
+			args.append(arg)
+	args += ['--stop_after', str(opts.recycle_events), '--resume']
+	while True:
+		code = subprocess.call([sys.executable, os.path.abspath(__file__)] + args)
+		if code != RECYCLE_EXIT_CODE:
+			break
+		print('### Continuing in a new process')
+	sys.exit(code)
+
+
+print('### Running {0:s} over {1:d} input files:'.format(TheDriver.__name__, len(opts.input)))
+
+if events is not None:
+	from skim import SelectedEventLoop
+	evLoop = SelectedEventLoop(events)
+	for infile in opts.input:
+		print('  {0:s}'.format(infile))
+	print('### Selected {0:d} events with: {1:s}'.format(len(events), opts.select))
+else:
+	evLoop = EventLoop()
+	for infile in opts.input:
+		print('  {0:s}'.format(infile))
+		evLoop.addFile(infile)
 # evLoop.addFile('/home/bartosik/clic/test3_py/v2.slcio')
 # evLoop.addFile('/home/bartosik/clic/out/digi_bkg_QGSP_BERT_HP/c0_25ns_nEkin150MeV/sim_mod1_mumi-1e3x500-26m-lowth-excl_j1.slcio')
 # evLoop.addFile('/home/bartosik/clic/out/digi_bkg_QGSP_BERT_HP/c0_25ns_nEkin150MeV/sim_mod1_mumi-1e3x500-26m-lowth-excl_j2.slcio')
@@ -42,18 +132,73 @@ for infile in opts.input:
 print('### Will store output in: {0:s}'.format(opts.output))
 nEvents = evLoop.reader.getNumberOfEvents()
 print('### Total number of events in the files: {0:d}'.format(nEvents))
-driver = TheDriver(opts.output)
-evLoop.add(driver)
+driver = TheDriver(opts.output, **driver_kwargs)
+# Processing a random sample of events and hits with the corresponding weights
+if opts.sample_events < 1.0 or opts.sample_hits < 1.0 or opts.sample_strata:
+	from sampling import Sampler, SamplingDriver, parse_strata
+	sampler = Sampler(opts.sample_events, opts.sample_hits, parse_strata(opts.sample_strata), opts.sample_seed)
+	print('### Sampling {0:g} of events and {1:g} of hits with seed {2:d}'.format(opts.sample_events, opts.sample_hits, opts.sample_seed))
+	try:
+		evLoop.add(SamplingDriver(driver, sampler))
+	except ValueError as e:
+		parser.error(str(e))
+else:
+	evLoop.add(driver)
 
 if opts.max_events > 0:
 	nEvents = opts.max_events
 
+# Setting up periodic checkpoints of the driver output
+ckpt_driver = None
+if opts.checkpoint_events or opts.checkpoint_minutes or opts.resume or opts.stop_after:
+	from checkpoint import CheckpointDriver, checkpoint_dir, load_checkpoint
+	ckpt_path = checkpoint_dir(opts.output)
+	job = {'driver': opts.driver, 'input': opts.input, 'skip_events': opts.skip_events, 'max_events': opts.max_events,
+	       'sampling': [opts.sample_events, opts.sample_hits, opts.sample_strata, opts.sample_seed],
+	       'select': [opts.catalog, opts.select]}
+	ckpt = load_checkpoint(ckpt_path) if opts.resume else None
+	if ckpt:
+		if any(ckpt.get(key) != value for key, value in job.items()):
+			raise ValueError('Checkpoint in {0:s} was created with different driver, input or event range'.format(ckpt_path))
+		print('### Resuming from event {0:d}'.format(ckpt['position']))
+		# Appending to the LCIO output written up to the checkpoint
+		if hasattr(driver, 'LCIO_APPEND'):
+			driver.LCIO_APPEND = True
+		opts.skip_events = ckpt['position']
+		nEvents -= ckpt['processed']
+	elif opts.resume:
+		print('### No checkpoint found in {0:s}: starting from the beginning'.format(ckpt_path))
+	# The last process of a recycled job finishes normally
+	stop_after = opts.stop_after if opts.stop_after and nEvents > opts.stop_after else None
+	ckpt_driver = CheckpointDriver(driver, ckpt_path, job, opts.checkpoint_events, opts.checkpoint_minutes, ckpt, stop_after)
+	evLoop.add(ckpt_driver)
+
+# Releasing per-event objects and watching the memory usage
+if opts.max_rss_mb or opts.max_growth_mb:
+	from memory import MemoryGuardDriver
+	on_exceed = ckpt_driver.request_stop if ckpt_driver is not None else None
+	evLoop.add(MemoryGuardDriver([driver], opts.max_rss_mb, opts.max_growth_mb, opts.output + '.memreport.json', on_exceed=on_exceed))
+
 print('### Starting the loop over {0:d} events'.format(nEvents))
 # event = evLoop.reader.next()
 if opts.skip_events:
 	print('### Skipping {0:d} events'.format(opts.skip_events))
 	evLoop.skipEvents(opts.skip_events)
-evLoop.loop(nEvents)
+from checkpoint import StopForRecycle, RECYCLE_EXIT_CODE
+try:
+	evLoop.loop(nEvents)
+except StopForRecycle:
+	import sys
+	print('### Stopped after a checkpoint to continue in a new process')
+	sys.stdout.flush()
+	# Exiting without writing the incomplete output
+	os._exit(RECYCLE_EXIT_CODE)
 evLoop.printStatistics()
 
+# Storing the accumulated state of the driver for merging with other partial outputs
+if opts.save_state and hasattr(driver, 'getState'):
+	import pickle
+	with open(opts.save_state, 'wb') as f:
+		pickle.dump(driver.getState(), f, pickle.HIGHEST_PROTOCOL)
+
 print('### Finished')
@@ -0,0 +1,245 @@
+import zlib
+import numpy as np
+
+import ROOT as R
+from pyLCIO import EVENT
+from pyLCIO.drivers.Driver import Driver
+
+from drivers.utils import decode_cellids, collect_histos
+
+HIT_TYPES = [EVENT.LCIO.SIMTRACKERHIT, EVENT.LCIO.SIMCALORIMETERHIT,
+             EVENT.LCIO.TRACKERHIT, EVENT.LCIO.TRACKERHITPLANE, EVENT.LCIO.CALORIMETERHIT]
+
+
+def parse_strata(spec):
+    """Parses sampling fractions in the `COL=F,COL:LAYER=F,...` format"""
+    strata = {}
+    if not spec:
+        return strata
+    for item in spec.split(','):
+        key, fraction = item.split('=')
+        words = key.split(':')
+        layer = int(words[1]) if len(words) > 1 else None
+        strata[(words[0], layer)] = float(fraction)
+    return strata
+
+def double_histo(histo):
+    """Returns a histogram with double-precision bin contents replacing an integer one"""
+    class_name = histo.ClassName()
+    if not class_name.startswith(('TH1', 'TH2')) or class_name[-1] in 'DF':
+        return histo
+    axes = [histo.GetXaxis(), histo.GetYaxis()][:histo.GetDimension()]
+    binning = []
+    for axis in axes:
+        if axis.IsVariableBinSize():
+            edges = [axis.GetBinLowEdge(iB) for iB in range(1, axis.GetNbins() + 2)]
+            binning += [axis.GetNbins(), np.array(edges, dtype=np.float64)]
+        else:
+            binning += [axis.GetNbins(), axis.GetXmin(), axis.GetXmax()]
+    name = histo.GetName()
+    histo.SetName(name + '_int')
+    histo_d = getattr(R, 'TH{0:d}D'.format(histo.GetDimension()))(name, histo.GetTitle(), *binning)
+    histo_d.Add(histo)
+    # Keeping the original out of the output file
+    histo.SetDirectory(0)
+    return histo_d
+
+def replace_histos(histos, func):
+    """Replaces histograms in the (nested) dictionary or list by `func(histo)`"""
+    keys = histos.keys() if isinstance(histos, dict) else range(len(histos))
+    for key in list(keys):
+        value = histos[key]
+        if isinstance(value, (dict, list)):
+            replace_histos(value, func)
+        elif hasattr(value, 'Fill'):
+            histos[key] = func(value)
+
+
+class WeightedHisto(object):
+    """Histogram proxy applying the weight of the current sampled entry to every fill
+
+    Explicit weights of `Fill()` and the weight arrays of `FillN()` are multiplied by it.
+    """
+
+    def __init__(self, histo, sampler):
+        """Constructor"""
+        self.histo = double_histo(histo)
+        self.histo.Sumw2()
+        self.sampler = sampler
+        self.n_args = self.histo.GetDimension() + (1 if self.histo.InheritsFrom('TProfile') else 0)
+
+    def Fill(self, *args):
+        """Fills the histogram with the current weight times the explicitly given one"""
+        if len(args) == self.n_args:
+            return self.histo.Fill(*(args + (self.sampler.weight,)))
+        if len(args) == self.n_args + 1:
+            return self.histo.Fill(*(args[:-1] + (args[-1] * self.sampler.weight,)))
+        return self.histo.Fill(*args)
+
+    def FillN(self, n, *args):
+        """Fills the histogram with arrays of values scaling the weights by the current weight"""
+        args = list(args)
+        if len(args) > self.n_args and args[self.n_args] is not None:
+            args[self.n_args] = np.ascontiguousarray(args[self.n_args], dtype=np.float64) * self.sampler.weight
+        else:
+            args[self.n_args:self.n_args + 1] = [np.full(n, self.sampler.weight, dtype=np.float64)]
+        return self.histo.FillN(n, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.histo, name)
+
+
+class SampledCollection(object):
+    """View of an LCCollection containing only the sampled elements"""
+
+    def __init__(self, col, indices, weights, sampler):
+        """Constructor"""
+        self.col = col
+        self.indices = indices
+        self.weights = weights
+        self.sampler = sampler
+
+    def getNumberOfElements(self):
+        return len(self.indices)
+
+    def getElementAt(self, i):
+        """Returns the sampled element and makes its weight the current one"""
+        self.sampler.set_weight(self.weights[i])
+        return self.col.getElementAt(int(self.indices[i]))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for i in range(len(self.indices)):
+            yield self.getElementAt(i)
+
+    def __getattr__(self, name):
+        return getattr(self.col, name)
+
+
+class SampledEvent(object):
+    """View of an LCEvent returning sampled hit collections"""
+
+    def __init__(self, event, sampler, weight):
+        """Constructor"""
+        self.event = event
+        self.sampler = sampler
+        self.weight = weight
+        self.collections = {}
+
+    def getCollection(self, name):
+        """Returns a sampled view of hit collections and the original otherwise"""
+        if name not in self.collections:
+            col = self.event.getCollection(name)
+            if col.getTypeName() in HIT_TYPES:
+                col = self.sampler.sample_collection(self.event, name, col, self.weight)
+            self.collections[name] = col
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        return getattr(self.event, name)
+
+
+class Sampler(object):
+    """Deterministic random sampling of events and hits with the corresponding weights
+
+    Random numbers are seeded by the run and event numbers, so that the same entries are
+    selected independently of how the input is split between jobs.
+    """
+
+    def __init__(self, event_fraction=1.0, hit_fraction=1.0, strata=None, seed=0):
+        """Constructor"""
+        self.event_fraction = event_fraction
+        self.hit_fraction = hit_fraction
+        self.strata = strata or {}
+        self.seed = seed
+        self.weight = 1.0
+        self.data = None
+
+    def rng(self, event, *keys):
+        """Random generator specific to the event and optional string keys"""
+        seq = [self.seed, event.getRunNumber(), event.getEventNumber()]
+        seq += [zlib.crc32(key.encode()) for key in keys]
+        return np.random.default_rng(seq)
+
+    def set_weight(self, weight):
+        """Sets the weight used by histograms and the `weight` branch of the driver's TTree"""
+        self.weight = weight
+        if self.data is not None and 'weight' in self.data:
+            self.data['weight'][0] = weight
+
+    def keep_event(self, event):
+        """Whether the event is selected for processing"""
+        if self.event_fraction >= 1.0:
+            return True
+        return self.rng(event).random() < self.event_fraction
+
+    def sample_collection(self, event, name, col, weight):
+        """Selects hits of the collection using the per-collection or per-layer fractions"""
+        nHits = col.getNumberOfElements()
+        fractions = np.full(nHits, self.strata.get((name, None), self.hit_fraction))
+        layer_strata = {layer: f for (col_name, layer), f in self.strata.items() if col_name == name and layer is not None}
+        if layer_strata:
+            cellIdEncoding = col.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding)
+            cellids = np.zeros(nHits, dtype=np.uint64)
+            for iHit in range(nHits):
+                hit = col.getElementAt(iHit)
+                cellids[iHit] = int(hit.getCellID0() & 0xffffffff) | (int( hit.getCellID1() ) << 32)
+            layers = decode_cellids(cellids, cellIdEncoding, ['layer'])['layer']
+            for layer, fraction in layer_strata.items():
+                fractions[layers == layer] = fraction
+        indices = np.nonzero(self.rng(event, name).random(nHits) < fractions)[0]
+        weights = weight / fractions[indices]
+        return SampledCollection(col, indices, weights, self)
+
+
+class SamplingDriver( Driver ):
+    """Driver passing a random sample of events and hits to another driver
+
+    Histograms of the driver are filled with the weight of the last accessed sampled entry,
+    and its `weight` TTree branch, if present, is set accordingly.
+    Weights of per-event quantities are correct only when sampling whole events, so hits
+    are sampled only for drivers declaring `HIT_SAMPLING = True`, which fill all histograms
+    per hit with the complete hit weights. Their histograms are only converted to double
+    precision, without applying the weight once more.
+    """
+
+    def __init__( self, driver, sampler ):
+        """Constructor"""
+        Driver.__init__(self)
+        if (sampler.hit_fraction < 1.0 or sampler.strata) and not getattr(driver, 'HIT_SAMPLING', False):
+            raise ValueError('{0:s} fills per-event quantities and supports only event sampling, '
+                             'not --sample_hits or --sample_strata'.format(type(driver).__name__))
+        self.driver = driver
+        self.sampler = sampler
+        self.nSampled = 0
+
+    def wrap_histos( self, histos ):
+        """Replaces histograms in the (nested) dictionary by weighted proxies"""
+        if getattr(self.driver, 'HIT_SAMPLING', False):
+            replace_histos(histos, double_histo)
+            for histo in collect_histos(histos):
+                histo.Sumw2()
+        else:
+            replace_histos(histos, lambda histo: WeightedHisto(histo, self.sampler))
+
+    def startOfData( self ):
+        """Called by the event loop at the beginning of the loop"""
+        self.driver.startOfData()
+        self.wrap_histos(getattr(self.driver, 'histos', {}))
+        self.sampler.data = getattr(self.driver, 'data', None)
+
+    def processEvent( self, event ):
+        """Called by the event loop for each event"""
+        if not self.sampler.keep_event(event):
+            return
+        self.nSampled += 1
+        weight = 1.0 / self.sampler.event_fraction
+        self.sampler.set_weight(weight)
+        self.driver.processEvent(SampledEvent(event, self.sampler, weight))
+
+    def endOfData( self ):
+        """Called by the event loop at the end of the loop"""
+        print('### Processed {0:d} sampled events'.format(self.nSampled))
+        self.driver.endOfData()
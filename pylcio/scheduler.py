@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import glob
+import shlex
+import socket
+import argparse
+import subprocess
+
+import registry
+
+QUEUE_FILE = 'queue.json'
+STATES = ['todo', 'leased', 'done', 'failed']
+RUN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+
+
+def count_events(path):
+    """Number of events in the LCIO file"""
+    from pyLCIO import IOIMPL
+    reader = IOIMPL.LCFactory.getInstance().createLCReader()
+    reader.open(path)
+    n = reader.getNumberOfEvents()
+    reader.close()
+    return n
+
+def write_json(path, content):
+    """Writes a JSON file through a temporary one, so that it appears only when complete"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def unit_paths(queue, state, pattern='unit_*.json*'):
+    """Sorted paths of the work units in the given state"""
+    paths = glob.glob(os.path.join(queue, state, pattern))
+    return sorted(path for path in paths if not path.endswith('.tmp'))
+
+def unit_output(queue, name, suffix='.root'):
+    """Path of the partial output of the work unit"""
+    return os.path.join(queue, 'outputs', name.replace('.json', suffix))
+
+
+def create_queue(queue, inputs, output, events_per_unit, driver=registry.DEFAULT_DRIVER, run_args=None, max_attempts=3):
+    """Splits the input files into work units of at most `events_per_unit` events
+
+    Each unit is a JSON file with the input file and event range, which moves between
+    the `todo`, `leased`, `done` and `failed` folders of the queue by atomic renames.
+    """
+    if os.path.isfile(os.path.join(queue, QUEUE_FILE)):
+        raise IOError('Queue already exists in {0:s}'.format(queue))
+    for state in STATES + ['outputs']:
+        os.makedirs(os.path.join(queue, state), exist_ok=True)
+    iUnit = 0
+    for path in inputs:
+        nEvents = count_events(path)
+        print('  {0:s}: {1:d} events'.format(path, nEvents))
+        for skip in range(0, nEvents, events_per_unit):
+            unit = {'input': os.path.abspath(path), 'skip_events': skip,
+                    'max_events': min(events_per_unit, nEvents - skip), 'attempts': 0}
+            write_json(os.path.join(queue, 'todo', 'unit_{0:06d}.json'.format(iUnit)), unit)
+            iUnit += 1
+    config = {'output': os.path.abspath(output), 'driver': driver, 'run_args': run_args or [],
+              'max_attempts': max_attempts, 'n_units': iUnit}
+    write_json(os.path.join(queue, QUEUE_FILE), config)
+    return iUnit
+
+def load_queue(queue):
+    """Configuration of the queue"""
+    with open(os.path.join(queue, QUEUE_FILE)) as f:
+        return json.load(f)
+
+def status(queue):
+    """Number of work units in each state"""
+    return {state: len(unit_paths(queue, state)) for state in STATES}
+
+
+def lease(queue, worker):
+    """Takes the first available unit by renaming it into the `leased` folder with the worker's name
+
+    Returns the path of the lease or None if no unit is available.
+    Only one of the workers racing for a unit succeeds with the rename.
+    """
+    for path in unit_paths(queue, 'todo'):
+        leased = os.path.join(queue, 'leased', '{0:s}.{1:s}'.format(os.path.basename(path), worker))
+        try:
+            os.rename(path, leased)
+        except OSError:
+            continue
+        return leased
+    return None
+
+def heartbeat(leased):
+    """Renews the lease by updating its modification time; False if the lease was lost"""
+    try:
+        os.utime(leased)
+        return True
+    except OSError:
+        return False
+
+def unit_name(leased):
+    """Name of the unit file without the worker suffix of the lease"""
+    name = os.path.basename(leased)
+    return name[:name.index('.json') + len('.json')]
+
+def claim(queue, leased):
+    """Takes the unit out of the leases, so that no other worker can requeue or complete it
+
+    Returns the path of the claimed unit, or None if the lease was lost meanwhile.
+    """
+    claimed = os.path.join(queue, 'leased', 'claimed_' + os.path.basename(leased))
+    try:
+        os.rename(leased, claimed)
+    except OSError:
+        return None
+    return claimed
+
+def release(queue, leased, unit, failed=False):
+    """Returns the leased unit to the `todo` folder, or to `failed` after too many attempts
+
+    Returns False without any change if the lease is no longer held.
+    """
+    claimed = claim(queue, leased)
+    if claimed is None:
+        return False
+    write_json(claimed, unit)
+    os.rename(claimed, os.path.join(queue, 'failed' if failed else 'todo', unit_name(leased)))
+    return True
+
+def requeue_expired(queue, timeout, max_attempts):
+    """Moves the leases not renewed within `timeout` seconds back to the `todo` folder
+
+    An expired lease counts as a failed attempt, so that a unit that kills its workers is
+    eventually given up.
+    """
+    n = 0
+    now = time.time()
+    for leased in unit_paths(queue, 'leased'):
+        try:
+            if now - os.path.getmtime(leased) < timeout:
+                continue
+        except OSError:
+            # Completed or requeued by another worker meanwhile
+            continue
+        claimed = claim(queue, leased)
+        if claimed is None:
+            continue
+        with open(claimed) as f:
+            unit = json.load(f)
+        unit['attempts'] += 1
+        failed = unit['attempts'] >= max_attempts
+        write_json(claimed, unit)
+        os.rename(claimed, os.path.join(queue, 'failed' if failed else 'todo', unit_name(leased)))
+        print('### {0:s} expired lease: {1:s}'.format('Gave up' if failed else 'Requeued', os.path.basename(leased)))
+        n += 1
+    return n
+
+
+def process_unit(queue, config, leased, worker, heartbeat_every):
+    """Runs the driver over the event range of the leased unit, renewing the lease while it runs
+
+    The partial output is written under a worker-specific name and kept only if the unit is
+    still leased by this worker when it finishes.
+    Returns True if the unit was completed by this worker.
+    """
+    with open(leased) as f:
+        unit = json.load(f)
+    name = unit_name(leased)
+    output = unit_output(queue, name, '.{0:s}.root'.format(worker))
+    state = unit_output(queue, name, '.{0:s}.pkl'.format(worker))
+    cmd = [sys.executable, RUN_PATH, unit['input'], '-o', output, '-d', config['driver'],
+           '-s', str(unit['skip_events']), '-m', str(unit['max_events']), '--save_state', state] + config['run_args']
+    log_path = unit_output(queue, name, '.{0:s}.log'.format(worker))
+    with open(log_path, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        lost = False
+        while True:
+            try:
+                code = proc.wait(heartbeat_every)
+                break
+            except subprocess.TimeoutExpired:
+                if not heartbeat(leased):
+                    # The lease expired and the unit was given to another worker
+                    proc.kill()
+                    proc.wait()
+                    lost = True
+                    break
+    if lost or not os.path.isfile(leased):
+        print('### Lost the lease of {0:s}'.format(name))
+        return False
+    if code != 0 or not os.path.isfile(output):
+        unit['attempts'] += 1
+        failed = unit['attempts'] >= config['max_attempts']
+        if code != 0:
+            print('### Processing of {0:s} failed with code {1:d}, see: {2:s}'.format(name, code, log_path))
+        else:
+            print('### Processing of {0:s} wrote no output, see: {1:s}'.format(name, log_path))
+        release(queue, leased, unit, failed)
+        return False
+    # Publishing the output before marking the unit as done: a worker that lost the lease
+    # meanwhile can only replace it with the output of the same events
+    os.replace(output, unit_output(queue, name))
+    if os.path.isfile(state):
+        os.replace(state, unit_output(queue, name, '.pkl'))
+    try:
+        os.rename(leased, os.path.join(queue, 'done', name))
+    except OSError:
+        return False
+    os.remove(log_path)
+    return True
+
+def run_worker(queue, worker=None, heartbeat_every=30, lease_timeout=300, max_units=None):
+    """Processes units until the queue has none left to do or lease
+
+    Waits for units leased by other workers, which are requeued when their leases expire.
+    """
+    if worker is None:
+        worker = '{0:s}-{1:d}'.format(socket.gethostname(), os.getpid())
+    config = load_queue(queue)
+    nDone = 0
+    while max_units is None or nDone < max_units:
+        requeue_expired(queue, lease_timeout, config['max_attempts'])
+        leased = lease(queue, worker)
+        if leased is None:
+            if not unit_paths(queue, 'leased'):
+                break
+            time.sleep(heartbeat_every)
+            continue
+        print('### Worker {0:s} processing: {1:s}'.format(worker, unit_name(leased)))
+        if process_unit(queue, config, leased, worker, heartbeat_every):
+            nDone += 1
+    print('### Worker {0:s} finished {1:d} units'.format(worker, nDone))
+    return nDone
+
+
+def merge_outputs(queue, n_jobs=4):
+    """Merges the partial outputs of all units in the order of the inputs and event ranges"""
+    from manifest import merge_partials
+    from merge import merge_files
+    config = load_queue(queue)
+    counts = status(queue)
+    if counts['done'] != config['n_units']:
+        raise RuntimeError('Only {0:d} of {1:d} units are done: {2:s}'.format(counts['done'], config['n_units'], json.dumps(counts)))
+    names = [os.path.basename(path) for path in unit_paths(queue, 'done')]
+    parts = [(unit_output(queue, name), unit_output(queue, name, '.pkl')) for name in names]
+    info, kwargs, constants = registry.resolve(config['driver'])
+    driver_class = registry.load_driver(info, constants)
+    print('### Merging {0:d} partial outputs into: {1:s}'.format(len(parts), config['output']))
+    if hasattr(driver_class, 'setState'):
+        # Letting the driver compute its output from the accumulated state
+        merge_partials(driver_class(config['output'], **kwargs), parts)
+    else:
+        merge_files([output for output, _ in parts], config['output'], n_jobs)
+    return config['output']
+
+def run_local(queue, n_workers, heartbeat_every=30, lease_timeout=300):
+    """Runs the workers as local processes and merges their outputs"""
+    cmd = [sys.executable, os.path.abspath(__file__), 'work', queue,
+           '--heartbeat', str(heartbeat_every), '--lease_timeout', str(lease_timeout)]
+    workers = [subprocess.Popen(cmd + ['--worker', 'local{0:d}'.format(iW)]) for iW in range(n_workers)]
+    for proc in workers:
+        proc.wait()
+    return merge_outputs(queue, n_workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process many input files with a shared work queue of event ranges')
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('init', help='Create the work units of the input files')
+    cmd.add_argument('queue', metavar='QUEUE', type=str, help='Queue folder on a filesystem shared by the workers')
+    cmd.add_argument('input', metavar='input.slcio', type=str, help='List of input files', nargs='+')
+    cmd.add_argument('-o', dest='output', metavar='OUT.root', type=str, help='Path to the merged output ROOT file', required=True)
+    cmd.add_argument('-e', '--events_per_unit', metavar='N', type=int, help='Maximum number of events in a work unit', default=1000)
+    cmd.add_argument('-d', '--driver', metavar='NAME[:KEY=VALUE,...]', type=str, help='Driver to run', default=registry.DEFAULT_DRIVER)
+    cmd.add_argument('-a', '--run_args', metavar='ARGS', type=str, help='Additional arguments of run.py, e.g. "--sample_events 0.1"', default='')
+    cmd.add_argument('--max_attempts', metavar='N', type=int, help='Number of failed attempts before a unit is given up', default=3)
+    for name in ['work', 'local']:
+        cmd = commands.add_parser(name, help='Process units as a worker' if name == 'work' else 'Process units with local workers and merge the outputs')
+        cmd.add_argument('queue', metavar='QUEUE', type=str, help='Queue folder')
+        cmd.add_argument('--heartbeat', metavar='S', type=float, help='Interval between the lease renewals [s]', default=30)
+        cmd.add_argument('--lease_timeout', metavar='S', type=float, help='Age of a lease without renewal after which it is requeued [s]', default=300)
+        if name == 'work':
+            cmd.add_argument('--worker', metavar='ID', type=str, help='Worker name (default: host-pid)', default=None)
+            cmd.add_argument('--max_units', metavar='N', type=int, help='Stop after processing N units', default=None)
+        else:
+            cmd.add_argument('-n', '--workers', metavar='N', type=int, help='Number of local worker processes', default=4)
+    cmd = commands.add_parser('status', help='Print the number of units in each state')
+    cmd.add_argument('queue', metavar='QUEUE', type=str, help='Queue folder')
+    cmd = commands.add_parser('merge', help='Merge the outputs of all units')
+    cmd.add_argument('queue', metavar='QUEUE', type=str, help='Queue folder')
+    cmd.add_argument('-j', '--jobs', metavar='N', type=int, help='Number of parallel merging processes', default=4)
+    opts = parser.parse_args()
+
+    if opts.command == 'init':
+        try:
+            registry.resolve(opts.driver)
+        except ValueError as e:
+            parser.error(str(e))
+        nUnits = create_queue(opts.queue, opts.input, opts.output, opts.events_per_unit, opts.driver,
+                              shlex.split(opts.run_args), opts.max_attempts)
+        print('### Created {0:d} work units in: {1:s}'.format(nUnits, opts.queue))
+    elif opts.command == 'work':
+        run_worker(opts.queue, opts.worker, opts.heartbeat, opts.lease_timeout, opts.max_units)
+    elif opts.command == 'local':
+        output = run_local(opts.queue, opts.workers, opts.heartbeat, opts.lease_timeout)
+        print('### Finished: {0:s}'.format(output))
+    elif opts.command == 'status':
+        print(json.dumps(status(opts.queue)))
+    elif opts.command == 'merge':
+        output = merge_outputs(opts.queue, opts.jobs)
+        print('### Finished: {0:s}'.format(output))
+    else:
+        parser.print_help()
@@ -0,0 +1,234 @@
+import os
+import time
+import queue
+import pickle
+import shutil
+import argparse
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+import registry
+
+# Alignment of the arrays in a slot [bytes]
+ALIGN = 64
+
+
+def collection_names(driver_class):
+    """Hit collections read by the driver: a list or a dictionary of lists by hit type"""
+    names = driver_class.HIT_COLLECTION_NAMES
+    if isinstance(names, dict):
+        names = [name for col_names in names.values() for name in col_names]
+    return list(names)
+
+def event_arrays(event, col_names, readers):
+    """Columnar hits and decoded layers of each collection of the event"""
+    from pyLCIO import EVENT
+    from drivers.utils import decode_cellids
+    arrays = []
+    for col_name in col_names:
+        col = event.getCollection(col_name)
+        if col.getTypeName() not in readers:
+            raise ValueError('Collection {0:s} of type {1:s} cannot be read into arrays'.format(col_name, col.getTypeName()))
+        hits = readers[col.getTypeName()](col)
+        encoding = col.getParameters().getStringVal(EVENT.LCIO.CellIDEncoding)
+        layers = decode_cellids(hits['cellid'], encoding, ['layer'])['layer']
+        arrays.append((col_name, hits, layers))
+    return arrays
+
+def pack(arrays, buf, offset, size):
+    """Copies the arrays of one event into the buffer and returns their layout
+
+    The layout lists (col_name, [(field, dtype, offset, length), ...]) with the layers stored
+    as the field `None`, or None if the arrays do not fit into `size` bytes.
+    """
+    layout = []
+    pos = 0
+    for col_name, hits, layers in arrays:
+        fields = []
+        for name, values in list(hits.items()) + [(None, layers)]:
+            values = np.ascontiguousarray(values)
+            pos = -(-pos // ALIGN) * ALIGN
+            if pos + values.nbytes > size:
+                return None
+            buf[offset + pos:offset + pos + values.nbytes] = values.view(np.uint8)
+            fields.append((name, values.dtype.str, offset + pos, len(values)))
+            pos += values.nbytes
+        layout.append((col_name, fields))
+    return layout
+
+def unpack(layout, buf):
+    """Array views of one event in the buffer without copying"""
+    arrays = []
+    for col_name, fields in layout:
+        hits = {}
+        for name, dtype, offset, length in fields:
+            hits[name] = np.ndarray((length,), dtype=np.dtype(dtype), buffer=buf, offset=offset)
+        layers = hits.pop(None)
+        arrays.append((col_name, hits, layers))
+    return arrays
+
+
+def worker(driver_spec, output_path, state_path, shm_name, ready, free):
+    """Runs the driver on the events in the shared-memory slots until the end marker
+
+    Each message on `ready` is (slot, layout) for arrays in the slot or (None, arrays) for an
+    event too large for a slot. The slot is returned to `free` once all collections are processed.
+    """
+    info, kwargs, constants = registry.resolve(driver_spec)
+    driver = registry.load_driver(info, constants)(output_path, **kwargs)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    driver.startOfData()
+    while True:
+        message = ready.get()
+        if message is None:
+            break
+        slot, content = message
+        arrays = unpack(content, shm.buf) if slot is not None else content
+        for col_name, hits, layers in arrays:
+            driver.processArrays(col_name, hits, layers)
+        if hasattr(driver, 'endOfEventArrays'):
+            driver.endOfEventArrays()
+        # Releasing the views before the slot is reused
+        arrays = hits = layers = None
+        if slot is not None:
+            free.put(slot)
+    driver.endOfData()
+    if hasattr(driver, 'getState'):
+        with open(state_path, 'wb') as f:
+            pickle.dump(driver.getState(), f, pickle.HIGHEST_PROTOCOL)
+    shm.close()
+
+def next_slot(free, workers, timeout=1.0):
+    """Waits for a free slot, failing if a worker has died meanwhile"""
+    while True:
+        try:
+            return free.get(timeout=timeout)
+        except queue.Empty:
+            failed = [proc for proc in workers if proc.exitcode not in (None, 0)]
+            if failed:
+                raise RuntimeError('Worker {0:s} failed with code {1:d}'.format(failed[0].name, failed[0].exitcode))
+
+def run_pipeline(driver_spec, inputs, output_path, n_workers=4, n_slots=None, slot_mb=64, skip_events=0, max_events=-1):
+    """Processes the input files by one reader and `n_workers` driver processes sharing a ring of slots
+
+    The reader decodes the hit collections of each event into columnar arrays, copies them into a
+    free slot of the shared memory and passes only the slot layout to the workers, which run the
+    driver's `processArrays()` on views of the slot. With all slots in use the reader waits,
+    which bounds the memory to `n_slots * slot_mb`. The per-worker outputs are merged at the end.
+    """
+    from pyLCIO import IOIMPL, EVENT
+    from drivers.utils import read_sim_trk_hits, read_trk_hits, read_sim_cal_hits
+    from manifest import merge_partials
+    from merge import merge_files
+    readers = {
+        EVENT.LCIO.SIMTRACKERHIT: read_sim_trk_hits,
+        EVENT.LCIO.TRACKERHIT: read_trk_hits,
+        EVENT.LCIO.TRACKERHITPLANE: read_trk_hits,
+        EVENT.LCIO.SIMCALORIMETERHIT: read_sim_cal_hits,
+    }
+    info, kwargs, constants = registry.resolve(driver_spec)
+    driver_class = registry.load_driver(info, constants)
+    if not getattr(driver_class, 'PIPELINE_SAFE', False) or not hasattr(driver_class, 'processArrays'):
+        raise ValueError('Driver {0:s} does not declare PIPELINE_SAFE = True with processArrays()'.format(driver_class.__name__))
+    col_names = collection_names(driver_class)
+    n_slots = n_slots or 2 * n_workers
+    slot_size = int(slot_mb * (1 << 20))
+    parts_path = output_path + '.workers'
+    os.makedirs(parts_path, exist_ok=True)
+    parts = [(os.path.join(parts_path, 'worker_{0:d}.root'.format(iW)), os.path.join(parts_path, 'worker_{0:d}.pkl'.format(iW)))
+             for iW in range(n_workers)]
+
+    ctx = mp.get_context('spawn')
+    shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_size)
+    workers = []
+    try:
+        ready = ctx.Queue()
+        free = ctx.Queue()
+        for slot in range(n_slots):
+            free.put(slot)
+        workers = [ctx.Process(target=worker, name='worker_{0:d}'.format(iW), args=(driver_spec, output, state, shm.name, ready, free))
+                   for iW, (output, state) in enumerate(parts)]
+        for proc in workers:
+            proc.start()
+        # Reading the events in this process
+        nEvents = 0
+        nLarge = 0
+        t_start = time.time()
+        reader = IOIMPL.LCFactory.getInstance().createLCReader()
+        for input_path in inputs:
+            print('  reading: {0:s}'.format(input_path))
+            reader.open(input_path)
+            if skip_events > 0:
+                nSkip = min(skip_events, reader.getNumberOfEvents())
+                reader.skipNEvents(nSkip)
+                skip_events -= nSkip
+            event = reader.readNextEvent()
+            while event and (max_events < 0 or nEvents < max_events):
+                arrays = event_arrays(event, col_names, readers)
+                slot = next_slot(free, workers)
+                layout = pack(arrays, shm.buf, slot * slot_size, slot_size)
+                if layout is None:
+                    # Passing events larger than a slot by copy
+                    free.put(slot)
+                    ready.put((None, arrays))
+                    nLarge += 1
+                else:
+                    ready.put((slot, layout))
+                nEvents += 1
+                if nEvents % 100 == 0:
+                    print('### Read {0:d} events: {1:.1f} events/s'.format(nEvents, nEvents / (time.time() - t_start)))
+                event = reader.readNextEvent()
+            reader.close()
+            if max_events >= 0 and nEvents >= max_events:
+                break
+        for proc in workers:
+            ready.put(None)
+        for proc in workers:
+            proc.join()
+        failed = [proc for proc in workers if proc.exitcode != 0]
+        if failed:
+            raise RuntimeError('Worker {0:s} failed with code {1:d}'.format(failed[0].name, failed[0].exitcode))
+    finally:
+        for proc in workers:
+            if proc.is_alive():
+                proc.terminate()
+        shm.close()
+        shm.unlink()
+    print('### Processed {0:d} events by {1:d} workers, {2:d} passed by copy'.format(nEvents, n_workers, nLarge))
+
+    print('### Merging {0:d} partial outputs into: {1:s}'.format(len(parts), output_path))
+    if hasattr(driver_class, 'setState'):
+        # Letting the driver compute its output from the accumulated state
+        merge_partials(driver_class(output_path, **kwargs), parts)
+    else:
+        merge_files([output for output, _ in parts], output_path, n_workers)
+    shutil.rmtree(parts_path)
+    return nEvents
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process the events of large input files in parallel by workers sharing the decoded hits')
+    parser.add_argument('input', metavar='input.slcio', type=str, help='List of input files', nargs='+')
+    parser.add_argument('-d', '--driver', metavar='NAME[:KEY=VALUE,...]', type=str, help='Driver implementing processArrays()', required=True)
+    parser.add_argument('-o', dest='output', metavar='OUT.root', type=str, help='Path to the output ROOT file', required=True)
+    parser.add_argument('-j', '--workers', metavar='N', type=int, help='Number of worker processes', default=4)
+    parser.add_argument('--slots', metavar='N', type=int, help='Number of events in the shared memory (default: 2 per worker)', default=None)
+    parser.add_argument('--slot_mb', metavar='MB', type=float, help='Size of the shared memory for one event', default=64)
+    parser.add_argument('-m', '--max_events', metavar='N', type=int, help='Maximum number of events to process', default=-1)
+    parser.add_argument('-s', '--skip_events', metavar='N', type=int, help='Number of events to skip', default=0)
+    opts = parser.parse_args()
+
+    missing = [path for path in opts.input if not os.path.isfile(path)]
+    if missing:
+        parser.error('input files not found: {0:s}'.format(', '.join(missing)))
+    try:
+        registry.resolve(opts.driver)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        nEvents = run_pipeline(opts.driver, opts.input, opts.output, opts.workers, opts.slots, opts.slot_mb,
+                               opts.skip_events, opts.max_events)
+    except ValueError as e:
+        parser.error(str(e))
+    print('### Finished: {0:d} events in {1:s}'.format(nEvents, opts.output))
@@ -0,0 +1,294 @@
+import os
+import ast
+import argparse
+import numpy as np
+
+# Functions available in selection expressions
+FUNCTIONS = {name: getattr(np, name) for name in ['abs', 'sqrt', 'sin', 'cos', 'tan', 'degrees', 'radians', 'log10', 'isin', 'minimum', 'maximum']}
+
+
+def hit_energy(hit, type_name):
+    """Energy of a tracker or calorimeter hit"""
+    return hit.getEnergy() if 'Calorimeter' in type_name else hit.getEDep()
+
+def event_summary(event, hit_types):
+    """Collection sizes, generator-level particles and energy per hit collection of the event"""
+    summary = {}
+    names = list(event.getCollectionNames())
+    for name in names:
+        col = event.getCollection(name)
+        nElements = col.getNumberOfElements()
+        summary['n_' + name] = nElements
+        type_name = col.getTypeName()
+        if type_name not in hit_types:
+            continue
+        energy = np.zeros(nElements, dtype=np.float64)
+        pos = np.zeros((3, nElements), dtype=np.float64)
+        for iHit in range(nElements):
+            hit = col.getElementAt(iHit)
+            energy[iHit] = hit_energy(hit, type_name)
+            pos[:, iHit] = list(hit.getPosition())[:3]
+        theta = np.degrees(np.arctan2(np.hypot(pos[0], pos[1]), pos[2]))
+        summary['e_' + name] = energy.sum()
+        summary['thmin_' + name] = theta.min() if nElements else np.nan
+        summary['thmax_' + name] = theta.max() if nElements else np.nan
+    # Stable generator-level particles
+    mcps = []
+    if 'MCParticle' in names:
+        col = event.getCollection('MCParticle')
+        for iMcp in range(col.getNumberOfElements()):
+            mcp = col.getElementAt(iMcp)
+            if mcp.getGeneratorStatus() != 1:
+                continue
+            mom = mcp.getMomentum()
+            mcps.append((mcp.getPDG(), mcp.getCharge(), mcp.getEnergy(), mom[0], mom[1], mom[2]))
+    mcps = np.array(mcps, dtype=np.float64).reshape(-1, 6)
+    pdg, charge, e, px, py, pz = mcps.T
+    pt = np.hypot(px, py)
+    summary['nmcp'] = len(mcps)
+    summary['nmcp_charged'] = np.count_nonzero(charge)
+    summary['nmcp_mu'] = np.count_nonzero(np.abs(pdg) == 13)
+    summary['mcp_e_sum'] = e.sum()
+    iLead = np.argmax(pt) if len(pt) else None
+    summary['lead_pdg'] = pdg[iLead] if iLead is not None else 0
+    summary['lead_pt'] = pt[iLead] if iLead is not None else np.nan
+    summary['lead_theta'] = np.degrees(np.arctan2(pt[iLead], pz[iLead])) if iLead is not None else np.nan
+    summary['lead_phi'] = np.arctan2(py[iLead], px[iLead]) if iLead is not None else np.nan
+    return summary
+
+def build_catalog(inputs, output, max_events=None):
+    """Writes the summaries of all events in the input files into a columnar .npz catalog
+
+    Besides the summary columns, every event has its `run` and `event` numbers, the index
+    of its input file `ifile` and its `entry` in that file. `unique_id` marks the files, read
+    completely, in which no (run, event) pair repeats, so that events can be read by direct access.
+    Columns of collections missing in an event are 0, or NaN for the hit angles.
+    """
+    from pyLCIO import IOIMPL
+    from sampling import HIT_TYPES
+    rows = []
+    reader = IOIMPL.LCFactory.getInstance().createLCReader()
+    for iFile, path in enumerate(inputs):
+        print('  reading: {0:s}'.format(path))
+        reader.open(path)
+        entry = 0
+        ids = set()
+        file_rows = []
+        event = reader.readNextEvent()
+        while event and (max_events is None or len(rows) + len(file_rows) < max_events):
+            row = event_summary(event, HIT_TYPES)
+            row.update({'run': event.getRunNumber(), 'event': event.getEventNumber(), 'ifile': iFile, 'entry': entry})
+            ids.add((row['run'], row['event']))
+            file_rows.append(row)
+            entry += 1
+            event = reader.readNextEvent()
+        # Duplicates beyond the last read event could also be returned by direct access
+        unique = len(ids) == len(file_rows) and not event
+        if len(ids) < len(file_rows):
+            print('  WARNING: repeated run and event numbers, reading the events by position')
+        for row in file_rows:
+            row['unique_id'] = unique
+        rows.extend(file_rows)
+        reader.close()
+    names = sorted(set(name for row in rows for name in row))
+    columns = {}
+    for name in names:
+        default = np.nan if name.startswith(('thmin_', 'thmax_')) else 0
+        values = np.array([row.get(name, default) for row in rows])
+        if values.dtype.kind == 'f':
+            values = values.astype(np.float32)
+        columns[name] = values
+    columns['inputs'] = np.array([os.path.abspath(path) for path in inputs])
+    with open(output + '.tmp', 'wb') as f:
+        np.savez_compressed(f, **columns)
+    os.replace(output + '.tmp', output)
+    return len(rows)
+
+def load_catalog(path):
+    """Columns of the catalog and the list of its input files"""
+    with np.load(path) as data:
+        columns = {name: data[name] for name in data.files}
+    return columns, list(columns.pop('inputs'))
+
+
+class Vectorize(ast.NodeTransformer):
+    """Rewrites `and`, `or`, `not` and chained comparisons into element-wise NumPy operations"""
+
+    def call(self, func, args):
+        return ast.Call(func=ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()), attr=func, ctx=ast.Load()),
+                        args=args, keywords=[])
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        func = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        expr = node.values[0]
+        for value in node.values[1:]:
+            expr = self.call(func, [expr, value])
+        return expr
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return self.call('logical_not', [node.operand])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        parts = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            parts.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        expr = parts[0]
+        for part in parts[1:]:
+            expr = self.call('logical_and', [expr, part])
+        return expr
+
+
+def select(columns, expr):
+    """Boolean mask of the events passing the expression over the catalog columns
+
+    The expression uses column names, e.g. `nmcp == 1 and 20 < lead_theta < 30`,
+    NumPy functions from FUNCTIONS and `events((run, event), ...)` for specific events.
+    """
+    def events(*pairs):
+        keys = set((int(run), int(evt)) for run, evt in pairs)
+        return np.array([(run, evt) in keys for run, evt in zip(columns['run'], columns['event'])], dtype=bool)
+    tree = ast.fix_missing_locations(Vectorize().visit(ast.parse(expr, mode='eval')))
+    names = dict(FUNCTIONS, np=np, events=events)
+    names.update(columns)
+    mask = eval(compile(tree, '<selection>', 'eval'), {'__builtins__': {}}, names)
+    return np.broadcast_to(np.asarray(mask, dtype=bool), columns['run'].shape)
+
+def selected_events(catalog_path, expr):
+    """Input file, run and event numbers and entry of the selected events in the catalog order
+
+    The entry is None for files with unique (run, event) pairs, which are read by direct access.
+    """
+    columns, inputs = load_catalog(catalog_path)
+    mask = select(columns, expr)
+    # Catalogs without the flag are read by position
+    unique = columns.get('unique_id', np.zeros(len(mask), dtype=bool))[mask]
+    return [(inputs[iFile], int(run), int(evt), None if uniq else int(entry)) for iFile, run, evt, entry, uniq in
+            zip(columns['ifile'][mask], columns['run'][mask], columns['event'][mask], columns['entry'][mask], unique)]
+
+def iter_events(events):
+    """Reads only the listed events from their files
+
+    Events are read by direct access to (run, event), or by skipping to their entry in files
+    where the run and event numbers are not unique.
+    """
+    from pyLCIO import IOIMPL
+    reader = IOIMPL.LCFactory.getInstance().createLCReader()
+    current = None
+    position = 0
+    for path, run, evt, entry in events:
+        if path != current or (entry is not None and entry < position):
+            if current is not None:
+                reader.close()
+            reader.open(path)
+            current = path
+            position = 0
+        if entry is None:
+            event = reader.readEvent(run, evt)
+        else:
+            if entry > position:
+                reader.skipNEvents(entry - position)
+            event = reader.readNextEvent()
+            position = entry + 1
+        if not event:
+            raise IOError('Event {0:d}:{1:d} not found in {2:s}'.format(run, evt, path))
+        yield event
+    if current is not None:
+        reader.close()
+
+def loop_events(drivers, events):
+    """Runs the drivers over the listed events as the event loop would over the whole input"""
+    for driver in drivers:
+        driver.startOfData()
+    nEvents = 0
+    for event in iter_events(events):
+        for driver in drivers:
+            driver.processEvent(event)
+        nEvents += 1
+    for driver in drivers:
+        driver.endOfData()
+    return nEvents
+
+def write_skim(events, output):
+    """Copies the listed events into a new LCIO file"""
+    from pyLCIO import EVENT, IOIMPL
+    writer = IOIMPL.LCFactory.getInstance().createLCWriter()
+    writer.open(output, EVENT.LCIO.WRITE_NEW)
+    for event in iter_events(events):
+        writer.writeEvent(event)
+    writer.close()
+
+
+class SelectedEventLoop(object):
+    """Event loop over a list of selected events with the interface of the pyLCIO EventLoop used by run.py"""
+
+    def __init__(self, events):
+        """Constructor"""
+        self.events = events
+        self.drivers = []
+        self.position = 0
+        self.nProcessed = 0
+        self.reader = self
+
+    def getNumberOfEvents(self):
+        return len(self.events)
+
+    def add(self, driver):
+        self.drivers.append(driver)
+
+    def skipEvents(self, nEvents):
+        self.position += nEvents
+
+    def loop(self, nEvents=-1):
+        """Processes the selected events after the skipped ones"""
+        events = self.events[self.position:]
+        if nEvents >= 0:
+            events = events[:nEvents]
+        self.nProcessed = loop_events(self.drivers, events)
+
+    def printStatistics(self):
+        print('### Processed {0:d} of {1:d} selected events'.format(self.nProcessed, len(self.events)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a per-event summary catalog and skim events selected from it')
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('catalog', help='Write the summary catalog of the input files')
+    cmd.add_argument('input', metavar='input.slcio', type=str, help='List of input files', nargs='+')
+    cmd.add_argument('-o', dest='output', metavar='CATALOG.npz', type=str, help='Path to the catalog', required=True)
+    cmd.add_argument('-m', '--max_events', metavar='N', type=int, help='Maximum number of events', default=None)
+    cmd = commands.add_parser('select', help='List or copy into a new file the events passing the selection')
+    cmd.add_argument('catalog', metavar='CATALOG.npz', type=str, help='Path to the catalog')
+    cmd.add_argument('selection', metavar='EXPR', type=str, help='Selection expression, e.g. "nmcp == 1 and lead_pt > 10"')
+    cmd.add_argument('-o', dest='output', metavar='SKIM.slcio', type=str, help='Write the selected events into this file', default=None)
+    cmd = commands.add_parser('columns', help='List the columns of the catalog')
+    cmd.add_argument('catalog', metavar='CATALOG.npz', type=str, help='Path to the catalog')
+    opts = parser.parse_args()
+
+    if opts.command == 'catalog':
+        nEvents = build_catalog(opts.input, opts.output, opts.max_events)
+        print('### Finished: {0:d} events in {1:s}'.format(nEvents, opts.output))
+    elif opts.command == 'select':
+        events = selected_events(opts.catalog, opts.selection)
+        print('### Selected {0:d} events'.format(len(events)))
+        if opts.output:
+            write_skim(events, opts.output)
+            print('### Finished: {0:s}'.format(opts.output))
+        else:
+            for path, run, evt, _ in events:
+                print('{0:d} {1:d} {2:s}'.format(run, evt, path))
+    elif opts.command == 'columns':
+        columns, inputs = load_catalog(opts.catalog)
+        print('### {0:d} events from {1:d} files'.format(len(columns['run']), len(inputs)))
+        for name in sorted(columns):
+            print('  {0:s}'.format(name))
+    else:
+        parser.print_help()
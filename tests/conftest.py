@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Making the scripts of pylcio and the notebook helpers importable as in their own directories
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in ['pylcio', 'notebooks']:
+    sys.path.insert(0, os.path.join(ROOT_DIR, path))
@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip('ROOT')
+
+
+def test_merge_without_inputs(tmp_path):
+    from merge import merge_files
+    with pytest.raises(ValueError):
+        merge_files([], str(tmp_path / 'out.root'))
+
+
+def test_merge_groups_of_one(tmp_path):
+    from merge import merge_files
+    with pytest.raises(ValueError):
+        merge_files(['a.root', 'b.root'], str(tmp_path / 'out.root'), group_size=1)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+R = pytest.importorskip('ROOT')
+
+
+def test_tree_next_to_subdirectory(tmp_path):
+    from pycode.utils import read_root_obj, close_root_files, index_keys
+    path = str(tmp_path / 'out.root')
+    file_out = R.TFile(path, 'RECREATE')
+    tree = R.TTree('tree', 'tree')
+    value = np.zeros(1, dtype=np.float64)
+    tree.Branch('value', value, 'value/D')
+    for v in range(3):
+        value[0] = v
+        tree.Fill()
+    tree.Write()
+    file_out.mkdir('histos').cd()
+    histo = R.TH1F('h', '', 10, 0, 10)
+    histo.Fill(3)
+    histo.Write()
+    file_out.Close()
+
+    histo = read_root_obj(path, 'histos/h')
+    assert histo.GetEntries() == 1
+    file_in = R.TFile(path)
+    assert index_keys(file_in) == {'': (['tree'], ['histos']), 'histos': (['h'], [])}
+    file_in.Close()
+    close_root_files()
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+R = pytest.importorskip('ROOT')
+pytest.importorskip('pyLCIO')
+
+
+def test_weighted_fills_carry_sampling_weight():
+    from sampling import Sampler, WeightedHisto
+    from drivers.utils import fill_hist
+    sampler = Sampler(event_fraction=0.25)
+    sampler.set_weight(1.0 / sampler.event_fraction)
+    histo = WeightedHisto(R.TH1I('h_sampling_test', '', 10, 0, 10), sampler)
+    fill_hist(histo, np.array([1.5, 2.5, 3.5]))
+    assert histo.GetBinContent(2) == pytest.approx(4.0)
+    fill_hist(histo, np.array([4.5]), w=np.array([0.5]))
+    assert histo.GetBinContent(5) == pytest.approx(2.0)
+    histo.Fill(6.5, 3)
+    assert histo.GetBinContent(7) == pytest.approx(12.0)
+    histo.Fill(7.5)
+    assert histo.GetBinContent(8) == pytest.approx(4.0)
+    assert histo.Integral() == pytest.approx(4.0 * (3 + 0.5 + 3 + 1))